@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the local store of links and the indexes kept with it. They
+run on a generated account, so no simpy account or network access is
+needed.
+
+Usage:
+    python benchmark.py search [links] [queries]
+        Syncs a generated account into a new store with a search index,
+        and reports the time that takes, the size of the index and the
+        time per search, with the postings read from the database and
+        from memory. The results are checked against a scan of every link,
+        after the first sync and after one that changes some links and
+        removes others.
+
+    python benchmark.py tags [links] [queries]
+        Syncs a generated account into a store with a tag index and one
+        without, and reports the time to work out the views of the links
+        from each, and to answer random queries on their tags. The results
+        are checked against the tags of every link, after the first sync
+        and after one that changes some links and removes others.
+
+    python benchmark.py queries [links] [queries]
+        Syncs a generated account into a store with both indexes and one
+        with neither, and reports the time to answer random simpy queries
+        of each kind from each, for the first 50 results as the search page
+        shows them. All of the results are checked against matching the
+        queries with every link.
+
+    python benchmark.py complete [links] [tags] [queries]
+        Syncs a generated account with many tags into a store with a tag
+        index, and reports the time to complete the starts of tags, the
+        first time after a sync and after that. The tag counts and the
+        completions are checked against counting the tags of every link,
+        after the first sync and after one that changes some links and
+        removes others.
+"""
+
+import sys, os, time, random, shutil, tempfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'simpyapi-python-1.1'))
+from simpy import Link
+import store, search, tagindex, simpyquery
+
+TAGS = [u"read later", u"have read", u"starred", u"python", u"web",
+        u"music", u"recipes", u"news", u"reference", u"tools"]
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "pe", "da",
+             "gi", "fu", "zo", "be", "ha"]
+
+
+def makeVocabulary(rand, n):
+    words = {}
+    while len(words) < n:
+        words["".join([rand.choice(SYLLABLES)
+                       for i in range(rand.randint(2, 4))])] = True
+    return sorted(words)
+
+
+def makeWords(rand, vocabulary, n):
+    """Returns n words, the first ones in the vocabulary far more often than
+    the last, as in real text."""
+    return u" ".join([vocabulary[int(len(vocabulary) * rand.random() ** 3)]
+                      for i in range(n)])
+
+
+def makeLink(rand, vocabulary, i, version=0, tags=TAGS):
+    day = u"2009-%02d-%02d" % (1 + i % 12, 1 + i % 28)
+    return Link(url=u"http://example.com/%s/%d?ref=%d"
+                    % (makeWords(rand, vocabulary, 1), i, version),
+                title=makeWords(rand, vocabulary, rand.randint(3, 8)),
+                nickname=rand.random() < 0.2 and
+                         makeWords(rand, vocabulary, 2) or u"",
+                note=makeWords(rand, vocabulary, rand.randint(0, 60)),
+                tags=rand.sample(tags, rand.randint(1, 3)),
+                addDateStr=day, modDateStr=u"%s 10:%02d" % (day, version))
+
+
+class StandInClient:
+    """Hands the store a list of links, as SimpyClient.iterLinks would."""
+
+    def __init__(self, links):
+        self.links = links
+
+    def iterLinks(self, params):
+        return iter(self.links)
+
+
+def bruteForce(linkTerms, query):
+    """Returns the ids and scores of the links matching query, worked out
+    from the terms of every link the slow way."""
+    terms = dict.fromkeys(search.tokenize(query)).keys()
+    df = dict([(term, len([1 for id, t in linkTerms if term in t]))
+               for term in terms])
+    results = {}
+    for id, t in linkTerms:
+        if terms and not [term for term in terms if term not in t]:
+            results[id] = round(sum([t[term] * search.math.log(
+                1.0 + float(len(linkTerms)) / df[term])
+                for term in terms]), 6)
+    return results
+
+
+def checkSearches(linkStore, links, queries):
+    linkTerms = [(store.linkId(link.url), search.linkTerms(link))
+                 for link in links]
+    for query in queries:
+        expected = bruteForce(linkTerms, query)
+        ids = linkStore.searchIndex.search(linkStore._db(), query,
+                                           len(links))
+        if sorted(ids) != sorted(expected):
+            print "results differ for %r" % query
+            sys.exit(1)
+        scores = [expected[id] for id in ids]
+        if scores != sorted(scores, reverse=True):
+            print "results out of order for %r" % query
+            sys.exit(1)
+        if linkStore.searchIndex.search(linkStore._db(), query, 50) != \
+                ids[:50]:
+            print "the best results differ for %r" % query
+            sys.exit(1)
+    print "%d searches match a scan of every link" % len(queries)
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p))]
+
+
+def benchSearch(links=100000, queries=200):
+    rand = random.Random(0)
+    vocabulary = makeVocabulary(rand, 20000)
+    account = [makeLink(rand, vocabulary, i) for i in range(links)]
+    directory = tempfile.mkdtemp()
+    try:
+        timings = {}
+        for name, index in (('without index', None),
+                            ('with index', search.SearchIndex())):
+            path = os.path.join(directory, name.replace(' ', '_') + '.db')
+            linkStore = store.LinkStore(path, searchIndex=index)
+            start = time.time()
+            linkStore.sync(StandInClient(account), force=True)
+            print "first sync of %d links %s: %.1f sec" % \
+                (links, name, time.time() - start)
+        db = linkStore._db()
+        postings = db.execute('SELECT count(*), sum(length(postings)) '
+                              'FROM search_terms').fetchone()
+        terms = db.execute('SELECT sum(length(terms)) FROM search_docs'
+                           ).fetchone()[0]
+        print "%d terms, %.1f MB of postings, %.1f MB of the terms of each " \
+              "link, %.0f bytes per link in all" % \
+            (postings[0], postings[1] / 1048576.0, terms / 1048576.0,
+             float(postings[1] + terms) / links)
+
+        # Queries of one to three words taken from the links, so that most
+        # of them find something.
+        samples = []
+        for i in range(queries):
+            words = search.tokenize(rand.choice(account).title + u" " +
+                                    rand.choice(account).note)
+            samples.append(u" ".join(rand.sample(words, min(len(words),
+                                                            rand.randint(1, 3)))))
+        for cold in (True, False):
+            timings = []
+            for query in samples:
+                if cold:
+                    linkStore.searchIndex = search.SearchIndex()
+                start = time.time()
+                linkStore.searchIndex.search(db, query, 50)
+                timings.append(time.time() - start)
+            print "%-28s median %6.3f ms, 90%% %6.3f ms, max %6.3f ms" % \
+                (cold and "postings from the database" or
+                 "postings from memory", 1000 * percentile(timings, 0.5),
+                 1000 * percentile(timings, 0.9), 1000 * max(timings))
+        # The commonest words on their own, too, which have their best links
+        # ranked in the index.
+        checks = samples[:20] + vocabulary[:5]
+        checkSearches(linkStore, account, checks)
+
+        # Change 1% of the links, remove 1% and add 1%.
+        changed = account[:]
+        for i in rand.sample(range(links), links // 100):
+            changed[i] = makeLink(rand, vocabulary, i, version=1)
+        for i in sorted(rand.sample(range(links), links // 100),
+                        reverse=True):
+            del changed[i]
+        changed += [makeLink(rand, vocabulary, links + i)
+                    for i in range(links // 100)]
+        start = time.time()
+        linkStore.sync(StandInClient(changed), full=True)
+        print "sync changing 3%% of the links: %.1f sec" % \
+            (time.time() - start)
+        linkStore.searchIndex = search.SearchIndex()
+        checkSearches(linkStore, changed, checks)
+    finally:
+        shutil.rmtree(directory)
+
+
+VIEWS = {'unread': tagindex.tagExpression([u"read later"], [u"have read"]),
+         'starred': tagindex.tagExpression([u"starred"]),
+         'read': tagindex.tagExpression([u"have read"])}
+
+
+def makeExpression(rand, depth=0):
+    """Returns a random tag expression."""
+    if depth == 2 or rand.random() < 0.4:
+        expression = (tagindex.TAG, rand.choice(TAGS))
+    else:
+        expression = (rand.choice([tagindex.AND, tagindex.OR]),) + \
+            tuple([makeExpression(rand, depth + 1)
+                   for i in range(rand.randint(2, 3))])
+    if rand.random() < 0.2:
+        expression = (tagindex.NOT, expression)
+    return expression
+
+
+def checkTagged(linkStore, links, expressions):
+    for expression in expressions:
+        expected = [store.linkId(link.url) for link in links
+                    if tagindex.matches(expression, link.tags)]
+        found = [link.id for link in linkStore.tagged(expression)]
+        if sorted(found) != sorted(expected):
+            print "results differ for %r" % (expression,)
+            sys.exit(1)
+        dates = [link.addDateStr for link in linkStore.tagged(expression)]
+        if dates != sorted(dates, reverse=True):
+            print "results out of order for %r" % (expression,)
+            sys.exit(1)
+    print "%d tag queries match the tags of every link" % len(expressions)
+
+
+def timeIt(function, repeat=5):
+    """Returns the best time of `repeat` calls of function."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        best = min(best or 1e9, time.time() - start)
+    return best
+
+
+def benchTags(links=100000, queries=200):
+    rand = random.Random(0)
+    vocabulary = makeVocabulary(rand, 2000)
+    account = [makeLink(rand, vocabulary, i) for i in range(links)]
+    expressions = [makeExpression(rand) for i in range(queries)]
+    directory = tempfile.mkdtemp()
+    try:
+        stores = {}
+        for name, index in (('without index', None),
+                            ('with index', tagindex.TagIndex())):
+            path = os.path.join(directory, name.replace(' ', '_') + '.db')
+            stores[name] = store.LinkStore(path, tagIndex=index)
+            start = time.time()
+            stores[name].sync(StandInClient(account), force=True)
+            print "first sync of %d links %s: %.1f sec" % \
+                (links, name, time.time() - start)
+        linkStore = stores['with index']
+        db = linkStore._db()
+        print "%d tags, %.1f KB of bitmaps" % tuple(db.execute(
+            'SELECT count(*) - 1, sum(length(bitmap)) / 1024.0 '
+            'FROM tag_bitmaps').fetchone())
+
+        # Most links are in the views; a view of a tag few links have shows
+        # what is saved by reading only the links in it.
+        rare = {'rare': (tagindex.AND, (tagindex.TAG, u"recipes"),
+                         (tagindex.TAG, u"tools"),
+                         (tagindex.NOT, (tagindex.TAG, u"have read")))}
+        for views, label in ((VIEWS, "the three views"),
+                             (rare, "a view of %d links" % len(
+                                 linkStore.tagged(rare['rare'])))):
+            for name in ('without index', 'with index'):
+                print "%-32s %-14s %8.1f ms" % (label, name, 1000 * timeIt(
+                    lambda: stores[name].partition(views)))
+        timings = []
+        for expression in expressions:
+            linkStore.tagIndex = tagindex.TagIndex()
+            start = time.time()
+            linkStore.tagIndex.evaluate(db, expression)
+            timings.append(time.time() - start)
+        print "bitmap of a query, median %.3f ms, 90%% %.3f ms, max %.3f ms" \
+            % (1000 * percentile(timings, 0.5),
+               1000 * percentile(timings, 0.9), 1000 * max(timings))
+        checks = expressions[:20] + VIEWS.values() + rare.values()
+        checkTagged(linkStore, account, checks)
+
+        # Change 1% of the links, remove 1% and add 1%.
+        changed = account[:]
+        for i in rand.sample(range(links), links // 100):
+            changed[i] = makeLink(rand, vocabulary, i, version=1)
+        for i in sorted(rand.sample(range(links), links // 100),
+                        reverse=True):
+            del changed[i]
+        changed += [makeLink(rand, vocabulary, links + i)
+                    for i in range(links // 100)]
+        start = time.time()
+        linkStore.sync(StandInClient(changed), full=True)
+        print "sync changing 3%% of the links: %.1f sec" % \
+            (time.time() - start)
+        checkTagged(linkStore, changed, checks)
+    finally:
+        shutil.rmtree(directory)
+
+
+def makeTerm(rand, account, kind):
+    """Returns a random query term of the given kind, taken from a link so
+    that most of them match something."""
+    link = rand.choice(account)
+    if kind == 'tag':
+        return u'tags:"%s"' % rand.choice(TAGS)
+    words = search.tokenize(link.title + u" " + link.note)
+    if kind == 'word':
+        return rand.choice(words)
+    i = rand.randrange(len(words) - 1)
+    if kind == 'phrase':
+        return u'"%s %s"' % (words[i], words[i + 1])
+    return u'title:%s' % rand.choice(search.tokenize(link.title))
+
+
+# The kinds of query timed, as the kinds of their terms; a query is made
+# of one to three terms of the kinds given, with random signs.
+QUERY_KINDS = (('tags', ('tag',)), ('words', ('word',)),
+               ('tags and words', ('tag', 'word')),
+               ('phrases and fields', ('phrase', 'field', 'word')))
+
+
+def makeQuery(rand, account, kinds):
+    terms = []
+    for i in range(rand.randint(1, 3)):
+        sign = rand.choice([u"", u"", u"+", u"-"])
+        terms.append(sign + makeTerm(rand, account, rand.choice(kinds)))
+    return u" ".join(terms)
+
+
+def benchQueries(links=20000, queries=50):
+    rand = random.Random(0)
+    vocabulary = makeVocabulary(rand, 2000)
+    account = [makeLink(rand, vocabulary, i) for i in range(links)]
+    directory = tempfile.mkdtemp()
+    try:
+        stores = {}
+        for name, indexes in (('without indexes', {}),
+                              ('with indexes', {
+                                  'searchIndex': search.SearchIndex(),
+                                  'tagIndex': tagindex.TagIndex()})):
+            path = os.path.join(directory, name.replace(' ', '_') + '.db')
+            stores[name] = store.LinkStore(path, **indexes)
+            stores[name].sync(StandInClient(account), force=True)
+        ids = [store.linkId(link.url) for link in account]
+        for label, kinds in QUERY_KINDS:
+            samples = [makeQuery(rand, account, kinds)
+                       for i in range(queries)]
+            for name in ('without indexes', 'with indexes'):
+                timings = []
+                for text in samples:
+                    start = time.time()
+                    first = stores[name].search(text, 50)
+                    timings.append(time.time() - start)
+                    found = [link.id for link in stores[name].search(text)]
+                    query = simpyquery.Query(text)
+                    expected = [id for id, link in zip(ids, account)
+                                if query.matches(link)]
+                    if sorted(found) != sorted(expected) or \
+                       [link.id for link in first] != found[:50]:
+                        print "results differ for %r %s" % (text, name)
+                        sys.exit(1)
+                print "%-20s %-16s median %7.1f ms, 90%% %7.1f ms" % \
+                    (label, name, 1000 * percentile(timings, 0.5),
+                     1000 * percentile(timings, 0.9))
+        print "every query matches matching it with every link"
+    finally:
+        shutil.rmtree(directory)
+
+
+def checkTagCounts(linkStore, links):
+    counts = {}
+    for link in links:
+        for tag in link.tags:
+            counts[tag] = counts.get(tag, 0) + 1
+    expected = sorted([(-count, tag) for tag, count in counts.items()])
+    found = [(-item['count'], item['tag']) for item in linkStore.tagCounts()]
+    if found != expected:
+        print "tag counts differ"
+        sys.exit(1)
+    prefixes = [u""] + [tag[:n] for tag in counts for n in (1, 2, 4)]
+    for prefix in prefixes:
+        completions = [(item['tag'], item['count']) for item
+                       in linkStore.completeTag(prefix.upper(), 10)]
+        if completions != [(tag, -count) for count, tag in expected
+                           if tag.startswith(prefix)][:10]:
+            print "completions differ for %r" % prefix
+            sys.exit(1)
+    print "%d tag counts and %d completions match counting the tags of " \
+        "every link" % (len(counts), len(prefixes))
+
+
+def benchComplete(links=20000, tags=5000, queries=1000):
+    rand = random.Random(0)
+    vocabulary = makeVocabulary(rand, 2000)
+    tagNames = makeVocabulary(rand, tags)
+    account = [makeLink(rand, vocabulary, i, tags=tagNames)
+               for i in range(links)]
+    prefixes = [tag[:rand.randint(1, 4)]
+                for tag in rand.sample(tagNames, min(queries, tags))]
+    directory = tempfile.mkdtemp()
+    try:
+        linkStore = store.LinkStore(os.path.join(directory, 'complete.db'),
+                                    tagIndex=tagindex.TagIndex())
+        linkStore.sync(StandInClient(account), force=True)
+        start = time.time()
+        linkStore.completeTag(u"")
+        print "first completion after a sync, %d tags: %.1f ms" % \
+            (tags, 1000 * (time.time() - start))
+        timings = []
+        for prefix in prefixes:
+            start = time.time()
+            linkStore.completeTag(prefix)
+            timings.append(time.time() - start)
+        print "completion, median %.3f ms, 90%% %.3f ms, max %.3f ms" % \
+            (1000 * percentile(timings, 0.5), 1000 * percentile(timings, 0.9),
+             1000 * max(timings))
+        checkTagCounts(linkStore, account)
+
+        # Change 1% of the links, remove 1% and add 1%.
+        changed = account[:]
+        for i in rand.sample(range(links), links // 100):
+            changed[i] = makeLink(rand, vocabulary, i, version=1,
+                                  tags=tagNames)
+        for i in sorted(rand.sample(range(links), links // 100),
+                        reverse=True):
+            del changed[i]
+        changed += [makeLink(rand, vocabulary, links + i, tags=tagNames)
+                    for i in range(links // 100)]
+        linkStore.sync(StandInClient(changed), full=True)
+        checkTagCounts(linkStore, changed)
+    finally:
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {'search': benchSearch, 'tags': benchTags,
+              'queries': benchQueries, 'complete': benchComplete}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print __doc__
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
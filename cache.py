@@ -0,0 +1,190 @@
+"""Caches for things that are expensive to work out and rarely change.
+
+LRUCache keeps a bounded number of values in memory, DiskCache keeps values
+in files so that they survive from one CGI process to the next, and
+TieredCache puts the first in front of the second.
+"""
+import os, time, threading, tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+def contentKey(*parts):
+    """Return a key for content made of the given strings, a hex digest that
+    changes if any of them do."""
+    digest = sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update(part)
+        digest.update('\0')
+    return digest.hexdigest()
+
+class LRUCache:
+    """An in-memory cache of at most `size` values, which forgets the least
+    recently used value when it is full. Safe to share between threads."""
+
+    # Indexes into the [prev, next, key, value] entries of the linked list.
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = {}
+        # A circular doubly linked list, most recently used first.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            self._push(entry)
+            return entry[self.VALUE]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            elif len(self.entries) >= self.size:
+                oldest = self.root[self.PREV]
+                self._unlink(oldest)
+                del self.entries[oldest[self.KEY]]
+            entry = [None, None, key, value]
+            self.entries[key] = entry
+            self._push(entry)
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unlink(self, entry):
+        entry[self.PREV][self.NEXT] = entry[self.NEXT]
+        entry[self.NEXT][self.PREV] = entry[self.PREV]
+
+    def _push(self, entry):
+        first = self.root[self.NEXT]
+        entry[self.PREV], entry[self.NEXT] = self.root, first
+        first[self.PREV] = self.root[self.NEXT] = entry
+
+class DiskCache:
+    """A cache of unicode strings kept in files under `path`, one file per
+    key. Keys must be safe to use as file names, e.g. from contentKey().
+
+    If `size` is given the cache keeps about that many values: at most every
+    `sweep_interval` seconds, a set() that finds more than that removes the
+    least recently used, going by the modification times of the files, which
+    get() brings up to date.
+
+    Failing to read or write the cache is never an error; the value is just
+    not cached."""
+
+    SUFFIX = '.cache'
+
+    # The file whose modification time is when the cache was last swept.
+    SWEPT = 'swept'
+
+    def __init__(self, path, size=None, sweep_interval=10 * 60):
+        self.path = path
+        self.size = size
+        self.sweep_interval = sweep_interval
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key[2:] + self.SUFFIX)
+
+    def get(self, key, default=None):
+        filename = self._filename(key)
+        try:
+            f = open(filename, 'rb')
+            try:
+                value = f.read().decode('utf-8')
+            finally:
+                f.close()
+            if self.size is not None:
+                os.utime(filename, None)
+            return value
+        except (IOError, OSError, UnicodeDecodeError):
+            return default
+
+    def set(self, key, value):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # Write to a temporary file and rename it into place, so that
+            # other processes never see a half-written value.
+            fd, tmp = tempfile.mkstemp(suffix=self.SUFFIX, dir=directory)
+            try:
+                os.write(fd, value.encode('utf-8'))
+            finally:
+                os.close(fd)
+            os.rename(tmp, filename)
+        except (IOError, OSError):
+            pass
+        if self.size is not None:
+            self._maybeSweep()
+
+    def _maybeSweep(self):
+        swept = os.path.join(self.path, self.SWEPT)
+        try:
+            if time.time() - os.path.getmtime(swept) < self.sweep_interval:
+                return
+        except OSError:
+            pass
+        try:
+            # Touch the file first, so that other processes don't sweep too.
+            open(swept, 'wb').close()
+            self.sweep()
+        except (IOError, OSError):
+            pass
+
+    def sweep(self):
+        """Remove the least recently used values until at most `size` are
+        left."""
+        entries = []
+        for directory, subdirectories, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(self.SUFFIX):
+                    filename = os.path.join(directory, name)
+                    try:
+                        entries.append((os.path.getmtime(filename), filename))
+                    except OSError:
+                        pass
+        if len(entries) <= self.size:
+            return
+        entries.sort()
+        for mtime, filename in entries[:len(entries) - self.size]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+class TieredCache:
+    """A cache that looks in each of `tiers` in turn, copying a value found in
+    a slower tier into the faster ones."""
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+
+    def get(self, key, default=None):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
@@ -2,3 +2,14 @@ title="read_later"
 simpy_user='username'
 simpy_pass='password'
 base_url='http://0.0.0.0:8080/'
+store_db='read_later.db'
+cache_dir='cache'
+note_cache_size=1000
+note_disk_cache_size=10000
+page_cache_size=10
+page_disk_cache_size=100
+preview_cache_size=1000
+link_cache_size=1000
+search_cache_size=1000
+tag_cache_size=1000
+views={}
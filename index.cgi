@@ -1,22 +1,125 @@
 #!/usr/bin/env python
-import sys, datetime, urllib2 # Standard library stuff.
+import os, sys, datetime, threading, urllib, urllib2 # Standard library stuff.
+import httplib, sqlite3
+from xml.parsers.expat import ExpatError
+try:
+    import json
+except ImportError:
+    import simplejson as json
 import web # web.py
 sys.path.append('./markdown-1.7')
-from markdown import Markdown
+from markdown import MarkdownPool, IncrementalMarkdown, convertPool, \
+     convert_many, version as markdown_version
 sys.path.append('./simpyapi-python-1.1')
 from simpy import SimpyClient
 import config # the config file
+from store import LinkStore, linkId, permalink
+from summary import Summarizer, EXCERPT_WORDS
+from search import SearchIndex
+from tagindex import TagIndex
+from cache import LRUCache, DiskCache, TieredCache, contentKey
 
 # Utility functions
 # =================
 
+# Markdown instances shared by the threads serving requests.
+markdown_pool = MarkdownPool(4)
+
 def markdown(text):
     """Given a string of plain text, return a string of html via markdown."""
-    md = Markdown()
-    return md.convert(text)
+    return markdown_pool.convert(text)
+
+# Markdown instances for /preview. They share the html of the sections of
+# the notes they have rendered, so that as a note is typed only the section
+# being edited is rendered again. Raw html is escaped, since whatever is
+# posted to /preview, by any page, is sent straight back as html.
+preview_pool = MarkdownPool(4, markdownClass=IncrementalMarkdown,
+                            blockCache=LRUCache(config.preview_cache_size),
+                            safe_mode='escape')
+
+# The version of the renderer, which the html of notes is kept under. It is
+# made from the source of markdown.py, since markdown's own version number
+# doesn't change when the renderer does, so that any change to it renders
+# every note again.
+RENDERER_VERSION = contentKey(markdown_version,
+    open(os.path.join('markdown-1.7', 'markdown.py')).read())
+
+# Rendered notes, keyed by the note text and the version of the renderer.
+# The disk tier is shared by every process serving the site.
+note_cache = TieredCache(LRUCache(config.note_cache_size),
+                         DiskCache(os.path.join(config.cache_dir, 'notes'),
+                                   config.note_disk_cache_size))
+
+def renderNote(text):
+    """Return the html for a note, rendering it only if this note has never
+    been rendered before."""
+    key = contentKey(RENDERER_VERSION, text)
+    html = note_cache.get(key)
+    if html is None:
+        html = markdown(text)
+        note_cache.set(key, html)
+    return html
+
+# When more than this many notes that have never been rendered are summarized
+# at once, they are rendered by a pool of processes, one per core, if the
+# pool has been started.
+PARALLEL_RENDER_THRESHOLD = 50
+
+def cpuCount():
+    """Return the number of cores, or 1 if it can't be found out."""
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+# The pool of processes, if it has been started, or else None.
+render_processes = None
+
+def startRenderProcesses():
+    """Start the pool of processes that renders notes, if there is more than
+    one core. It is only worth having in a server that keeps running: a CGI
+    process would start it for every request and hardly ever use it.
+
+    Forking copies the parent's threads' locks into the children in
+    whatever state they are in, so this has to be called before the server
+    starts any threads. The children never use the store's connection, and
+    leave without closing it."""
+    global render_processes
+    if cpuCount() > 1:
+        render_processes = convertPool()
+
+def renderNotes(texts):
+    """Return the html for each of a list of notes, rendering the ones that
+    are not in the cache in parallel if there are enough of them and the
+    pool of processes has been started."""
+    html = [None] * len(texts)
+    missing = {}
+    for i, text in enumerate(texts):
+        key = contentKey(RENDERER_VERSION, text)
+        html[i] = note_cache.get(key)
+        if html[i] is None:
+            missing.setdefault(key, []).append(i)
+    if not missing:
+        return html
+    keys = missing.keys()
+    sources = [texts[missing[key][0]] for key in keys]
+    if len(keys) > PARALLEL_RENDER_THRESHOLD and render_processes is not None:
+        rendered = convert_many(sources, pool=render_processes)
+    else:
+        rendered = [markdown(source) for source in sources]
+    for key, note_html in zip(keys, rendered):
+        note_cache.set(key, note_html)
+        for i in missing[key]:
+            html[i] = note_html
+    return html
+
+# The template for one link, compiled once and shared by every SimpyLink.
+link_template = web.template.frender('templates/simpylink.html')
 
 class SimpyLink:
-    """A link from a simpy account."""
+    """A link from a simpy account, as shown in the listings: with the
+    summary of its note rather than the whole note."""
     
     def __init__(self,d):
 
@@ -28,21 +131,20 @@ class SimpyLink:
             self.name = web.safestr(d['title'])
         else:
             self.name = web.safestr(d['nickname'])
+        self.id = d['id']
         self.note = d['note']
-        self.note_html = markdown(self.note)
+        self.excerpt_html = d['excerptHtml']
+        self.word_count = d['wordCount']
+        self.truncated = self.word_count > EXCERPT_WORDS
         self.tags = d['tags']
         self.date = d['addDate']
         self.datestr = web.datestr(self.date)
+        # The day it was added, which unlike datestr ("3 hours ago") stays
+        # true on a page that the browser keeps while it gets 304s.
+        self.daystr = '%d %s' % (self.date.day, self.date.strftime('%B %Y'))
         self.url = d['url']
-        i = len(self.url)
-        try:
-            i = self.url.index('?')
-        except ValueError:
-            # url does not contain a '?'
-            pass            
-        self.permalink = self.url[0:i]
-        template = web.template.frender('templates/simpylink.html')
-        self.html = template(self)
+        self.permalink = permalink(self.url)
+        self.html = link_template(self)
         
 # The simpy stuff
 # ===============
@@ -50,42 +152,131 @@ class SimpyLink:
 # Initialise the SimpyClient object that handles accessing simpy.
 simpy = SimpyClient(config.simpy_user,config.simpy_pass)
 
-# Queries used to get lists of links from query.
+# Queries used to get lists of links from query. They are answered from the
+# local store (see simpyquery), and simpy answers them for the RSS feeds.
 UNREAD_QUERY = '+tags:"read later" -tags:"have read"'
 STARRED_QUERY = '+tags:starred'
 READ_QUERY = '+tags:"have read"'
 
+# The views of the links, as simpy queries: the built-in ones and any set up
+# in config.views, which are shown at /view/<name>.
+BUILTIN_VIEWS = {'unread': UNREAD_QUERY, 'starred': STARRED_QUERY,
+                 'read': READ_QUERY}
+VIEWS = dict(config.views, **BUILTIN_VIEWS)
+
+# The local copy of the simpy account that the pages are served from, with
+# a summary of each note for the listings, an index for searching it and
+# one of its tags for working out the views. The whole account is kept,
+# not just the links in the views, since any query can be asked of it: a
+# view in config.views, a search or the tags.
+summarizer = Summarizer(renderNotes, RENDERER_VERSION)
+store = LinkStore(config.store_db, None, summarizer,
+                  config.link_cache_size, SearchIndex(config.search_cache_size),
+                  TagIndex(config.tag_cache_size))
+
+# The most links a search shows.
+SEARCH_RESULTS = 50
+
+# The most tags /tags/complete suggests.
+TAG_COMPLETIONS = 10
+
 class SimpyNotAvailableError(Exception):
     def __init__(self,value):
         self.value = value
     def __str__(self):
         return repr(self.value)
 
-def getLinks(query):
-    """Return all the links from simpy that match a given query as a list of
-    SimpyLink objects."""
+def syncStore(full=False):
+    """Pull any changes from simpy into the local store, downloading the
+    whole account again if `full` is true. If simpy can't be reached, or
+    the store is busy with another sync for too long, the store is left as
+    it was, unless it has never been filled."""
     try:
-        links = simpy.getLinks({'limit':'-1','q':query})
-    except urllib2.HTTPError, e:
-        raise SimpyNotAvailableError(e)
-    link_objects = []
+        store.sync(simpy, full=full)
+    # urllib2 and socket errors, a response that was cut off or garbled, or
+    # a sync that waited too long for another one to finish.
+    except (IOError, ExpatError, httplib.HTTPException,
+            sqlite3.OperationalError), e:
+        if store.isEmpty():
+            raise SimpyNotAvailableError(e)
+
+def fingerprint(name, links):
+    """Return a key that changes whenever the page for the named view would:
+    when a link is added, removed or modified, or the templates or the
+    summaries change."""
+    parts = [name, TEMPLATES_VERSION, summarizer.version]
     for link in links:
-        link_objects.append(SimpyLink(link))
-    return link_objects
+        parts.append(linkId(link.url))
+        parts.append(link.modDateStr)
+    return contentKey(*parts)
+
+# The partitioned links and their fingerprints, and the store version they
+# were read at.
+_views = (None, None, None)
+
+# The fingerprints are also kept in the store, under this key, for the other
+# processes serving the site.
+FINGERPRINTS_STATE = 'view_fingerprints'
+
+def fingerprintsContext():
+    """Return what the fingerprints depend on besides the links."""
+    return contentKey(TEMPLATES_VERSION, summarizer.version,
+                      repr(sorted(VIEWS.items())))
+
+def getViews():
+    """Return all the views, worked out from the local store, and a
+    dictionary of their fingerprints. They are only read again when the
+    store changes."""
+    global _views
+    syncStore()
+    version = store.version()
+    if _views[0] != version:
+        # The version is read before the links, so that if a sync changes
+        # them in between the fingerprints are kept under the older version
+        # and never used.
+        views = store.views(VIEWS)
+        fingerprints = dict([(name, fingerprint(name, links))
+                             for name, links in views.items()])
+        _views = (version, views, fingerprints)
+        store.setState(FINGERPRINTS_STATE, json.dumps(
+            {'version': version, 'context': fingerprintsContext(),
+             'fingerprints': fingerprints}))
+    return _views[1], _views[2]
+
+def getFingerprints():
+    """Return the fingerprints of the views, as getViews() does, but without
+    reading the links if they are known for this version of the store,
+    by this process or another one."""
+    syncStore()
+    version = store.version()
+    if _views[0] == version:
+        return _views[2]
+    saved = store.getState(FINGERPRINTS_STATE)
+    if saved is not None:
+        saved = json.loads(saved)
+        if saved['version'] == version and \
+           saved['context'] == fingerprintsContext():
+            return saved['fingerprints']
+    return getViews()[1]
+
+def getLinks(view):
+    """Return all the links in the named view as a list of SimpyLink
+    objects."""
+    return [SimpyLink(link) for link in getViews()[0][view]]
 
 def getUnread():
     """Return all the links from simpy that have the tag 'read later' but do
     not have the tag 'have read'."""
-    return getLinks(UNREAD_QUERY)
+    return getLinks('unread')
 
 def getStarred():
     """Return all the links from simpy that have either the 'read later' or
     'have read' (or both) _and_ the starred tag."""
-    return getLinks(STARRED_QUERY)
+    return getLinks('starred')
 
 def getRead():
     """Return all the links from simpy that have the 'have read' tag."""
-    return getLinks(READ_QUERY)
+    return getLinks('read')
     
 # The web.py stuff
 # ================
@@ -96,31 +287,198 @@ def getRead():
 global_opts = {'title':config.title,'base_url':config.base_url,'user':config.simpy_user, 'unread_query':UNREAD_QUERY,'starred_query':STARRED_QUERY,'read_query':READ_QUERY}
 render = web.template.render('templates/', base='base', globals=global_opts)
 
+# The same templates without base.html wrapped around them, for pages that
+# are sent in pieces.
+render_parts = web.template.render('templates/', globals=global_opts)
+
 # Specify URLs to web.py.
 urls = (
   '/?', 'UnreadPage',
   '/starred', 'StarredPage',
   '/read', 'ReadPage',
+  '/view/(.*)', 'ViewPage',
   '/link/(.*)', 'LinkPage',
-  '/about', 'AboutPage'
+  '/search', 'SearchPage',
+  '/tags', 'TagsPage',
+  '/tags/complete', 'TagCompletePage',
+  '/refresh', 'RefreshPage',
+  '/about', 'AboutPage',
+  '/stats', 'StatsPage',
+  '/preview', 'PreviewPage'
 )
 app = web.application(urls,globals())
 
+# Everything the templates could show, so that a change to them changes the
+# fingerprint of every page.
+TEMPLATES_VERSION = contentKey(repr(sorted(global_opts.items())),
+    *[open(os.path.join('templates', name)).read()
+      for name in sorted(os.listdir('templates')) if name.endswith('.html')])
+
+# Whole listing pages, keyed by the fingerprint of the view they show.
+page_cache = TieredCache(LRUCache(config.page_cache_size),
+                         DiskCache(os.path.join(config.cache_dir, 'pages'),
+                                   config.page_disk_cache_size))
+# How the requests for pages have been answered, counted in memory since the
+# process started. They are only worth looking at in a server that keeps
+# running: under CGI every request starts from nothing. They aren't kept in
+# the store, since that would add a write to the database to every page
+# view, 304s included.
+page_cache_stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+page_cache_stats_lock = threading.Lock()
+
+def countPage(outcome):
+    """Count one request for a page in page_cache_stats."""
+    page_cache_stats_lock.acquire()
+    try:
+        page_cache_stats[outcome] += 1
+    finally:
+        page_cache_stats_lock.release()
+
+# How many links to render into each piece of a streamed page.
+STREAM_CHUNK = 50
+
+def streamPage(links, template, etag):
+    """Render the page listing `links` with `template`, one of the listing
+    templates in render_parts, as a series of utf-8 chunks: the top of the
+    page, the links STREAM_CHUNK at a time, and then the bottom. The first
+    chunk is ready before any link has been rendered. Once the whole page has
+    been sent it is added to the page cache under `etag`, which must be the
+    fingerprint of these same links.
+
+    A listing template must be a loop over its links, so that rendering it
+    with some of the links gives that part of the page."""
+    # Whatever the template puts before its first link, and its title etc.
+    content = template([])
+    prefix = unicode(content)
+    marker = u'\0links\0'
+    content['__body__'] = prefix + marker
+    head, foot = unicode(render_parts.base(content)).split(marker)
+    page = [head]
+    yield web.safestr(head)
+    for i in range(0, len(links), STREAM_CHUNK):
+        chunk = [SimpyLink(link) for link in links[i:i + STREAM_CHUNK]]
+        html = unicode(template(chunk))[len(prefix):]
+        page.append(html)
+        yield web.safestr(html)
+    page.append(foot)
+    yield web.safestr(foot)
+    page_cache.set(etag, u''.join(page))
+
+def cachedPage(view, template):
+    """Return the page for the named view rendered with `template`, from the
+    page cache if the view hasn't changed since it was last rendered, or else
+    streamed as it is rendered.
+
+    The fingerprint of the view is sent as the ETag, and if the browser
+    already has this version of the page it gets a 304 and no body. Neither
+    that nor a page from the cache needs the links to be read."""
+    etag = getFingerprints()[view]
+    web.header('Content-Type', 'text/html; charset=utf-8')
+    if not web.http.modified(etag=etag):
+        countPage('not_modified')
+        web.header('ETag', '"%s"' % etag)
+        return ''
+    html = page_cache.get(etag)
+    if html is None:
+        countPage('misses')
+        # The links and their fingerprint have to come from the same
+        # version of the views, or a page could be cached under the wrong
+        # etag.
+        views, fingerprints = getViews()
+        etag = fingerprints[view]
+        web.header('ETag', '"%s"' % etag)
+        web.header('X-Cache', 'MISS')
+        return streamPage(views[view], template, etag)
+    countPage('hits')
+    web.header('ETag', '"%s"' % etag)
+    web.header('X-Cache', 'HIT')
+    return html
+
 class UnreadPage:
     """Shows all the unread links."""
     def GET(self):
-        return render.unread(getUnread())
+        return cachedPage('unread', render_parts.unread)
 
 class ReadPage:
     """Shows all the read links."""
     def GET(self):
-        return render.read(getRead())
+        return cachedPage('read', render_parts.read)
 
 class StarredPage:
     """Shows all the starred links (read or unread)."""
     def GET(self):
-        return render.starred(getStarred())
+        return cachedPage('starred', render_parts.starred)
     
+class ViewPage:
+    """Shows the links in one of the views set up in config.views."""
+    def GET(self, name):
+        if name not in config.views:
+            return web.notfound()
+        return cachedPage(name, lambda links: render_parts.view(links, name))
+
+class LinkPage:
+    """Shows one link with the whole of its note. The link is found by its
+    id, or the id of its permalink (see store.linkId and store.permalinkId),
+    without reading the rest of the account.
+
+    The ETag changes with the link, the templates and markdown, and if the
+    browser already has this version of the page it gets a 304."""
+    def GET(self, id):
+        syncStore()
+        link = store.link(id)
+        if link is None:
+            return web.notfound()
+        etag = contentKey(link.id, link.modDateStr, TEMPLATES_VERSION,
+                          RENDERER_VERSION)
+        web.header('Content-Type', 'text/html; charset=utf-8')
+        web.header('ETag', '"%s"' % etag)
+        if not web.http.modified(etag=etag):
+            return ''
+        return render.link(SimpyLink(link), renderNote(link.note))
+
+class SearchPage:
+    """Shows the links that match the simpy query in the `q` parameter, best
+    matches first, searching the local copy of the whole account."""
+    def GET(self):
+        query = web.input(q='').q
+        syncStore()
+        links = [SimpyLink(link)
+                 for link in store.search(query, SEARCH_RESULTS)]
+        return render.search(links, query)
+
+class TagsPage:
+    """Shows every tag in the account and how many links have it, most used
+    first, each linked to a search for it. They are counted in the local
+    copy of the whole account, without asking simpy."""
+    def GET(self):
+        syncStore()
+        tags = [(item['tag'], item['count'],
+                 'index.cgi/search?' + urllib.urlencode(
+                     {'q': web.safestr(u'tags:"%s"' % item['tag'])}))
+                for item in store.tagCounts()]
+        return render.tags(tags)
+
+class TagCompletePage:
+    """Suggests tags that begin with the `q` parameter, most used first, as
+    a JSON list of objects with the "tag" and its "count". They are found
+    in the local copy of the whole account as it is, without syncing it
+    first, so that they can be suggested as fast as a tag is typed."""
+    def GET(self):
+        prefix = web.input(q='').q
+        web.header('Content-Type', 'application/json; charset=utf-8')
+        return json.dumps(store.completeTag(prefix, TAG_COMPLETIONS))
+
+class RefreshPage:
+    """Downloads the whole account from simpy again, so that links that
+    were changed or deleted there since the last full sync show straight
+    away, and goes back to the page the request came from."""
+    def POST(self):
+        syncStore(full=True)
+        referer = web.ctx.env.get('HTTP_REFERER', '')
+        if not referer.startswith(config.base_url):
+            referer = '/'
+        raise web.seeother(referer)
+
 class AboutPage:
     """Page that shows the site's about text."""
     def GET(self):
@@ -128,6 +486,33 @@ class AboutPage:
         html = markdown(text)
         return render.about(html)
 
-if __name__ == "__main__":
+class StatsPage:
+    """Shows how well the page cache is doing, as plain text, in the process
+    serving the request (see page_cache_stats)."""
+    def GET(self):
+        web.header('Content-Type', 'text/plain')
+        heading = 'Pages served by process %d since it started\n' % os.getpid()
+        return heading + ''.join(['%s: %d\n' % item
+                                  for item in sorted(page_cache_stats.items())])
+
+class PreviewPage:
+    """Renders the markdown in the `text` parameter, for previewing a note
+    while it is being written. It only takes a POST, so that a link can't
+    make it render something, and shows raw html escaped."""
+    def POST(self):
+        text = web.input(text='').text
+        web.header('Content-Type', 'text/html; charset=utf-8')
+        return preview_pool.convert(text)
+
+# "index.cgi sync" downloads the whole account, to catch the links that were
+# changed or deleted on simpy without holding up a page view; run it every
+# few minutes, from cron for example:
+#     */5 * * * * cd /path/to/read_later && python index.cgi sync
+if __name__ == "__main__" and sys.argv[1:] == ['sync']:
+    store.sync(simpy, full=True)
+elif __name__ == "__main__":
     web.config.debug = True
+    # Under CGI every request is a process of its own.
+    if not os.environ.has_key('SERVER_SOFTWARE'):
+        startRenderProcesses()
     app.run()
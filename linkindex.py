@@ -0,0 +1,165 @@
+"""What the indexes a LinkStore keeps in its database have in common: the
+state they keep in the store's sync_state table, the arrays of ids they pack
+into blobs, and the way they are brought up to date with the links.
+
+An index gives each link it indexes an ordinal, in a table of its own with
+the ids of the keys the link is indexed under, and keeps a row for each key
+with a blob of the links that have it: the terms and their postings of a
+search.SearchIndex, the tags and their bitmaps of a tagindex.TagIndex.
+"""
+import array
+
+# How many values to put in one SQL IN (...), which SQLite limits.
+SQL_BATCH = 500
+
+def getState(db, key, default=None):
+    """Return the value kept under `key` in the store's sync_state table, or
+    `default` if there is none."""
+    row = db.execute('SELECT value FROM sync_state WHERE key = ?',
+                     (key,)).fetchone()
+    if row is None:
+        return default
+    return row[0]
+
+def setState(db, key, value):
+    """Keep `value` under `key` in the store's sync_state table."""
+    db.execute('INSERT OR REPLACE INTO sync_state (key, value) '
+               'VALUES (?, ?)', (key, unicode(value)))
+
+# Lists of ids, and of ordinals, are stored as arrays.
+def encodeIds(ids):
+    return buffer(array.array('I', ids).tostring())
+
+def decodeIds(blob):
+    ids = array.array('I')
+    ids.fromstring(str(blob))
+    return ids
+
+class LinkIndex:
+    """The base of the indexes. A subclass names its tables and columns,
+    says which keys a link is indexed under, and how a key's blob changes
+    when some of its links do; update() does the rest."""
+
+    # The table of the indexed links, and its column of their key ids.
+    docs_table = docs_column = None
+    # The table of the keys, its column of their names and the columns
+    # update() writes, the first of which holds the key's links, with their
+    # values for a key that has none yet.
+    keys_table = key_column = None
+    value_columns = ()
+    empty_values = ()
+    # The columns of the links table that _linkKeys() needs, and the one
+    # that is cleared when a link is written.
+    link_columns = '*'
+    dirty_column = None
+    # The sync_state key counting the times the index has changed, which
+    # what has been read from it is cached by.
+    generation_key = None
+    # A key every link is indexed under, without being kept with its keys.
+    all_key = None
+
+    def _state(self, db, key):
+        return int(getState(db, key, 0))
+
+    def generation(self, db):
+        return self._state(db, self.generation_key)
+
+    def _linkKeys(self, row, rowToLink):
+        """Return a dictionary of the keys a row of the links table is
+        indexed under, and the value it has under each."""
+        raise NotImplementedError
+
+    def _merge(self, blob, changed):
+        """Return the values of `value_columns` for a key whose links were
+        `blob`, with those in `changed` set to their new values or, if
+        those are None, taken out; or None if it has no links left."""
+        raise NotImplementedError
+
+    def _updated(self, db):
+        """Called once an update has changed the index."""
+        setState(db, self.generation_key, self.generation(db) + 1)
+
+    def update(self, db, rowToLink=None):
+        """Index the links that have been written since they were last
+        indexed, which have their dirty column cleared, and take the
+        removed ones out. Returns how many links were indexed or
+        removed."""
+        changes = {} # key id -> {ordinal: value, or None to remove it}
+        key_ids = {}
+        def keyId(key):
+            key_id = key_ids.get(key)
+            if key_id is None:
+                row = db.execute('SELECT id FROM %s WHERE %s = ?'
+                                 % (self.keys_table, self.key_column),
+                                 (key,)).fetchone()
+                if row is None:
+                    key_id = db.execute(
+                        'INSERT INTO %s (%s, %s) VALUES (?%s)'
+                        % (self.keys_table, self.key_column,
+                           ', '.join(self.value_columns),
+                           ', ?' * len(self.value_columns)),
+                        (key,) + tuple(self.empty_values)).lastrowid
+                else:
+                    key_id = row[0]
+                key_ids[key] = key_id
+            return key_id
+        def change(ordinal, ids, values=None):
+            # Without `values` the link is taken out of the keys.
+            for key_id in ids:
+                changes.setdefault(key_id, {})[ordinal] = \
+                    values is not None and values[key_id] or None
+            if self.all_key is not None:
+                changes.setdefault(keyId(self.all_key), {})[ordinal] = \
+                    values is not None or None
+
+        removed = db.execute('SELECT ordinal, %s FROM %s WHERE id NOT IN '
+                             '(SELECT id FROM links)'
+                             % (self.docs_column, self.docs_table)).fetchall()
+        for ordinal, keys in removed:
+            change(ordinal, decodeIds(keys))
+        db.executemany('DELETE FROM %s WHERE ordinal = ?' % self.docs_table,
+                       [(row[0],) for row in removed])
+
+        rows = db.execute('SELECT %s FROM links WHERE %s = 0'
+                          % (self.link_columns, self.dirty_column)).fetchall()
+        for row in rows:
+            values = dict([(keyId(key), value) for key, value
+                           in self._linkKeys(row, rowToLink).items()])
+            old = db.execute('SELECT ordinal, %s FROM %s WHERE id = ?'
+                             % (self.docs_column, self.docs_table),
+                             (row['id'],)).fetchone()
+            if old is None:
+                ordinal = db.execute('INSERT INTO %s (id, %s) VALUES (?, ?)'
+                                     % (self.docs_table, self.docs_column),
+                                     (row['id'], encodeIds(values))
+                                     ).lastrowid
+            else:
+                ordinal = old[0]
+                change(ordinal, decodeIds(old[1]))
+                db.execute('UPDATE %s SET %s = ? WHERE ordinal = ?'
+                           % (self.docs_table, self.docs_column),
+                           (encodeIds(values), ordinal))
+            change(ordinal, values, values)
+        db.execute('UPDATE links SET %s = 1 WHERE %s = 0'
+                   % (self.dirty_column, self.dirty_column))
+
+        # Each key's links are read and written once, however many of them
+        # changed.
+        for key_id, changed in changes.items():
+            blob = db.execute('SELECT %s FROM %s WHERE id = ?'
+                              % (self.value_columns[0], self.keys_table),
+                              (key_id,)).fetchone()[0]
+            values = self._merge(blob, changed)
+            if values is None:
+                db.execute('DELETE FROM %s WHERE id = ?' % self.keys_table,
+                           (key_id,))
+            else:
+                db.execute('UPDATE %s SET %s WHERE id = ?'
+                           % (self.keys_table,
+                              ', '.join(['%s = ?' % column for column
+                                         in self.value_columns])),
+                           tuple(values) + (key_id,))
+
+        if removed or rows:
+            self._updated(db)
+        return len(removed) + len(rows)
@@ -0,0 +1,947 @@
+#!/usr/bin/env python
+"""
+Benchmarks for markdown.py, run on generated notes like the ones kept in a
+simpy account.
+
+Usage:
+    python benchmark.py parallel [notes] [processes]
+        Converts the notes with convert_many() on pools of 1 up to
+        `processes` processes (by default one per core) and reports the
+        throughput and speed-up of each, against converting them one after
+        another in this process.
+
+    python benchmark.py inline [notes] [repeat]
+        Checks that the inline patterns give exactly the same output as the
+        original pattern by pattern engine, on generated notes and on random
+        strings of markup characters, then compares the speed of the two on
+        long notes.
+
+    python benchmark.py serialize [paragraphs] [repeat]
+        Checks that the NanoDom serializer gives the same output as the
+        original recursive one, then compares the time and the peak memory
+        of the two on one large document.
+
+    python benchmark.py memory [notes]
+        Converts the notes, keeping the NanoDom tree of each, and reports
+        the conversion rate and the memory held by the nodes per note.
+
+    python benchmark.py preview [sections] [keystrokes]
+        Types into a long note a character at a time, converting it after
+        every keystroke with IncrementalMarkdown and with Markdown, checks
+        that they agree, and compares the time per keystroke.
+
+    python benchmark.py htmlblocks [kb] [notes] [repeat]
+        Checks that the HTML block preprocessor gives exactly the same
+        output as the original on random tag soup and generated notes, then
+        compares the two on notes of `kb` KB, half of them pasted HTML.
+
+    python benchmark.py construct [instances]
+        Checks that Markdown instances copied from the extension registry
+        convert like ones set up from scratch and share no state, then
+        compares the time it takes to make one each way, with and without
+        extensions.
+
+    python benchmark.py suite [docs] [repeat] [results.json]
+        Converts a corpus of `docs` generated notes of each kind: short,
+        long, heavy on inline markup, nested lists, HTML blocks and
+        footnotes (with mdx_footnotes). Reports docs/sec, the peak memory
+        and the time spent in each phase of the conversion for each kind,
+        and saves the results to results.json if given.
+
+    python benchmark.py compare before.json after.json
+        Shows the results saved by two suite runs side by side.
+"""
+
+import sys, os, time, random, resource, gc
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import markdown
+
+markdown.console_hndlr.setLevel(markdown.CRITICAL + 1) # no warnings
+
+WORDS = ["read", "later", "python", "simpy", "note", "link", "article",
+         "about", "the", "web", "and", "a", "with", "some", "more", "text"]
+
+
+def makeNote(rand, i):
+    """Returns a generated note of a few paragraphs with the usual inline
+    markup, a list and a reference."""
+    def sentence():
+        words = [rand.choice(WORDS) for j in range(rand.randint(6, 16))]
+        k = rand.randrange(len(words))
+        words[k] = rand.choice(["*%s*", "**%s**", "`%s`", "[%s][r]",
+                                "[%s](http://example.com/)"]) % words[k]
+        return " ".join(words).capitalize() + "."
+    paragraphs = [" ".join([sentence() for j in range(rand.randint(1, 4))])
+                  for k in range(rand.randint(1, 3))]
+    paragraphs.append("\n".join(["* " + sentence()
+                                 for j in range(rand.randint(0, 4))]))
+    paragraphs.append("[r]: http://example.com/%d \"Note %d\"" % (i, i))
+    return u"\n\n".join(paragraphs)
+
+
+def makeNotes(n, seed=0):
+    rand = random.Random(seed)
+    return [makeNote(rand, i) for i in range(n)]
+
+
+def benchParallel(notes=2000, processes=None):
+    if markdown.multiprocessing is None:
+        print "multiprocessing is not available"
+        return
+    cores = markdown.multiprocessing.cpu_count()
+    if processes is None:
+        processes = cores
+    sources = makeNotes(notes)
+
+    md = markdown.Markdown()
+    start = time.time()
+    expected = []
+    for source in sources:
+        md.reset()
+        expected.append(md.convert(source))
+    serial = time.time() - start
+    print "%d notes, %d cores" % (notes, cores)
+    print "%-12s %8.1f notes/sec" % ("serial", notes / serial)
+
+    for n in range(1, processes + 1):
+        pool = markdown.convertPool(n)
+        try:
+            # Time a warm pool, as the app keeps its pool between pages.
+            markdown.convert_many(sources[:n], pool=pool)
+            start = time.time()
+            html = markdown.convert_many(sources, pool=pool)
+            seconds = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+        assert html == expected, "convert_many output differs"
+        print "%-12s %8.1f notes/sec %5.2fx" % \
+            ("%d processes" % n, notes / seconds, serial / seconds)
+
+
+def legacyToxml(node):
+    """Serializes a NanoDom node the way the original toxml() methods did,
+    concatenating strings recursively and normalizing entities with a
+    regular expression pass per entity."""
+    doc = getattr(node, "doc", None)
+    if isinstance(node, markdown.TextNode):
+        text = node.value
+        node.parent.setBidi(markdown.getBidiType(text))
+        if not text.startswith(markdown.HTML_PLACEHOLDER_PREFIX):
+            if node.parent.nodeName == "p":
+                text = text.replace("\n", "\n   ")
+            elif (node.parent.nodeName == "li"
+                  and node.parent.childNodes[0]==node):
+                text = "\n     " + text.replace("\n", "\n     ")
+        return legacyNormalize(text, markdown.ENTITY_NORMALIZATION_EXPRESSIONS)
+    if not isinstance(node, markdown.Element):
+        return node.toxml()
+    if markdown.ENABLE_ATTRIBUTES:
+        for child in node.childNodes:
+            child.handleAttributes()
+    buffer = ""
+    if node.nodeName in ['h1', 'h2', 'h3', 'h4']:
+        buffer += "\n"
+    elif node.nodeName in ['li']:
+        buffer += "\n "
+    childBuffer = ""
+    if node.childNodes or node.nodeName in ['blockquote']:
+        childBuffer += ">"
+        for child in node.childNodes:
+            childBuffer += legacyToxml(child)
+        if node.nodeName == 'p':
+            childBuffer += "\n"
+        elif node.nodeName == 'li':
+            childBuffer += "\n "
+        childBuffer += "</%s>" % node.nodeName
+    else:
+        childBuffer += "/>"
+    buffer += "<" + node.nodeName
+    if node.nodeName in ['p', 'li', 'ul', 'ol',
+                         'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+        if not node.attribute_values.has_key("dir"):
+            bidi = node.bidi or doc.bidi
+            if bidi == "rtl":
+                node.setAttribute("dir", "rtl")
+    for attr in node.attributes:
+        value = legacyNormalize(node.attribute_values[attr],
+                                markdown.ENTITY_NORMALIZATION_EXPRESSIONS_SOFT)
+        buffer += ' %s="%s"' % (attr, value)
+    buffer += childBuffer
+    if node.nodeName in ['p', 'br ', 'li', 'ul', 'ol',
+                         'h1', 'h2', 'h3', 'h4']:
+        buffer += "\n"
+    return buffer
+
+
+def legacyNormalize(text, regexps):
+    for regexp, substitution in regexps:
+        text = regexp.sub(substitution, text)
+    return text
+
+
+def legacyDocumentToxml(doc):
+    """Returns a replacement for doc.toxml() that uses legacyToxml() and
+    strips the top level tag by slicing it off."""
+    def toxml(withDocumentElement=True):
+        xml = legacyToxml(doc.documentElement)
+        if not withDocumentElement:
+            xml = xml.strip()[23:-7]
+        return xml
+    return toxml
+
+
+class LegacyMarkdown(markdown.Markdown):
+    """Markdown with the original inline engine and serializer, for checking
+    that the current ones give the same output. Each pattern is matched
+    against every string with its "^(.*)PATTERN(.*)$" regular expression,
+    and the results are spliced back into the list of parts one at a time."""
+
+    def _transform(self):
+        doc = markdown.Markdown._transform(self)
+        doc.toxml = legacyDocumentToxml(doc)
+        return doc
+
+    def _handleInline(self, line, patternIndex=0):
+        parts = [line]
+        while patternIndex < len(self.inlinePatterns):
+            i = 0
+            while i < len(parts):
+                x = parts[i]
+                if isinstance(x, (str, unicode)):
+                    result = self._applyPattern(x,
+                                self.inlinePatterns[patternIndex],
+                                patternIndex)
+                    if result:
+                        i -= 1
+                        parts.remove(x)
+                        for y in result:
+                            parts.insert(i+1, y)
+                i += 1
+            patternIndex += 1
+        for i in range(len(parts)):
+            x = parts[i]
+            if isinstance(x, (str, unicode)):
+                parts[i] = self.doc.createTextNode(x)
+        return parts
+
+    def _matchPattern(self, line, pattern):
+        return pattern.getCompiledRegExp().match(line)
+
+
+MARKUP = ["*", "**", "_", "__", "`", "[", "]", "(", ")", "!", "<", ">",
+          "&", ";", "\\", "  \n", " ", "a", "b", "http://x.y/", "@", "#", "- ", "1. "]
+
+
+def makeMarkupSoup(rand):
+    """Returns a short random string of markdown punctuation, to find the
+    corner cases where two inline engines could disagree."""
+    return u"".join([rand.choice(MARKUP)
+                     for i in range(rand.randint(1, 30))]) + u"\n\n[a]: /a"
+
+
+def makeLongNote(rand, i):
+    """Returns a note of some fifty paragraphs of inline markup."""
+    return u"\n\n".join([makeNote(rand, i) for j in range(10)])
+
+
+def convertOrFail(md, source):
+    """Returns what md.convert() gives for source, or the exception it
+    raises."""
+    md.reset()
+    try:
+        return md.convert(source)
+    except Exception, e:
+        return repr(e)
+
+
+def benchInline(notes=200, repeat=3):
+    rand = random.Random(0)
+    cases = makeNotes(notes) + [makeMarkupSoup(rand) for i in range(5000)]
+    cases.append(u"Escaped \\*stars\\*, <b>html</b> &amp; &copy; <me@x.y> "
+                 u"<http://x.y/> ![img](/i.png \"t\") ![ref][r] [a][] "
+                 u"***both*** ___both___ __strong__ _em_ snake_case_name "
+                 u"``code `with` ticks`` *a*b* **a**b** line  \nbreak  ")
+    new, old = markdown.Markdown(), LegacyMarkdown()
+    for case in cases:
+        if convertOrFail(new, case) != convertOrFail(old, case):
+            print "outputs differ for %r" % case
+            sys.exit(1)
+    print "%d documents converted identically" % len(cases)
+
+    long_notes = [makeLongNote(rand, i) for i in range(notes // 10)]
+    size = sum([len(note) for note in long_notes]) / 1024.0
+    for name, md in (("original engine", old), ("current engine", new)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            for note in long_notes:
+                md.reset()
+                md.convert(note)
+            seconds = time.time() - start
+            if best is None or seconds < best: best = seconds
+        print "%-16s %6.1f notes/sec %7.1f KB/sec" % \
+            (name, len(long_notes) / best, size / best)
+
+
+def peakMemory(fn):
+    """Runs fn in a child process and returns how far its peak resident
+    size rose above what it started with, in KB."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, str(after - before))
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return int(result)
+
+
+def benchSerialize(paragraphs=20000, repeat=3):
+    rand = random.Random(0)
+    # A heading per note, so that the lists don't nest ever deeper.
+    source = u"\n\n".join([u"# Note %d\n\n%s" % (i, makeNote(rand, i))
+                            for i in range(paragraphs // 5)])
+
+    for legacy in (False, True):
+        md = markdown.Markdown()
+        md.source = source
+        for pp in md.textPreprocessors:
+            md.source = pp.run(md.source)
+        doc = md._transform()
+        if legacy:
+            expected = legacyDocumentToxml(doc)(withDocumentElement=False)
+        else:
+            html = doc.toxml(withDocumentElement=False)
+    if html != expected:
+        print "serializer output differs"
+        sys.exit(1)
+    print "%.1f KB of markdown, %.1f KB of html, serialized identically" % \
+        (len(source) / 1024.0, len(html) / 1024.0)
+
+    # toxml() adds dir attributes and runs the {@attribute} handling, so
+    # serializing the same tree again is the same amount of work.
+    for name, toxml in (("original serializer", legacyDocumentToxml(doc)),
+                        ("current serializer", doc.toxml)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            toxml(withDocumentElement=False)
+            seconds = time.time() - start
+            if best is None or seconds < best: best = seconds
+        peak = peakMemory(lambda: toxml(withDocumentElement=False))
+        print "%-20s %7.3f sec %8.1f KB/sec %8d KB peak" % \
+            (name, best, len(html) / 1024.0 / best, peak)
+
+
+def nodeSize(node, seen):
+    """Returns the bytes held by a NanoDom node and its descendants: the
+    node, its __dict__ or slots, and the lists, dicts and strings they hold.
+    The document and anything in `seen` is not counted."""
+    if id(node) in seen or isinstance(node, markdown.Document):
+        return 0
+    seen[id(node)] = node
+    size = sys.getsizeof(node)
+    if hasattr(node, "__dict__"):
+        size += sys.getsizeof(node.__dict__)
+        values = node.__dict__.values()
+    else:
+        values = [getattr(node, name) for name in type(node).__slots__
+                  if hasattr(node, name)]
+    for value in values:
+        if isinstance(value, (markdown.Element, markdown.TextNode,
+                              markdown.EntityReference, markdown.CDATA)):
+            size += nodeSize(value, seen)
+        elif isinstance(value, (list, dict, str, unicode)) \
+                and id(value) not in seen:
+            seen[id(value)] = value
+            size += sys.getsizeof(value)
+            if isinstance(value, dict):
+                value = value.values()
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, (str, unicode)):
+                        if id(item) not in seen:
+                            seen[id(item)] = item
+                            size += sys.getsizeof(item)
+                    else:
+                        size += nodeSize(item, seen)
+    return size
+
+
+def benchMemory(notes=2000):
+    sources = makeNotes(notes)
+    md = markdown.Markdown()
+    docs = []
+    start = time.time()
+    for source in sources:
+        md.reset()
+        md.convert(source)
+        docs.append(md.doc)
+    seconds = time.time() - start
+    seen = {}
+    size = sum([nodeSize(doc.documentElement, seen) for doc in docs])
+    print "%d notes, %.1f notes/sec, %.0f bytes of nodes per note" % \
+        (notes, notes / seconds, size / float(notes))
+
+
+def benchPreview(sections=20, keystrokes=300):
+    rand = random.Random(0)
+    new, old = markdown.IncrementalMarkdown(), markdown.Markdown()
+
+    # First check that whole documents come out the same, including right
+    # to left text and random markup split into sections by '#'.
+    cases = makeNotes(200) + [makeMarkupSoup(rand) for i in range(3000)]
+    cases += [u"# %s\n\n\u05e9\u05dc\u05d5\u05dd %s" % (case, case)
+              for case in makeNotes(50)]
+    for case in cases:
+        if convertOrFail(new, case) != convertOrFail(old, case):
+            print "outputs differ for %r" % case
+            sys.exit(1)
+    print "%d documents converted identically" % len(cases)
+
+    note = u"\n\n".join([u"# Section %d\n\n%s" % (i, makeNote(rand, i))
+                          for i in range(sections)])
+    text = u"Here is what I'm typing: "
+    at = len(note) // 2
+    at = note.index(u"\n\n", at) # the end of a paragraph in the middle
+    timings = {'incremental': 0.0, 'full': 0.0}
+    for i in range(keystrokes):
+        typed = note[:at] + text[:i % len(text)] + note[at:]
+        start = time.time()
+        html = convertOrFail(new, typed)
+        timings['incremental'] += time.time() - start
+        start = time.time()
+        expected = convertOrFail(old, typed)
+        timings['full'] += time.time() - start
+        if html != expected:
+            print "outputs differ after %d keystrokes" % i
+            sys.exit(1)
+    print "%d keystrokes into a %.1f KB note of %d sections" % \
+        (keystrokes, len(note) / 1024.0, sections)
+    for name in ('full', 'incremental'):
+        print "%-12s %7.2f ms/keystroke" % \
+            (name, 1000 * timings[name] / keystrokes)
+
+
+def makeSentence(rand, words):
+    return " ".join([rand.choice(WORDS)
+                     for j in range(words)]).capitalize() + "."
+
+
+def makeInlineNote(rand, i):
+    """Returns a note where nearly every word has inline markup."""
+    forms = ["*%s*", "**%s**", "_%s_", "__%s__", "`%s`", "[%s][r]",
+             "[%s](http://example.com/%s)", "![%s](/img/%s.png)",
+             "<http://example.com/%s>", "%s &amp; %s", "\\*%s\\*",
+             "<b>%s</b>", "%s&copy;"]
+    def word():
+        form = rand.choice(forms)
+        w = rand.choice(WORDS)
+        return form % ((w,) * form.count("%s"))
+    paragraphs = [" ".join([word() for j in range(rand.randint(20, 60))])
+                  for k in range(rand.randint(2, 5))]
+    paragraphs.append("[r]: http://example.com/%d \"Note %d\"" % (i, i))
+    return u"\n\n".join(paragraphs)
+
+
+def makeListNote(rand, i):
+    """Returns a note of lists nested up to three deep, tight and loose,
+    with a code block in some of the items."""
+    lines = [makeSentence(rand, 8), ""]
+    for k in range(rand.randint(3, 10)):
+        depth = rand.randint(0, 2)
+        marker = rand.choice(["* ", "- ", "%d. " % (k + 1)])
+        lines.append("    " * depth + marker + makeSentence(rand, 10))
+        if rand.random() < 0.3:
+            lines += ["", "    " * (depth + 1) + makeSentence(rand, 12), ""]
+        if rand.random() < 0.1:
+            lines += ["", "    " * (depth + 2) + "print 'note %d'" % i, ""]
+    return u"\n".join(lines)
+
+
+def makeHtmlNote(rand, i):
+    """Returns a note mixing paragraphs with raw HTML blocks."""
+    blocks = []
+    for k in range(rand.randint(2, 6)):
+        blocks.append(makeSentence(rand, 14))
+        blocks.append(rand.choice([
+            "<div class=\"quote\">\n<p>%s</p>\n</div>" % makeSentence(rand, 20),
+            "<table>\n<tr><td>%s</td><td>%d</td></tr>\n</table>"
+                % (makeSentence(rand, 4), k),
+            "<!-- %s -->" % makeSentence(rand, 6),
+            "<p>\n<a href=\"http://example.com/%d\">%s</a>\n</p>"
+                % (i, makeSentence(rand, 5))]))
+    return u"\n\n".join(blocks)
+
+
+def makeFootnoteNote(rand, i):
+    """Returns a note citing a few footnotes, for mdx_footnotes."""
+    notes = rand.randint(1, 4)
+    # Every footnote has to be cited, mdx_footnotes fails on one that isn't.
+    cites = range(1, notes + 1) + [rand.randint(1, notes)
+                                   for k in range(rand.randint(0, 6))]
+    rand.shuffle(cites)
+    paragraphs = []
+    while cites:
+        paragraphs.append(" ".join([makeSentence(rand, 12) + "[^%d]" % cite
+                                    for cite in cites[:3]]))
+        del cites[:3]
+    paragraphs += ["[^%d]: %s" % (k + 1, makeSentence(rand, 10))
+                   for k in range(notes)]
+    return u"\n\n".join(paragraphs)
+
+
+# The kinds of note in the corpus: how to make one and the extensions to
+# convert it with.
+CORPUS = [('short', lambda rand, i: makeSentence(rand, rand.randint(5, 20)),
+           []),
+          ('long', makeLongNote, []),
+          ('inline', makeInlineNote, []),
+          ('lists', makeListNote, []),
+          ('html', makeHtmlNote, []),
+          ('footnotes', makeFootnoteNote, ['footnotes'])]
+
+PHASES = ['preprocessors', 'transform', 'inline', 'serialization',
+          'postprocessors']
+
+
+def makeCorpus(docs, seed=0):
+    """Returns a list of (kind, extensions, notes) with docs notes of each
+    kind in CORPUS."""
+    rand = random.Random(seed)
+    return [(kind, extensions, [make(rand, i) for i in range(docs)])
+            for kind, make, extensions in CORPUS]
+
+
+class TimedProcessor:
+    """Stands in for a processor, adding the time it runs for to a phase."""
+
+    def __init__(self, processor, phase, times):
+        self.processor, self.phase, self.times = processor, phase, times
+
+    def run(self, arg):
+        start = time.time()
+        try:
+            return self.processor.run(arg)
+        finally:
+            self.times[self.phase] += time.time() - start
+
+
+class ProfiledMarkdown(markdown.Markdown):
+    """A Markdown that adds up the time spent in each of PHASES. The
+    transform phase is the block level parsing, what _transform() takes
+    besides the line preprocessors, the inline patterns and the NanoDom
+    postprocessors."""
+
+    def __init__(self, **kwargs):
+        markdown.Markdown.__init__(self, **kwargs)
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.depth = 0
+        for name, phase in [('textPreprocessors', 'preprocessors'),
+                            ('preprocessors', 'preprocessors'),
+                            ('postprocessors', 'postprocessors'),
+                            ('textPostprocessors', 'postprocessors')]:
+            setattr(self, name, [TimedProcessor(p, phase, self.times)
+                                 for p in getattr(self, name)])
+
+    def _transform(self):
+        before = self.times.copy()
+        start = time.time()
+        doc = markdown.Markdown._transform(self)
+        elapsed = time.time() - start
+        for phase in ('preprocessors', 'inline', 'postprocessors'):
+            elapsed -= self.times[phase] - before[phase]
+        self.times['transform'] += elapsed
+        self.doc = TimedDocument(doc, self.times)
+        return self.doc
+
+    def _handleInline(self, line, patternIndex=0):
+        # Only the outermost call counts, the patterns recurse into it.
+        if self.depth:
+            return markdown.Markdown._handleInline(self, line, patternIndex)
+        self.depth += 1
+        start = time.time()
+        try:
+            return markdown.Markdown._handleInline(self, line, patternIndex)
+        finally:
+            self.times['inline'] += time.time() - start
+            self.depth -= 1
+
+
+class TimedDocument:
+    """Wraps a Document to time its serialization."""
+
+    def __init__(self, doc, times):
+        self.doc, self.times = doc, times
+
+    def __getattr__(self, name):
+        return getattr(self.doc, name)
+
+    def toxml(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.doc.toxml(*args, **kwargs)
+        finally:
+            self.times['serialization'] += time.time() - start
+
+
+def benchSuite(docs=200, repeat=3, output=None):
+    corpus = makeCorpus(docs)
+    results = {'markdown': markdown.version,
+               'python': sys.version.split()[0],
+               'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+               'docs': docs, 'repeat': repeat, 'kinds': {}}
+    print "%-10s %8s %10s %8s  %s" % ("kind", "KB", "docs/sec", "peak KB",
+        "  ".join(["%14s" % ("%s ms" % phase[:10]) for phase in PHASES]))
+    for kind, extensions, notes in corpus:
+        md = markdown.Markdown(extensions=extensions)
+        def convertAll():
+            for note in notes:
+                md.reset()
+                md.convert(note)
+        best = None
+        for i in range(repeat):
+            gc.collect()
+            start = time.time()
+            convertAll()
+            seconds = time.time() - start
+            if best is None or seconds < best: best = seconds
+        peak = peakMemory(convertAll)
+
+        profiled = ProfiledMarkdown(extensions=extensions)
+        for note in notes:
+            profiled.reset()
+            profiled.convert(note)
+        phases = dict([(phase, 1000 * profiled.times[phase] / docs)
+                       for phase in PHASES])
+
+        size = sum([len(note.encode('utf-8')) for note in notes]) / 1024.0
+        results['kinds'][kind] = {'kb': size, 'docs_per_sec': docs / best,
+                                  'peak_kb': peak, 'phase_ms': phases}
+        print "%-10s %8.1f %10.1f %8d  %s" % (kind, size, docs / best, peak,
+            "  ".join(["%14.3f" % phases[phase] for phase in PHASES]))
+    print "(phase times are ms per doc with profiling on, so they add up " \
+          "to a little more than 1000 / docs/sec)"
+
+    if output:
+        f = open(output, 'w')
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        print "results saved to %s" % output
+
+
+def benchCompare(before, after):
+    results = []
+    for filename in (before, after):
+        f = open(filename)
+        try:
+            results.append(json.load(f))
+        finally:
+            f.close()
+    old, new = results
+    print "%s (markdown %s, %s) against %s (markdown %s, %s)" % \
+        (after, new['markdown'], new['date'],
+         before, old['markdown'], old['date'])
+    def change(o, n):
+        if not o:
+            return "      -"
+        return "%+6.1f%%" % (100.0 * (n - o) / o)
+    print "%-10s %17s %17s  %s" % ("kind", "docs/sec", "peak KB",
+        "  ".join(["%15s" % phase[:15] for phase in PHASES]))
+    for kind, make, extensions in CORPUS:
+        if kind not in old['kinds'] or kind not in new['kinds']:
+            continue
+        o, n = old['kinds'][kind], new['kinds'][kind]
+        print "%-10s %9.1f %s %9d %s  %s" % (kind,
+            n['docs_per_sec'], change(o['docs_per_sec'], n['docs_per_sec']),
+            n['peak_kb'], change(o['peak_kb'], n['peak_kb']),
+            "  ".join(["%7.3f %s" % (n['phase_ms'][phase],
+                                     change(o['phase_ms'][phase],
+                                            n['phase_ms'][phase]))
+                       for phase in PHASES]))
+
+
+class LegacyHtmlBlockPreprocessor(markdown.TextPreprocessor):
+    """The original HtmlBlockPreprocessor, which splits the text into
+    blocks and each block into words."""
+    
+    def _get_left_tag(self, block):
+        return block[1:].replace(">", " ", 1).split()[0].lower()
+
+
+    def _get_right_tag(self, left_tag, block):
+        return block.rstrip()[-len(left_tag)-2:-1].lower()
+
+    def _equal_tags(self, left_tag, right_tag):
+        
+        if left_tag == 'div' or left_tag[0] in ['?', '@', '%']: # handle PHP, etc.
+            return True
+        if ("/" + left_tag) == right_tag:
+            return True
+        if (right_tag == "--" and left_tag == "--"):
+            return True
+        elif left_tag == right_tag[1:] \
+            and right_tag[0] != "<":
+            return True
+        else:
+            return False
+
+    def _is_oneliner(self, tag):
+        return (tag in ['hr', 'hr/'])
+
+    
+    def run(self, text):
+
+        new_blocks = []
+        text = text.split("\n\n")
+        
+        items = []
+        left_tag = ''
+        right_tag = ''
+        in_tag = False # flag
+        
+        for block in text:
+            if block.startswith("\n"):
+                block = block[1:]
+
+            if not in_tag:
+
+                if block.startswith("<"):
+                    
+                    left_tag = self._get_left_tag(block)
+                    right_tag = self._get_right_tag(left_tag, block)
+
+                    if not (markdown.isBlockLevel(left_tag) \
+                        or block[1] in ["!", "?", "@", "%"]):
+                        new_blocks.append(block)
+                        continue
+
+                    if self._is_oneliner(left_tag):
+                        new_blocks.append(block.strip())
+                        continue
+                        
+                    if block[1] == "!":
+                        # is a comment block
+                        left_tag = "--"
+                        right_tag = self._get_right_tag(left_tag, block)
+                        # keep checking conditions below and maybe just append
+                        
+                    if block.rstrip().endswith(">") \
+                        and self._equal_tags(left_tag, right_tag):
+                        new_blocks.append(
+                            self.stash.store(block.strip()))
+                        continue
+                    else: #if not block[1] == "!":
+                        # if is block level tag and is not complete
+                        items.append(block.strip())
+                        in_tag = True
+                        continue
+
+                new_blocks.append(block)
+
+            else:
+                items.append(block.strip())
+                
+                right_tag = self._get_right_tag(left_tag, block)
+                
+                if self._equal_tags(left_tag, right_tag):
+                    # if find closing tag
+                    in_tag = False
+                    new_blocks.append(
+                        self.stash.store('\n\n'.join(items)))
+                    items = []
+
+        if items:
+            new_blocks.append(self.stash.store('\n\n'.join(items)))
+            new_blocks.append('\n')
+            
+        return "\n\n".join(new_blocks)
+
+
+HTML_SOUP = ["<div>", "</div>", "<p>", "</p>", "<table>", "</table>",
+             "<!--", "-->", "<?php", "?>", "<hr>", "<hr/>", "<span>",
+             "</span>", "<h1>", "<", ">", " ", "\t", "text", "\n", "\n\n",
+             "\n\n\n", "<div class='x'>", "<pre>", "</pre>", "<>", "< p"]
+
+
+def makeHtmlSoup(rand):
+    """Returns a random string of tags and blank lines, to find the corner
+    cases where two block scanners could disagree."""
+    return u"".join([rand.choice(HTML_SOUP)
+                     for i in range(rand.randint(1, 40))])
+
+
+def makePastedHtml(rand, i):
+    """Returns a fragment of a web page as it gets pasted into a note: a
+    table of links without blank lines, or quoted paragraphs with them."""
+    if rand.random() < 0.5:
+        rows = "\n".join(["<tr><td class=\"title\">%s</td><td><a href=\""
+                          "http://example.com/%d/%d\">%s</a></td></tr>"
+                          % (makeSentence(rand, 8), i, k,
+                             makeSentence(rand, 3))
+                          for k in range(rand.randint(5, 60))])
+        return "<div class=\"pasted\">\n<table>\n%s\n</table>\n</div>" % rows
+    return "<blockquote>\n%s\n</blockquote>" % "\n\n".join(
+        ["<p>%s</p>" % makeSentence(rand, 40)
+         for k in range(rand.randint(2, 8))])
+
+
+def makeHtmlLadenNote(rand, i, size):
+    """Returns a note of about size bytes, half notes and half pasted
+    HTML."""
+    parts, length = [], 0
+    while length < size:
+        for part in (makeNote(rand, i), makePastedHtml(rand, i)):
+            parts.append(part)
+            length += len(part) + 2
+    return u"\n\n".join(parts)
+
+
+def runHtmlBlocks(preprocessor, text):
+    """Returns the text preprocessor gives for text along with what it
+    stashed, or the exception it raises."""
+    preprocessor.stash = markdown.HtmlStash()
+    try:
+        return preprocessor.run(text), preprocessor.stash.rawHtmlBlocks
+    except Exception, e:
+        return repr(e)
+
+
+def benchHtmlBlocks(kb=100, notes=10, repeat=3):
+    rand = random.Random(0)
+    new, old = markdown.HtmlBlockPreprocessor(), LegacyHtmlBlockPreprocessor()
+
+    # The original fails on a block of a lone '<', which is now left as
+    # text, so only compare where it succeeds.
+    cases = [makeHtmlSoup(rand) for i in range(20000)]
+    cases += [makeHtmlLadenNote(rand, i, 2000) for i in range(200)]
+    compared = 0
+    for case in cases:
+        expected = runHtmlBlocks(old, case)
+        if isinstance(expected, str):
+            continue
+        if runHtmlBlocks(new, case) != expected:
+            print "outputs differ for %r" % case
+            sys.exit(1)
+        compared += 1
+    print "%d documents preprocessed identically" % compared
+
+    sources = [makeHtmlLadenNote(rand, i, kb * 1024) for i in range(notes)]
+    print "%d notes of %d KB, half pasted HTML" % (notes, kb)
+    for name, preprocessor in (('original', old), ('scanner', new)):
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            for source in sources:
+                runHtmlBlocks(preprocessor, source)
+            seconds = time.time() - start
+            if best is None or seconds < best: best = seconds
+        md = markdown.Markdown()
+        md.md_globals['HTML_BLOCK_PREPROCESSOR'] = preprocessor
+        md.textPreprocessors[0] = preprocessor
+        start = time.time()
+        for source in sources:
+            md.reset()
+            md.convert(source)
+        converting = time.time() - start
+        print "%-10s %8.2f ms/note preprocessing %8.1f ms/note converting" % \
+            (name, 1000 * best / notes, 1000 * converting / notes)
+
+
+class FreshMarkdown(markdown.Markdown):
+    """A Markdown that sets up its pipeline itself, as every instance did
+    before the extension registry."""
+
+    def __init__(self, extensions=[], extension_configs=None,
+                 safe_mode=False):
+        self.source = None
+        self.safeMode = safe_mode
+        self._buildPipeline(extensions, extension_configs)
+        self.reset()
+
+
+def seededConvert(md, source):
+    """Converts with the random footnote ids mdx_footnotes makes in reset()
+    always the same."""
+    random.seed(0)
+    return convertOrFail(md, source)
+
+
+def perInstanceObjects(md):
+    """Returns the objects in md that hold per-document state."""
+    objects = md.registeredExtensions + md.inlinePatterns + \
+        md.preprocessors + md.postprocessors + md.textPostprocessors
+    return [obj for obj in objects
+            if obj not in markdown.__dict__.values()]
+
+
+def benchConstruct(instances=10000):
+    rand = random.Random(0)
+    engines = [('plain', [], None),
+               ('footnotes', ['footnotes'], None),
+               ('rss', ['rss'], {'rss': [('TITLE', 'Notes')]}),
+               ('footnotes, rss', ['footnotes', 'rss'], None)]
+    sources = [makeFootnoteNote(rand, i) for i in range(100)]
+    sources += [makeNote(rand, i) for i in range(100)]
+
+    # Copies have to convert like freshly set up instances, and must not
+    # share any state, even when they take turns.
+    for name, extensions, configs in engines:
+        copies = [markdown.Markdown(extensions=extensions,
+                                    extension_configs=configs)
+                  for i in range(2)]
+        shared = [obj for obj in perInstanceObjects(copies[0])
+                  if obj in perInstanceObjects(copies[1])]
+        if shared:
+            print "%s copies share %r" % (name, shared)
+            sys.exit(1)
+        fresh = FreshMarkdown(extensions=extensions,
+                              extension_configs=configs)
+        for i, source in enumerate(sources):
+            if seededConvert(copies[i % 2], source) != \
+               seededConvert(fresh, source):
+                print "%s outputs differ for %r" % (name, source)
+                sys.exit(1)
+    print "%d documents converted identically by each engine" % len(sources)
+
+    for name, extensions, configs in engines:
+        timings = []
+        for markdownClass in (FreshMarkdown, markdown.Markdown):
+            start = time.time()
+            for i in range(instances):
+                markdownClass(extensions=extensions,
+                              extension_configs=configs)
+            timings.append(time.time() - start)
+        print "%-16s %7.1f usec to set up, %7.1f usec to copy" % \
+            (name, 1e6 * timings[0] / instances,
+             1e6 * timings[1] / instances)
+
+
+BENCHMARKS = {'parallel': benchParallel,
+              'inline': benchInline,
+              'serialize': benchSerialize,
+              'memory': benchMemory,
+              'preview': benchPreview,
+              'suite': benchSuite,
+              'htmlblocks': benchHtmlBlocks,
+              'construct': benchConstruct,
+              'compare': benchCompare}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print __doc__
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[arg.isdigit() and int(arg) or arg
+                              for arg in sys.argv[2:]])
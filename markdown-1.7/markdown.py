@@ -31,7 +31,16 @@ License: GPL 2 (http://www.gnu.org/copyleft/gpl.html) or BSD
 """
 
 
-import re, sys, codecs
+import re, sys, codecs, copy, types, threading, Queue
+import sre_parse, sre_constants
+try:
+    from hashlib import sha1
+except ImportError: # Python < 2.5
+    from sha import new as sha1
+try:
+    import multiprocessing
+except ImportError: # Python < 2.6
+    multiprocessing = None
 
 from logging import getLogger, StreamHandler, Formatter, \
                     DEBUG, INFO, WARN, ERROR, CRITICAL
@@ -68,6 +77,9 @@ RTL_BIDI_RANGES = ( (u'\u0590', u'\u07FF'),
                     # Tifinagh
                     )
 
+# Every letter below this is left to right.
+RTL_BIDI_START = min([start for start, end in RTL_BIDI_RANGES])
+
 # Unicode Reference Table:
 # 0590-05FF - Hebrew
 # 0600-06FF - Arabic
@@ -102,6 +114,7 @@ EXECUTABLE_NAME_FOR_USAGE = "python markdown.py"
 # a template for html placeholders
 HTML_PLACEHOLDER_PREFIX = "qaodmasdkwaspemas"
 HTML_PLACEHOLDER = HTML_PLACEHOLDER_PREFIX + "%dajkqlsmdqpakldnzsdfls"
+HTML_PLACEHOLDER_RE = re.compile(HTML_PLACEHOLDER.replace("%d", r"(\d+)"))
 
 BLOCK_LEVEL_ELEMENTS = ['p', 'div', 'blockquote', 'pre', 'table',
                         'dl', 'ol', 'ul', 'script', 'noscript',
@@ -117,7 +130,7 @@ def isBlockLevel (tag):
 ========================== NANODOM ===================================
 ======================================================================
 
-The three classes below implement some of the most basic DOM
+The classes below implement some of the most basic DOM
 methods.  I use this instead of minidom because I need a simpler
 functionality and do not want to require additional libraries.
 
@@ -125,6 +138,8 @@ Importantly, NanoDom does not do normalization, which is what we
 want. It also adds extra white space when converting DOM to string
 """
 
+# The serializer makes these replacements inline, see escapeText() and
+# escapeAttribute(). They are kept here for extensions.
 ENTITY_NORMALIZATION_EXPRESSIONS = [ (re.compile("&"), "&amp;"),
                                      (re.compile("<"), "&lt;"),
                                      (re.compile(">"), "&gt;")]
@@ -134,6 +149,23 @@ ENTITY_NORMALIZATION_EXPRESSIONS_SOFT = [ (re.compile("&(?!\#)"), "&amp;"),
                                      (re.compile(">"), "&gt;"),
                                      (re.compile("\""), "&quot;")]
 
+SOFT_AMPERSAND_RE = re.compile("&(?!\#)")
+
+
+def escapeText(text):
+    """Replaces &, < and > with entities, in one pass each."""
+
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def escapeAttribute(value):
+    """Replaces &, < , > and " with entities, leaving &# alone so that
+       numeric entities are not escaped twice."""
+
+    if "&" in value:
+        value = SOFT_AMPERSAND_RE.sub("&amp;", value)
+    return value.replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
 
 def getBidiType(text):
 
@@ -144,6 +176,10 @@ def getBidiType(text):
     if not isinstance(ch, unicode) or not ch.isalpha():
         return None
 
+    elif ch < RTL_BIDI_START:
+        # ASCII and the rest of the common case, no need to look at ranges
+        return "ltr"
+
     else:
 
         for min, max in RTL_BIDI_RANGES:
@@ -190,19 +226,24 @@ class Document:
         node.doc = self
         return node
 
-    def toxml (self):
-        return self.documentElement.toxml()
+    def toxml (self, withDocumentElement=True):
+        """Serializes the document into a single buffer.  If
+           withDocumentElement is false only the children of the document
+           element are serialized, not its tags."""
+
+        buffer = []
+        if withDocumentElement:
+            self.documentElement.writexml(buffer)
+        else:
+            self.documentElement.writeChildren(buffer)
+        return "".join(buffer)
 
     def normalizeEntities(self, text, avoidDoubleNormalizing=False):
 
         if avoidDoubleNormalizing:
-            regexps = ENTITY_NORMALIZATION_EXPRESSIONS_SOFT
+            return escapeAttribute(text)
         else:
-            regexps = ENTITY_NORMALIZATION_EXPRESSIONS
-
-        for regexp, substitution in regexps:
-            text = regexp.sub(substitution, text)
-        return text
+            return escapeText(text)
 
     def find(self, test):
         return self.documentElement.find(test)
@@ -212,9 +253,10 @@ class Document:
         self.documentElement = None
 
 
-class CDATA:
+class CDATA(object):
 
     type = "cdata"
+    __slots__ = ('text', 'doc', 'parent')
 
     def __init__ (self, text):
         self.text = text
@@ -225,9 +267,16 @@ class CDATA:
     def toxml (self):
         return "<![CDATA[" + self.text + "]]>"
 
-class Element:
+    def writexml(self, buffer):
+        buffer.append("<![CDATA[")
+        buffer.append(self.text)
+        buffer.append("]]>")
+
+class Element(object):
 
     type = "element"
+    __slots__ = ('nodeName', 'attributes', 'attribute_values', 'childNodes',
+                 'bidi', 'isDocumentElement', 'parent', 'doc')
 
     def __init__ (self, tag):
 
@@ -292,38 +341,55 @@ class Element:
         return matched_nodes
 
     def toxml(self):
+        buffer = []
+        self.writexml(buffer)
+        return "".join(buffer)
+
+    def writeChildren(self, buffer):
+        """Serializes the children of this element onto buffer, a list of
+           strings."""
+
         if ENABLE_ATTRIBUTES:
             for child in self.childNodes:
                 child.handleAttributes()
 
-        buffer = ""
-        if self.nodeName in ['h1', 'h2', 'h3', 'h4']:
-            buffer += "\n"
-        elif self.nodeName in ['li']:
-            buffer += "\n "
+        for child in self.childNodes:
+            writexml = getattr(child, "writexml", None)
+            if writexml is not None:
+                writexml(buffer)
+            else:
+                buffer.append(child.toxml())
 
-        # Process children FIRST, then do the attributes
+    def writexml(self, buffer):
+        """Serializes this element onto buffer, a list of strings."""
 
-        childBuffer = ""
+        nodeName = self.nodeName
 
-        if self.childNodes or self.nodeName in ['blockquote']:
-            childBuffer += ">"
-            for child in self.childNodes:
-                childBuffer += child.toxml()
-            if self.nodeName == 'p':
-                childBuffer += "\n"
-            elif self.nodeName == 'li':
-                childBuffer += "\n "
-            childBuffer += "</%s>" % self.nodeName
-        else:
-            childBuffer += "/>"
+        if nodeName in ['h1', 'h2', 'h3', 'h4']:
+            buffer.append("\n")
+        elif nodeName in ['li']:
+            buffer.append("\n ")
 
+        # The children can add attributes and set the bidi of this element,
+        # so process them FIRST, keeping a slot for the opening tag to be
+        # filled in afterwards.
 
-            
-        buffer += "<" + self.nodeName
+        slot = len(buffer)
+        buffer.append(None)
+
+        if self.childNodes or nodeName in ['blockquote']:
+            buffer.append(">")
+            self.writeChildren(buffer)
+            if nodeName == 'p':
+                buffer.append("\n")
+            elif nodeName == 'li':
+                buffer.append("\n ")
+            buffer.append("</%s>" % nodeName)
+        else:
+            buffer.append("/>")
 
-        if self.nodeName in ['p', 'li', 'ul', 'ol',
-                             'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+        if nodeName in ['p', 'li', 'ul', 'ol',
+                        'h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
 
             if not self.attribute_values.has_key("dir"):
                 if self.bidi:
@@ -333,28 +399,22 @@ class Element:
                     
                 if bidi=="rtl":
                     self.setAttribute("dir", "rtl")
-        
-        for attr in self.attributes:
-            value = self.attribute_values[attr]
-            value = self.doc.normalizeEntities(value,
-                                               avoidDoubleNormalizing=True)
-            buffer += ' %s="%s"' % (attr, value)
-
 
-        # Now let's actually append the children
-
-        buffer += childBuffer
-
-        if self.nodeName in ['p', 'br ', 'li', 'ul', 'ol',
-                             'h1', 'h2', 'h3', 'h4'] :
-            buffer += "\n"
+        tag = ["<" + nodeName]
+        for attr in self.attributes:
+            value = escapeAttribute(self.attribute_values[attr])
+            tag.append(' %s="%s"' % (attr, value))
+        buffer[slot] = "".join(tag)
 
-        return buffer
+        if nodeName in ['p', 'br ', 'li', 'ul', 'ol',
+                        'h1', 'h2', 'h3', 'h4'] :
+            buffer.append("\n")
 
 
-class TextNode:
+class TextNode(object):
 
     type = "text"
+    __slots__ = ('value', 'doc', 'parent')
     attrRegExp = re.compile(r'\{@([^\}]*)=([^\}]*)}') # {@id=123}
 
     def __init__ (self, text):
@@ -368,6 +428,11 @@ class TextNode:
         self.value = self.attrRegExp.sub(self.attributeCallback, self.value)
 
     def toxml(self):
+        buffer = []
+        self.writexml(buffer)
+        return buffer[0]
+
+    def writexml(self, buffer):
 
         text = self.value
 
@@ -379,13 +444,13 @@ class TextNode:
             elif (self.parent.nodeName == "li"
                   and self.parent.childNodes[0]==self):
                 text = "\n     " + text.replace("\n", "\n     ")
-        text = self.doc.normalizeEntities(text)
-        return text
+        buffer.append(escapeText(text))
 
 
-class EntityReference:
+class EntityReference(object):
 
     type = "entity_ref"
+    __slots__ = ('entity', 'parent')
 
     def __init__(self, entity):
         self.entity = entity
@@ -396,6 +461,11 @@ class EntityReference:
     def toxml(self):
         return "&" + self.entity + ";"
 
+    def writexml(self, buffer):
+        buffer.append("&")
+        buffer.append(self.entity)
+        buffer.append(";")
+
 
 """
 ======================================================================
@@ -441,14 +511,42 @@ class Preprocessor:
  
 
 class HtmlBlockPreprocessor(TextPreprocessor):
-    """Removes html blocks from the source text and stores it."""
-    
-    def _get_left_tag(self, block):
-        return block[1:].replace(">", " ", 1).split()[0].lower()
+    """Removes html blocks from the source text and stores it.
 
+       The text is scanned once, block by block (a block being what lies
+       between two blank lines), by position: only the blocks that end up
+       in the output or the stash are copied."""
 
-    def _get_right_tag(self, left_tag, block):
-        return block.rstrip()[-len(left_tag)-2:-1].lower()
+    WORD_RE = re.compile(r'\S+', re.UNICODE)
+
+    def _get_left_tag(self, text, start, end):
+        """Returns the tag name a block starting with '<' opens: the first
+           word after the '<', which ends at the first '>'. Returns None if
+           there isn't one."""
+        word = self.WORD_RE.search(text, start + 1, end)
+        if word is None:
+            return None
+        gt = text.find(">", start + 1, end)
+        if word.start() <= gt < word.end():
+            if gt > word.start():
+                return text[word.start():gt].lower()
+            word = self.WORD_RE.search(text, gt + 1, end)
+            if word is None:
+                return None
+        return word.group().lower()
+
+    def _rstripped_end(self, text, start, end):
+        """Returns where the block would end with trailing whitespace
+           stripped."""
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return end
+
+    def _get_right_tag(self, left_tag, text, start, end):
+        """Returns the closing tag a block ending at `end` (stripped of
+           trailing whitespace) would have, as long as left_tag."""
+        return text[max(end - len(left_tag) - 2, start):
+                    max(end - 1, start)].lower()
 
     def _equal_tags(self, left_tag, right_tag):
         
@@ -471,56 +569,70 @@ class HtmlBlockPreprocessor(TextPreprocessor):
     def run(self, text):
 
         new_blocks = []
-        text = text.split("\n\n")
         
         items = []
         left_tag = ''
         right_tag = ''
         in_tag = False # flag
-        
-        for block in text:
-            if block.startswith("\n"):
-                block = block[1:]
+
+        pos, length = 0, len(text)
+        while pos <= length:
+            start = pos
+            end = text.find("\n\n", start)
+            if end == -1:
+                end = length
+            pos = end + 2
+
+            if text.startswith("\n", start, end):
+                start += 1
 
             if not in_tag:
 
-                if block.startswith("<"):
-                    
-                    left_tag = self._get_left_tag(block)
-                    right_tag = self._get_right_tag(left_tag, block)
+                if text.startswith("<", start, end):
+
+                    left_tag = self._get_left_tag(text, start, end)
+                    if left_tag is None:
+                        new_blocks.append(text[start:end])
+                        continue
+                    stripped_end = self._rstripped_end(text, start, end)
+                    right_tag = self._get_right_tag(left_tag, text, start,
+                                                    stripped_end)
 
                     if not (isBlockLevel(left_tag) \
-                        or block[1] in ["!", "?", "@", "%"]):
-                        new_blocks.append(block)
+                        or text[start + 1] in ["!", "?", "@", "%"]):
+                        new_blocks.append(text[start:end])
                         continue
 
                     if self._is_oneliner(left_tag):
-                        new_blocks.append(block.strip())
+                        new_blocks.append(text[start:end].strip())
                         continue
                         
-                    if block[1] == "!":
+                    if text[start + 1] == "!":
                         # is a comment block
                         left_tag = "--"
-                        right_tag = self._get_right_tag(left_tag, block)
+                        right_tag = self._get_right_tag(left_tag, text, start,
+                                                        stripped_end)
                         # keep checking conditions below and maybe just append
                         
-                    if block.rstrip().endswith(">") \
+                    if text[stripped_end - 1] == ">" \
                         and self._equal_tags(left_tag, right_tag):
                         new_blocks.append(
-                            self.stash.store(block.strip()))
+                            self.stash.store(text[start:end].strip()))
                         continue
                     else: #if not block[1] == "!":
                         # if is block level tag and is not complete
-                        items.append(block.strip())
+                        items.append(text[start:end].strip())
                         in_tag = True
                         continue
 
-                new_blocks.append(block)
+                new_blocks.append(text[start:end])
 
             else:
-                items.append(block.strip())
+                items.append(text[start:end].strip())
                 
-                right_tag = self._get_right_tag(left_tag, block)
+                stripped_end = self._rstripped_end(text, start, end)
+                right_tag = self._get_right_tag(left_tag, text, start,
+                                                stripped_end)
                 
                 if self._equal_tags(left_tag, right_tag):
                     # if find closing tag
@@ -714,11 +826,76 @@ ENTITY_RE = r'(&[\#a-zA-Z0-9]*;)'                # &amp;
 LINE_BREAK_RE = r'  \n'                     # two spaces at end of line
 LINE_BREAK_2_RE = r'  $'                    # two spaces at end of text
 
+def firstLiteral(pattern):
+    """Returns the character that every match of the regular expression
+       `pattern` starts with, or None if there isn't one. """
+
+    try:
+        parsed = sre_parse.parse(pattern, re.DOTALL)
+    except (sre_constants.error, OverflowError):
+        return None
+    for op, av in parsed:
+        if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT,
+                  sre_constants.AT):
+            continue # zero width, look at what follows
+        if op == sre_constants.LITERAL:
+            return unichr(av)
+        return None
+    return None
+
+
+class RightmostMatch:
+    """ What compiled_re.match(string) would give for a Pattern, worked
+        out from `m`, the rightmost match of the bare pattern in the
+        string: group 1 is the text to the left of the match, the groups
+        of the pattern follow, and the last group is the text to its
+        right. """
+
+    def __init__(self, m):
+        self.m = m
+        self.left = m.string[:m.start()]
+        self.right = m.string[m.end():]
+
+    def group(self, index=0):
+        if index == 0:
+            return self.m.string
+        if index == 1:
+            return self.left
+        if index == self.m.re.groups + 2:
+            return self.right
+        return self.m.group(index - 1)
+
+    def groups(self):
+        return (self.left,) + self.m.groups() + (self.right,)
+
+
+def rightmostMatch(regexp, text):
+    """Returns a RightmostMatch for the last place in `text` where `regexp`
+       matches, or None if it doesn't match anywhere.
+
+       This finds the same match as "^(.*)PATTERN(.*)$" with re.DOTALL,
+       whose greedy first group tries every position from the end of the
+       text backwards, but without the backtracking."""
+
+    m = regexp.search(text)
+    if m is None:
+        return None
+    while True:
+        later = regexp.search(text, m.start() + 1)
+        if later is None:
+            return RightmostMatch(m)
+        m = later
+
+
 class Pattern:
 
     def __init__ (self, pattern):
         self.pattern = pattern
         self.compiled_re = re.compile("^(.*)%s(.*)$" % pattern, re.DOTALL)
+        # For finding the same match as compiled_re more cheaply, and
+        # skipping text it can't match.
+        self.bare_re = re.compile(pattern, re.DOTALL)
+        self.trigger = firstLiteral(pattern)
 
     def getCompiledRegExp (self):
         return self.compiled_re
@@ -1145,6 +1322,22 @@ class CorePatterns:
 RE = CorePatterns()
 
 
+"""
+The processors and patterns that Markdown.reset() gives per-document state
+(the html stash and the link references). Every Markdown instance works with
+its own copies of these.
+"""
+
+STATEFUL_PROCESSORS = ['HTML_BLOCK_PREPROCESSOR',
+                       'LINE_PREPROCESSOR',
+                       'REFERENCE_PREPROCESSOR',
+                       'HTML_PATTERN',
+                       'ENTITY_PATTERN',
+                       'REFERENCE_PATTERN',
+                       'IMAGE_REFERENCE_PATTERN',
+                       'RAWHTMLTEXTPOSTPROCESSOR']
+
+
 class Markdown:
     """ Markdown formatter class for creating an html document from
         Markdown text """
@@ -1165,18 +1358,40 @@ class Markdown:
         if source is not None:
             message(WARN, "The `source` arg of Markdown.__init__() is depreciated and will be removed in the future. Use `instance.convert(source)` instead.")
         self.safeMode = safe_mode
+
+        # Setting up the processors, patterns and extensions is done once
+        # for each list of extensions, and copied from then on.
+        EXTENSION_REGISTRY.pipeline(extensions,
+                                    extension_configs).copyTo(self)
+
+        self.reset()
+
+
+    def _buildPipeline(self, extensions, extension_configs):
+        """Sets up the processors and patterns, and registers the
+           extensions."""
+
         self.blockGuru = BlockGuru()
         self.registeredExtensions = []
         self.stripTopLevelTags = 1
         self.docType = ""
 
-        self.textPreprocessors = [HTML_BLOCK_PREPROCESSOR]
+        # The processors and patterns that keep per-document state are
+        # copied for each instance, so that instances can be used from
+        # several threads at once. Extensions are given these copies in place
+        # of the module level ones.
+        self.md_globals = globals().copy()
+        for name in STATEFUL_PROCESSORS:
+            self.md_globals[name] = copy.copy(globals()[name])
+        g = self.md_globals
+
+        self.textPreprocessors = [g['HTML_BLOCK_PREPROCESSOR']]
 
         self.preprocessors = [HEADER_PREPROCESSOR,
-                              LINE_PREPROCESSOR,
+                              g['LINE_PREPROCESSOR'],
                               # A footnote preprocessor will
                               # get inserted here
-                              REFERENCE_PREPROCESSOR]
+                              g['REFERENCE_PREPROCESSOR']]
 
 
         self.postprocessors = [] # a footnote postprocessor will get
@@ -1184,7 +1399,7 @@ class Markdown:
 
         self.textPostprocessors = [# a footnote postprocessor will get
                                    # inserted here
-                                   RAWHTMLTEXTPOSTPROCESSOR]
+                                   g['RAWHTMLTEXTPOSTPROCESSOR']]
 
         self.prePatterns = []
         
@@ -1192,17 +1407,17 @@ class Markdown:
         self.inlinePatterns = [DOUBLE_BACKTICK_PATTERN,
                                BACKTICK_PATTERN,
                                ESCAPE_PATTERN,
-                               REFERENCE_PATTERN,
+                               g['REFERENCE_PATTERN'],
                                LINK_ANGLED_PATTERN,
                                LINK_PATTERN,
                                IMAGE_LINK_PATTERN,
-			                   IMAGE_REFERENCE_PATTERN,
+			                   g['IMAGE_REFERENCE_PATTERN'],
 			                   AUTOLINK_PATTERN,
                                AUTOMAIL_PATTERN,
                                LINE_BREAK_PATTERN_2,
                                LINE_BREAK_PATTERN,
-                               HTML_PATTERN,
-                               ENTITY_PATTERN,
+                               g['HTML_PATTERN'],
+                               g['ENTITY_PATTERN'],
                                NOT_STRONG_PATTERN,
                                STRONG_EM_PATTERN,
                                STRONG_EM_PATTERN_2,
@@ -1216,8 +1431,6 @@ class Markdown:
         self.registerExtensions(extensions = extensions,
                                 configs = extension_configs)
 
-        self.reset()
-
 
     def registerExtensions(self, extensions, configs):
 
@@ -1242,7 +1455,7 @@ class Markdown:
                 else:
                     configs_for_ext = []
                 extension = module.makeExtension(configs_for_ext)    
-                extension.extendMarkdown(self, globals())
+                extension.extendMarkdown(self, self.md_globals)
 
 
 
@@ -1257,15 +1470,16 @@ class Markdown:
         self.references={}
         self.htmlStash = HtmlStash()
 
-        HTML_BLOCK_PREPROCESSOR.stash = self.htmlStash
-        LINE_PREPROCESSOR.stash = self.htmlStash
-        REFERENCE_PREPROCESSOR.references = self.references
-        HTML_PATTERN.stash = self.htmlStash
-        ENTITY_PATTERN.stash = self.htmlStash
-        REFERENCE_PATTERN.references = self.references
-        IMAGE_REFERENCE_PATTERN.references = self.references
-        RAWHTMLTEXTPOSTPROCESSOR.stash = self.htmlStash
-        RAWHTMLTEXTPOSTPROCESSOR.safeMode = self.safeMode
+        g = self.md_globals
+        g['HTML_BLOCK_PREPROCESSOR'].stash = self.htmlStash
+        g['LINE_PREPROCESSOR'].stash = self.htmlStash
+        g['REFERENCE_PREPROCESSOR'].references = self.references
+        g['HTML_PATTERN'].stash = self.htmlStash
+        g['ENTITY_PATTERN'].stash = self.htmlStash
+        g['REFERENCE_PATTERN'].references = self.references
+        g['IMAGE_REFERENCE_PATTERN'].references = self.references
+        g['RAWHTMLTEXTPOSTPROCESSOR'].stash = self.htmlStash
+        g['RAWHTMLTEXTPOSTPROCESSOR'].safeMode = self.safeMode
 
         for extension in self.registeredExtensions:
             extension.reset()
@@ -1284,6 +1498,31 @@ class Markdown:
         self.top_element.setAttribute('class', 'markdown')
         self.doc.appendChild(self.top_element)
 
+        # Create a NanoDom tree from the lines and attach it to Document
+
+        for section in self._splitSections():
+            self._processSection(self.top_element, section)
+        
+        #self._processSection(self.top_element, self.lines)
+
+        # Not sure why I put this in but let's leave it for now.
+        self.top_element.appendChild(self.doc.createTextNode('\n'))
+
+        # Run the post-processors
+        for postprocessor in self.postprocessors:
+            postprocessor.run(self.doc)
+
+        return self.doc
+
+
+    def _splitSections(self):
+        """Fixes up the source text, runs the preprocessors over its lines
+           and splits them into the top level sections that are processed
+           one by one: a new one starts at every header line, and at every
+           other line where _processSection() would start a new block.
+
+           @returns: A list of lists of lines """
+
         # Fixup the source text
         text = self.source
         text = text.replace("\r\n", "\n").replace("\r", "\n")
@@ -1299,28 +1538,70 @@ class Markdown:
         for prep in self.preprocessors :
             self.lines = prep.run(self.lines)
 
-        # Create a NanoDom tree from the lines and attach it to Document
-
-
+        # Follow the blocks the way _processSection() finds them: a
+        # paragraph ends at a blank line, while a list, a quote or a code
+        # block goes on past blank lines into any line that could still be
+        # part of it (see _continuesBlock).  Html blocks are stashed away
+        # by now as a single line each.  Wherever there is doubt the
+        # section goes on, which is always safe.
+        sections = []
         buffer = []
+        block = None # the kind of block the lines are going into
+        blank = False
         for line in self.lines:
             if line.startswith("#"):
-                self._processSection(self.top_element, buffer)
-                buffer = [line]
+                split, block = True, "paragraph"
+            elif block is None:
+                # Between blocks, where blank lines are skipped, but a line
+                # of spaces is indented enough to start a code block.
+                split = bool(line.strip())
+                if split or RE.regExp['tabbed'].match(line):
+                    block = self._blockKind(line)
+            elif block == "paragraph":
+                split = False
+            elif ((blank or block == "tabbed") and line.strip()
+                  and not self._continuesBlock(block, line)):
+                # A code block ends at the first line that isn't indented,
+                # the others only at a blank line.  Whatever comes after a
+                # blank line that is indented is in a code block, if not in
+                # the block before it, since blank lines with enough spaces
+                # in them start one.
+                if RE.regExp['tabbed'].match(line):
+                    split, block = False, "tabbed"
+                else:
+                    split, block = True, self._blockKind(line)
             else:
-                buffer.append(line)
-        self._processSection(self.top_element, buffer)
-        
-        #self._processSection(self.top_element, self.lines)
-
-        # Not sure why I put this in but let's leave it for now.
-        self.top_element.appendChild(self.doc.createTextNode('\n'))
-
-        # Run the post-processors
-        for postprocessor in self.postprocessors:
-            postprocessor.run(self.doc)
-
-        return self.doc
+                split = False
+            if split and buffer:
+                sections.append(buffer)
+                buffer = []
+            buffer.append(line)
+            blank = not line.strip()
+            if blank and block == "paragraph":
+                block = None
+        sections.append(buffer)
+        return sections
+
+    def _blockKind(self, line):
+        """Returns what kind of block _processSection() takes a line that
+           starts one to be: 'ul', 'ol', 'quoted', 'tabbed' or 'paragraph'."""
+
+        for kind in ['ul', 'ol', 'quoted', 'tabbed']:
+            if RE.regExp[kind].match(line):
+                return kind
+        return "paragraph"
+
+    def _continuesBlock(self, kind, line):
+        """Returns whether a block of the given kind goes on into a line
+           that comes after a blank one. """
+
+        if kind in ('ul', 'ol'):
+            return bool(RE.regExp['ul'].match(line)
+                        or RE.regExp['ol'].match(line)
+                        or RE.regExp['tabbed'].match(line))
+        if kind == 'quoted':
+            return bool(RE.regExp['quoted'].match(line))
+        return bool(RE.regExp['tabbed'].match(line))
 
 
     def _processSection(self, parent_elem, lines,
@@ -1606,34 +1887,31 @@ class Markdown:
         This function uses auxiliary objects called inline patterns.
         See notes on inline patterns above.
 
+        Each pattern in turn splits the text that earlier patterns left
+        as strings.  A pattern whose first character doesn't appear in
+        the line at all is skipped without looking at the text again.
+
         @param line: A line of Markdown text
         @param patternIndex: The index of the inlinePattern to start with
         @return: A list of NanoDom nodes """
 
-
+        present = set(line)
         parts = [line]
 
-        while patternIndex < len(self.inlinePatterns):
-
-            i = 0
+        for index in range(patternIndex, len(self.inlinePatterns)):
 
-            while i < len(parts):
-                
-                x = parts[i]
+            pattern = self.inlinePatterns[index]
+            trigger = getattr(pattern, 'trigger', None)
+            if trigger is not None and trigger not in present:
+                continue
 
+            result = []
+            for x in parts:
                 if isinstance(x, (str, unicode)):
-                    result = self._applyPattern(x, \
-                                self.inlinePatterns[patternIndex], \
-                                patternIndex)
-
-                    if result:
-                        i -= 1
-                        parts.remove(x)
-                        for y in result:
-                            parts.insert(i+1,y)
-
-                i += 1
-            patternIndex += 1
+                    result.extend(self._splitText(x, pattern, index))
+                else:
+                    result.append(x)
+            parts = result
 
         for i in range(len(parts)):
             x = parts[i]
@@ -1641,7 +1919,45 @@ class Markdown:
                 parts[i] = self.doc.createTextNode(x)
 
         return parts
-        
+
+
+    def _splitText(self, text, pattern, patternIndex):
+        """Split a string on the matches of one inline pattern.
+
+        Matches are handled in the same order as always: the rightmost
+        one first, then the rest of the text to its left, then the
+        strings between the matches from left to right, each of which
+        may match again.
+
+        @param text: the string to split
+        @param pattern: the pattern to split it on
+        @returns: a list of strings and NanoDom nodes """
+
+        matches = []
+        while True:
+            result = self._applyPattern(text, pattern, patternIndex)
+            if not result:
+                break
+            right, node, text = result
+            matches.append((node, right))
+
+        parts = [text]
+        matches.reverse()
+        for node, right in matches:
+            parts.append(node)
+            parts.extend(self._splitText(right, pattern, patternIndex))
+        return parts
+
+
+    def _matchPattern(self, line, pattern):
+        """Match the line to the pattern's "^(.*)PATTERN(.*)$" regular
+        expression, finding the match without it if the pattern allows."""
+
+        bare_re = getattr(pattern, 'bare_re', None)
+        if bare_re is not None:
+            return rightmostMatch(bare_re, line)
+        return pattern.getCompiledRegExp().match(line)
+
 
     def _applyPattern(self, line, pattern, patternIndex):
 
@@ -1661,7 +1977,7 @@ class Markdown:
 
 
 
-        m = pattern.getCompiledRegExp().match(line)
+        m = self._matchPattern(line, pattern)
         if not m:
             return None
 
@@ -1732,19 +2048,28 @@ class Markdown:
         for pp in self.textPreprocessors:
             self.source = pp.run(self.source)
 
-        doc = self._transform()
-        xml = doc.toxml()
+        return (self.docType + self._toxml()).strip()
+
 
+    def _toxml(self):
+        """Transforms the source text and serializes it, with the text
+           post-processors run over the result.
+
+           @returns: A serialized XHTML body."""
+
+        doc = self._transform()
 
         # Return everything but the top level tag
 
         if self.stripTopLevelTags:
-            xml = xml.strip()[23:-7] + "\n"
+            xml = doc.toxml(withDocumentElement=False) + "\n"
+        else:
+            xml = doc.toxml()
 
         for pp in self.textPostprocessors:
             xml = pp.run(xml)
 
-        return (self.docType + xml).strip()
+        return xml
 
 
     def __str__(self):
@@ -1762,6 +2087,342 @@ class Markdown:
 
 
 
+class BlockCache:
+    """ A simple bounded cache for IncrementalMarkdown.  When it is full it
+        is emptied and starts again. """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = {}
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def set(self, key, value):
+        if len(self.entries) >= self.size:
+            self.entries.clear()
+        self.entries[key] = value
+
+
+class IncrementalMarkdown(Markdown):
+    """ A Markdown formatter that keeps the html of every top level section
+        of the documents it converts, keyed by a hash of all that goes into
+        it, and only renders the sections that are new or have changed.
+        For converting a document again and again as it is edited, e.g. for
+        a live preview.
+
+        The output is the same as Markdown's.  With extensions that work on
+        the whole document (post-processors, footnotes) every document is
+        converted in full. """
+
+    def __init__(self, blockCache=None, **kwargs):
+        """Creates a new instance.
+
+           @param blockCache: Where to keep the html of the sections, any
+                              object with get(key) and set(key, value).
+                              Can be shared between instances if it is safe
+                              to use from several threads.  By default each
+                              instance has a BlockCache of its own.
+           @param kwargs: Passed on to Markdown(). """
+
+        Markdown.__init__(self, **kwargs)
+        if blockCache is None:
+            blockCache = BlockCache()
+        self.blockCache = blockCache
+
+    def _toxml(self):
+        if (self.registeredExtensions or self.postprocessors
+                or not self.stripTopLevelTags):
+            return Markdown._toxml(self)
+
+        sections = self._splitSections()
+        # What every section depends on besides its own lines: the link
+        # references, which are defined anywhere in the document.
+        context = repr((self.safeMode, sorted(self.references.items())))
+
+        # A section can change the bidi of the document, which sets the
+        # direction of the sections after it.
+        bidi = "ltr"
+        buffer = ["\n"]
+        for section in sections:
+            key = self._sectionKey(section, context, bidi)
+            rendered = self.blockCache.get(key)
+            if rendered is None:
+                rendered = self._renderSection(section, bidi)
+                self.blockCache.set(key, rendered)
+            xml, bidi = rendered
+            buffer.append(xml)
+        buffer.append("\n\n")
+        return "".join(buffer)
+
+    def _sectionKey(self, lines, context, bidi):
+        """Returns a hash of a section's lines, with the html stashed by the
+           preprocessors in place of its placeholders, and of the context
+           it is rendered in."""
+
+        stash = self.htmlStash.rawHtmlBlocks
+        def unstash(m):
+            return "\0%r\0" % (stash[int(m.group(1))],)
+        text = HTML_PLACEHOLDER_RE.sub(unstash, "\n".join(lines))
+        key = sha1()
+        for part in (context, bidi, text):
+            key.update(part.encode("utf-8"))
+            key.update("\0")
+        return key.hexdigest()
+
+    def _renderSection(self, lines, bidi):
+        """Renders one section in a document of its own that starts with
+           the given bidi.
+
+           @returns: The section's html, and the bidi of the document
+                     after it """
+
+        self.doc = Document()
+        self.doc.bidi = bidi
+        self.top_element = self.doc.createElement("span")
+        self.top_element.setAttribute('class', 'markdown')
+        self.doc.appendChild(self.top_element)
+        self._processSection(self.top_element, lines)
+
+        xml = self.doc.toxml(withDocumentElement=False)
+        for pp in self.textPostprocessors:
+            xml = pp.run(xml)
+        return xml, self.doc.bidi
+
+
+class MarkdownPipeline(Markdown):
+    """ A Markdown instance that is never used to convert anything, only
+        set up for one list of extensions and copied into new instances
+        that ask for the same ones.
+
+        Module level processors and patterns are shared by the copies.
+        Everything else in the processor and pattern lists, and the
+        registered extensions, is copied for each instance, along with the
+        lists and dicts they hold; references between them, and to this
+        instance, are pointed at the copies. An extension's per-document
+        state must therefore be kept on the extension or its processors and
+        patterns, as mdx_footnotes does. """
+
+    # Attributes that belong to the instance rather than the pipeline.
+    NOT_COPIED = ['source', 'safeMode', 'perInstance', 'attributes', 'links']
+
+    def __init__(self, extensions, extension_configs):
+        self.source = None
+        self.safeMode = False
+        self._buildPipeline(extensions, extension_configs)
+
+        shared = dict([(id(value), True) for value in globals().values()])
+        objects = self.registeredExtensions[:]
+        objects += [self.md_globals[name] for name in STATEFUL_PROCESSORS]
+        for name in ('textPreprocessors', 'preprocessors', 'postprocessors',
+                     'textPostprocessors', 'prePatterns', 'inlinePatterns'):
+            objects += getattr(self, name)
+        perInstance = []
+        for obj in objects:
+            if not shared.has_key(id(obj)):
+                shared[id(obj)] = True
+                perInstance.append(obj)
+
+        # Work out once which attributes of the instance and of each copy
+        # need pointing at copies: copyTo() only has to follow the links.
+        self.attributes = dict([(name, value)
+                                for name, value in self.__dict__.items()
+                                if name not in self.NOT_COPIED])
+        index = {id(self): 0}
+        for i, obj in enumerate(perInstance):
+            index[id(obj)] = i + 1
+        self.perInstance = perInstance
+        self.links = [self._links(self.attributes, index)]
+        self.links += [self._links(obj.__dict__, index) for obj in perInstance]
+
+    def _links(self, attributes, index):
+        """Returns (name, kind, to) for each attribute to be linked to the
+           copies: kind is list or dict for a container to be copied, with
+           `to` a list of (position, copy) to replace, or None for an
+           attribute to be set to copy number `to`."""
+
+        links = []
+        for name, value in attributes.items():
+            if isinstance(value, list):
+                to = [(i, index[id(item)]) for i, item in enumerate(value)
+                      if index.has_key(id(item))]
+                links.append((name, list, to))
+            elif isinstance(value, dict):
+                to = [(key, index[id(item)]) for key, item in value.items()
+                      if index.has_key(id(item))]
+                links.append((name, dict, to))
+            elif index.has_key(id(value)):
+                links.append((name, None, index[id(value)]))
+        return links
+
+    def copyTo(self, md):
+        """Sets up md with copies of this pipeline."""
+
+        md.__dict__.update(self.attributes)
+        copies = [md]
+        for obj in self.perInstance:
+            if type(obj) is types.InstanceType:
+                copies.append(types.InstanceType(obj.__class__,
+                                                 obj.__dict__.copy()))
+            else:
+                copies.append(copy.copy(obj))
+        for target, links in zip(copies, self.links):
+            attributes = target.__dict__
+            for name, kind, to in links:
+                if kind is None:
+                    attributes[name] = copies[to]
+                else:
+                    value = attributes[name] = kind(attributes[name])
+                    for key, i in to:
+                        value[key] = copies[i]
+
+
+class ExtensionRegistry:
+    """ The pipelines Markdown instances are copied from, one for each list
+        of extensions and their configuration. """
+
+    def __init__(self):
+        self.pipelines = {}
+        self.lock = threading.Lock()
+
+    def pipeline(self, extensions, configs=None):
+        """Returns the MarkdownPipeline for extensions, setting it up if
+           this is the first time they are asked for."""
+
+        configs = configs or {}
+        key = repr([(ext, configs.get(ext)) for ext in extensions])
+        pipeline = self.pipelines.get(key)
+        if pipeline is None:
+            self.lock.acquire()
+            try:
+                pipeline = self.pipelines.get(key)
+                if pipeline is None:
+                    pipeline = MarkdownPipeline(extensions, configs)
+                    self.pipelines[key] = pipeline
+            finally:
+                self.lock.release()
+        return pipeline
+
+    def clear(self):
+        """Forgets the pipelines, e.g. after an extension module has been
+           reloaded."""
+
+        self.lock.acquire()
+        self.pipelines = {}
+        self.lock.release()
+
+EXTENSION_REGISTRY = ExtensionRegistry()
+
+
+class MarkdownPool:
+    """ A bounded pool of Markdown instances made with the same arguments,
+        for converting documents from several threads without building a
+        new instance for each one. """
+
+    def __init__(self, size=4, markdownClass=Markdown, **kwargs):
+        """Creates a new pool.
+
+           @param size: The most instances the pool will ever make.  A
+                        thread that finds them all in use waits for one.
+           @param markdownClass: Markdown or a subclass of it.
+           @param kwargs: Passed on to markdownClass() for each instance. """
+
+        self.size = size
+        self.markdownClass = markdownClass
+        self.kwargs = kwargs
+        self.idle = Queue.Queue()
+        self.made = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Returns an instance that is ready for a new document."""
+
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self.lock.acquire()
+        try:
+            make = self.made < self.size
+            if make:
+                self.made += 1
+        finally:
+            self.lock.release()
+        if not make:
+            return self.idle.get()
+        try:
+            return self.markdownClass(**self.kwargs)
+        except:
+            self.lock.acquire()
+            self.made -= 1
+            self.lock.release()
+            raise
+
+    def release(self, md):
+        """Returns an instance from acquire() to the pool."""
+
+        md.reset()
+        self.idle.put(md)
+
+    def convert(self, source):
+        """Converts a document with one of the pooled instances."""
+
+        md = self.acquire()
+        try:
+            return md.convert(source)
+        finally:
+            self.release(md)
+
+
+# The Markdown instance of a process started by convertPool().
+_worker_md = None
+
+def _initWorker(kwargs):
+    global _worker_md
+    _worker_md = Markdown(**kwargs)
+
+def _convertInWorker(source):
+    _worker_md.reset()
+    return _worker_md.convert(source)
+
+def convertPool(processes=None, **kwargs):
+    """Returns a multiprocessing pool for convert_many() whose processes each
+       convert with a Markdown instance made with kwargs.
+
+       @param processes: The number of processes, by default one per core."""
+
+    return multiprocessing.Pool(processes, _initWorker, (kwargs,))
+
+def convert_many(sources, pool=None, **kwargs):
+    """Converts a list of documents, spreading them across several processes
+       so that they can use more than one core.
+
+       @param sources: The documents, in Markdown format.
+       @param pool: A pool from convertPool() to use.  If not given, one is
+                    made for this call with kwargs and shut down again.
+       @returns: A list of the converted documents, in the same order. """
+
+    if multiprocessing is None:
+        md = Markdown(**kwargs)
+        html = []
+        for source in sources:
+            md.reset()
+            html.append(md.convert(source))
+        return html
+    own_pool = pool is None
+    if own_pool:
+        pool = convertPool(**kwargs)
+    try:
+        # A few chunks per process keeps them all busy without sending each
+        # document separately.
+        chunksize = max(1, len(sources) // (4 * multiprocessing.cpu_count()))
+        return pool.map(_convertInWorker, sources, chunksize)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+
 # ====================================================================
 
 def markdownFromFile(input = None,
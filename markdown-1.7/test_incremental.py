@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Tests for IncrementalMarkdown: it has to convert every document exactly as
+Markdown does, while rendering again only the sections of a document that
+have changed since it was last converted.
+
+Run with: python test_incremental.py
+"""
+
+import random, unittest
+import markdown
+from benchmark import makeCorpus, convertOrFail
+
+markdown.console_hndlr.setLevel(markdown.CRITICAL + 1) # no warnings
+
+
+class RecordingMarkdown(markdown.IncrementalMarkdown):
+    """An IncrementalMarkdown that keeps the sections it renders."""
+
+    def __init__(self, **kwargs):
+        markdown.IncrementalMarkdown.__init__(self, **kwargs)
+        self.rendered = []
+
+    def _renderSection(self, lines, bidi):
+        self.rendered.append("\n".join(lines))
+        return markdown.IncrementalMarkdown._renderSection(self, lines, bidi)
+
+
+# A note without headers, so that every section comes from splitting it at
+# blank lines. The blocks that go on past a blank line have to stay whole.
+NOTE = u"""First paragraph, with *emphasis* and a [link][r].
+
+* A loose list
+
+* whose items
+
+    have paragraphs of their own
+* and a [reference][r]
+
+Second paragraph.
+
+    code that goes on
+
+    past a blank line
+
+> A quote that goes on
+>
+> past a blank line
+
+<div class="box">
+<p>An html block</p>
+</div>
+
+Third paragraph, the one that gets edited.
+
+1. An ordered list
+2. right after it
+
+Last paragraph.
+
+[r]: http://example.com/
+"""
+
+# Lines of every kind of block, for random documents.
+LINES = ["text *a*", "* item", "- item", "1. item", "    code", "        deep",
+         "\tcode", "> quote", ">", "  two", "   three", "", "", "    ", "  ",
+         "# Head", "Title", "=====", "<div>", "</div>", "<div>x</div>",
+         "[r]: /r", "[x][r]", "   * sub"]
+
+
+class IncrementalMarkdownTest(unittest.TestCase):
+
+    def testBlocksStayWhole(self):
+        md = markdown.IncrementalMarkdown()
+        md.source = NOTE
+        for pp in md.textPreprocessors:
+            md.source = pp.run(md.source)
+        sections = ["\n".join(lines).strip()
+                    for lines in md._splitSections()]
+        self.assertEqual(sections[1], u"* A loose list\n\n* whose items\n\n"
+                                      u"    have paragraphs of their own\n"
+                                      u"* and a [reference][r]")
+        self.assertEqual(sections[3], u"code that goes on\n\n"
+                                      u"    past a blank line")
+        self.assertEqual(sections[4], u"> A quote that goes on\n>\n"
+                                      u"> past a blank line")
+        self.assert_(markdown.HTML_PLACEHOLDER_RE.match(sections[5]))
+        self.assertEqual(sections[6],
+                         u"Third paragraph, the one that gets edited.")
+        self.assertEqual(sections[7],
+                         u"1. An ordered list\n2. right after it")
+
+    def testEditRendersOneSection(self):
+        md = RecordingMarkdown()
+        md.convert(NOTE)
+        md.reset()
+        md.rendered = []
+        edited = NOTE.replace(u"the one that gets edited.",
+                              u"the one that gets *edited*.")
+        html = md.convert(edited)
+        self.assertEqual(md.rendered,
+                         [u"Third paragraph, the one that gets *edited*.\n"])
+        self.assertEqual(html, markdown.Markdown().convert(edited))
+
+    def testSameAsMarkdown(self):
+        rand = random.Random(0)
+        notes = [u"\n".join([rand.choice(LINES)
+                             for i in range(rand.randint(1, 25))])
+                 for j in range(2000)]
+        for kind, extensions, corpus in makeCorpus(20):
+            if not extensions:
+                notes += corpus
+        full, incremental = markdown.Markdown(), markdown.IncrementalMarkdown()
+        for note in notes:
+            self.assertEqual(convertOrFail(incremental, note),
+                             convertOrFail(full, note),
+                             "outputs differ for %r" % note)
+
+
+if __name__ == '__main__':
+    unittest.main()
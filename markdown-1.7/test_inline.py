@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Regression tests for the inline engine: the current one has to convert
+every document exactly like the original pattern by pattern engine, which
+LegacyMarkdown in benchmark.py keeps.
+
+Run with: python test_inline.py
+"""
+
+import random, unittest
+import markdown
+from benchmark import LegacyMarkdown, makeCorpus, makeMarkupSoup, \
+    convertOrFail
+
+# Documents where the order the patterns are applied in, and the text each
+# one hides from the ones after it, decides the output.
+EDGE_CASES = [
+    # Emphasis and code
+    u"***both*** ___both___ __strong__ _em_ snake_case_name",
+    u"*a*b* **a**b** *a **b** c* **a *b* c** _a __b__ c_",
+    u"``code `with` ticks`` `*not em*` `<b>` `&amp;`",
+    u"Escaped \\*stars\\*, \\_under\\_, \\`tick\\` and \\\\ backslash",
+    u"line  \nbreak  ",
+    # Links and images
+    u"![img](/i.png \"t\") ![ref][r] [a][] [a] [*em* link](/x) "
+    u"[link](/x \"title *not em*\")\n\n[r]: /r.png\n[a]: /a",
+    u"[outer [inner](/i)](/o) [a](/b)(c) [](/empty) [text]()",
+    u"<http://x.y/> <me@x.y> <http://x.y/a_b_c> http://x.y/*not*",
+    # Raw HTML and entities
+    u"Some <b>html</b> &amp; &copy; &#169; &#xA9; & < > AT&T 4 < 5",
+    u"<b>*em in html*</b> <span title=\"*a*\">x</span> <a href=\"/x\">a</a>",
+    u"<i>unclosed and <b>nested <i>tags</b> a <br/> b <br /> <hr>",
+    u"<!-- a *comment* --> text <!-- unclosed",
+    u"<div>\n*block*\n</div>\n\n*after* <div>inline</div>",
+    u"<p>\n<a href=\"http://x.y/\">*x*</a>\n</p>\n\nand `<p>` too",
+    # Footnotes, see FOOTNOTE_CASES for the ones with the extension.
+    u"[^1] is not a footnote without the extension\n\n[^1]: a note",
+]
+
+# Documents converted with mdx_footnotes. Every footnote is cited, as the
+# extension fails on one that isn't.
+FOOTNOTE_CASES = [
+    u"A note[^1] and *emphasis[^2]* and __strong__[^1].\n\n"
+    u"[^1]: The *first* note.\n[^2]: The `second` <b>note</b>.",
+    u"[A link](/x)[^a] and ![img](/i.png)[^b] and <b>html</b>[^a]\n\n"
+    u"[^a]: Note a with [a link](/y).\n\n[^b]: Note b &amp; more.",
+    u"Adjacent[^1][^2] notes, and [^missing] one.\n\n"
+    u"[^1]: One\n[^2]: Two",
+    u"* A list item[^x]\n* Another with `code`[^x]\n\n"
+    u"> Quoted[^y]\n\n[^x]: In a list\n[^y]: In a quote",
+    u"Note in code `[^1]` and escaped \\[^1] and real[^1].\n\n"
+    u"[^1]: The note\n\n    with an indented second paragraph",
+]
+
+
+class InlineEngineTest(unittest.TestCase):
+
+    def assertConvertsLikeLegacy(self, sources, extensions=[]):
+        new = markdown.Markdown(extensions=extensions)
+        old = LegacyMarkdown(extensions=extensions)
+        for source in sources:
+            # mdx_footnotes makes its ids unique with random(), which has to
+            # give both the same ones.
+            random.seed(0)
+            html = convertOrFail(new, source)
+            random.seed(0)
+            self.assertEqual(html, convertOrFail(old, source),
+                             "outputs differ for %r" % source)
+
+    def testEdgeCases(self):
+        self.assertConvertsLikeLegacy(EDGE_CASES)
+
+    def testFootnotes(self):
+        self.assertConvertsLikeLegacy(FOOTNOTE_CASES, ['footnotes'])
+
+    def testCorpus(self):
+        for kind, extensions, notes in makeCorpus(20):
+            self.assertConvertsLikeLegacy(notes, extensions)
+
+    def testMarkupSoup(self):
+        rand = random.Random(0)
+        self.assertConvertsLikeLegacy([makeMarkupSoup(rand)
+                                       for i in range(1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+"""A full-text index of the links in the store, for searching them without
+asking simpy.
+
+The index is kept in the store's database: a list of postings for each term,
+which are the links it appears in and how much weight it has in each, packed
+into a blob, and for each link the ids of its terms, so that they can be
+found again when it changes. A common term also keeps its best links, ranked.
+A search only reads the postings of the terms it is looking for, so a process
+can answer one without loading the whole index. LinkStore keeps the index up
+to date as links are added, changed and removed.
+"""
+import re, math, array, bisect, heapq, operator
+from itertools import izip, imap, repeat
+from cache import LRUCache
+from linkindex import SQL_BATCH, setState, encodeIds, decodeIds, LinkIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_docs (
+    ordinal INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    terms BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE,
+    postings BLOB NOT NULL,
+    top BLOB NOT NULL
+);
+"""
+
+# The fields of a link that are indexed, and how much a term counts for in
+# each.
+FIELD_WEIGHTS = (('title', 3), ('nickname', 3), ('tags', 2), ('url', 1),
+                 ('note', 1))
+
+# The most weight a term can have in one link, so that it fits the postings.
+MAX_WEIGHT = 0xffff
+
+# Terms with more links than this keep this many of their best links, best
+# first, so that searching for one of them alone doesn't need to look at all
+# of its links.
+TOP_POSTINGS = 200
+
+# Postings this many times longer than the links still in the running in a
+# search are looked up link by link, rather than read through.
+LOOKUP_RATIO = 8
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """Return the terms in a piece of text, in order."""
+    return WORD_RE.findall(text.lower())
+
+def linkTerms(link):
+    """Return a dictionary of the terms in a link and their weights."""
+    terms = {}
+    for field, weight in FIELD_WEIGHTS:
+        value = link[field]
+        if field == 'tags':
+            value = u' '.join(value)
+        for term in tokenize(value):
+            terms[term] = min(terms.get(term, 0) + weight, MAX_WEIGHT)
+    return terms
+
+# Postings are two arrays, the ordinals of the links in increasing order and
+# the weights, stored one after the other.
+def encodePostings(postings):
+    """Return a blob for a dictionary of ordinals and weights."""
+    ordinals = array.array('I', sorted(postings))
+    weights = array.array('H', [postings[ordinal] for ordinal in ordinals])
+    return buffer(ordinals.tostring() + weights.tostring())
+
+def decodePostings(blob):
+    """Return the arrays of ordinals and weights in a blob."""
+    blob = str(blob)
+    ordinals, weights = array.array('I'), array.array('H')
+    split = len(blob) // (ordinals.itemsize + weights.itemsize) * \
+        ordinals.itemsize
+    ordinals.fromstring(blob[:split])
+    weights.fromstring(blob[split:])
+    return ordinals, weights
+
+class SearchIndex(LinkIndex):
+    """The full-text index, used by a LinkStore through the methods that
+    take its database connection."""
+
+    def __init__(self, cache_size=1000):
+        # Postings that have been read, keyed by the generation of the
+        # index they were read from and the term.
+        self.postings_cache = LRUCache(cache_size)
+
+    def createTables(self, db):
+        db.executescript(SCHEMA)
+
+    docs_table, docs_column = 'search_docs', 'terms'
+    keys_table, key_column = 'search_terms', 'term'
+    value_columns = ('postings', 'top')
+    empty_values = (buffer(''), buffer(''))
+    dirty_column = 'indexed'
+    generation_key = 'search_generation'
+
+    def _linkKeys(self, row, rowToLink):
+        return linkTerms(rowToLink(row))
+
+    def _merge(self, blob, changed):
+        ordinals, weights = decodePostings(blob)
+        postings = dict(zip(ordinals, weights))
+        for ordinal, weight in changed.items():
+            if weight is None:
+                postings.pop(ordinal, None)
+            else:
+                postings[ordinal] = weight
+        if not postings:
+            return None
+        if len(postings) > TOP_POSTINGS:
+            top = [ordinal for weight, ordinal in heapq.nlargest(
+                TOP_POSTINGS, [(weight, ordinal) for ordinal, weight
+                               in postings.items()])]
+        else:
+            top = []
+        return encodePostings(postings), encodeIds(top)
+
+    def _updated(self, db):
+        LinkIndex._updated(self, db)
+        setState(db, 'search_docs', db.execute(
+            'SELECT count(*) FROM search_docs').fetchone()[0])
+
+    def _postings(self, db, generation, term):
+        key = (generation, term)
+        postings = self.postings_cache.get(key)
+        if postings is None:
+            row = db.execute('SELECT postings, top FROM search_terms '
+                             'WHERE term = ?', (term,)).fetchone()
+            if row is None:
+                postings = (array.array('I'), array.array('H'), None)
+            else:
+                postings = decodePostings(row[0]) + (decodeIds(row[1]),)
+            self.postings_cache.set(key, postings)
+        return postings
+
+    def _lookup(self, postings, scores):
+        """Return (ordinal, weight) for each of the links in `scores` that
+        are also in `postings`. When the postings are far longer than the
+        links in `scores` those are looked up in them; otherwise the
+        postings are filtered by them."""
+        ordinals, weights, top = postings
+        if len(ordinals) > LOOKUP_RATIO * len(scores):
+            found = []
+            for ordinal in scores:
+                i = bisect.bisect_left(ordinals, ordinal)
+                if i < len(ordinals) and ordinals[i] == ordinal:
+                    found.append((ordinal, weights[i]))
+            return found
+        return ((ordinal, weight)
+                for ordinal, weight in izip(ordinals, weights)
+                if ordinal in scores)
+
+    def _scores(self, required, optional, prohibited, docs):
+        """Return a dictionary of the scores of the links that have all the
+        terms whose postings are in `required`, or if there are none any of
+        those in `optional`, and none of those in `prohibited`."""
+        def idf(ordinals):
+            return math.log(1.0 + float(docs) / len(ordinals))
+        if required:
+            # Start from the rarest term's links, and then keep those of
+            # them that each other term has.
+            required = sorted(required, key=lambda p: len(p[0]))
+            ordinals, weights, top = required[0]
+            scores = dict(izip(ordinals, imap(operator.mul, weights,
+                                              repeat(idf(ordinals)))))
+            for postings in required[1:]:
+                term_idf = idf(postings[0])
+                scores = dict([(ordinal, scores[ordinal] + weight * term_idf)
+                               for ordinal, weight
+                               in self._lookup(postings, scores)])
+                if not scores:
+                    return scores
+            for postings in optional:
+                term_idf = idf(postings[0])
+                for ordinal, weight in self._lookup(postings, scores):
+                    scores[ordinal] += weight * term_idf
+        else:
+            scores = {}
+            for ordinals, weights, top in optional:
+                term_idf = idf(ordinals)
+                for ordinal, weight in izip(ordinals, weights):
+                    scores[ordinal] = scores.get(ordinal, 0) + weight * term_idf
+        for postings in prohibited:
+            for ordinal, weight in list(self._lookup(postings, scores)):
+                del scores[ordinal]
+        return scores
+
+    def search(self, db, query, limit=50):
+        """Return the ids of the links that have all the terms in `query`,
+        at most `limit` of them, best first."""
+        return self.rank(db, tokenize(query), limit=limit)
+
+    def rank(self, db, required=(), optional=(), prohibited=(), limit=50):
+        """Return the ids of the links that have all the terms in
+        `required`, or if there are none at least one of those in
+        `optional`, and none of those in `prohibited`: at most `limit` of
+        them, or all of them if `limit` is None, best first. A link scores
+        the weight of each required and optional term in it, times how rare
+        the term is."""
+        if not required and not optional:
+            return []
+        generation = self.generation(db)
+        docs = max(self._state(db, 'search_docs'), 1)
+        def postings(terms):
+            return [self._postings(db, generation, term)
+                    for term in dict.fromkeys(terms)]
+        required, optional, prohibited = \
+            postings(required), postings(optional), postings(prohibited)
+        if [p for p in required if not p[0]]:
+            return []
+        optional = [p for p in optional if p[0]]
+        if not required and not optional:
+            return []
+        if limit is None:
+            limit = docs
+
+        # Of links that score the same, the most recently indexed first.
+        if len(required) + len(optional) == 1 and not prohibited:
+            # One term ranks its links by weight alone, and a common term
+            # has its best links ranked already.
+            ordinals, weights, top = (required or optional)[0]
+            if top and limit <= len(top):
+                ordinals = top[:limit]
+            else:
+                ordinals = [ordinal for weight, ordinal
+                            in heapq.nlargest(limit, izip(weights, ordinals))]
+        else:
+            scores = self._scores(required, optional, prohibited, docs)
+            ordinals = [ordinal for score, ordinal in heapq.nlargest(
+                limit, izip(scores.values(), scores.keys()))]
+        ids = {}
+        for i in range(0, len(ordinals), SQL_BATCH):
+            batch = ordinals[i:i + SQL_BATCH]
+            ids.update(db.execute('SELECT ordinal, id FROM search_docs WHERE '
+                                  'ordinal IN (%s)' % ','.join('?' * len(batch)),
+                                  batch).fetchall())
+        return [ids[ordinal] for ordinal in ordinals]
+
+    def score(self, db, link, terms):
+        """Return the score of a link for `terms`, worked out from the link
+        itself and how rare each term is, as rank() would score it."""
+        generation = self.generation(db)
+        docs = max(self._state(db, 'search_docs'), 1)
+        weights = linkTerms(link)
+        score = 0.0
+        for term in dict.fromkeys(terms):
+            if term in weights:
+                ordinals = self._postings(db, generation, term)[0]
+                score += weights[term] * \
+                    math.log(1.0 + float(docs) / max(len(ordinals), 1))
+        return score
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the simpy client. They run against a local stand-in for the
+simpy REST API, so no account or network access is needed.
+
+Usage:
+    python benchmark.py connections [calls]
+        Compares the per-call cost of the module level GET/POST functions
+        (a new opener, connection and auth handshake every call) with the
+        keep-alive ConnectionPool used by SimpyClient.
+
+    python benchmark.py parse [repeat]
+        Reports parse throughput in links/sec and MB/sec for generated
+        GetLinks responses of 1k, 10k and 100k links.
+
+    python benchmark.py memory [links]
+        Parses a generated GetLinks response and reports the parse time and
+        the memory held per Link object, including its fields and tags.
+"""
+
+import sys, time, threading, base64, random, gc
+import BaseHTTPServer, SocketServer
+import simpy
+
+USER, PASSWD = "bench", "secret"
+
+TAGS = ["read later", "have read", "starred", "python", "web", "music",
+        "recipes", "news", "reference", "tools"]
+
+
+def makeLinksXML(n, seed=0):
+    """Returns a GetLinks response with n generated links."""
+    rand = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<links>']
+    for i in range(n):
+        day = "2009-%02d-%02d" % (1 + i % 12, 1 + i % 28)
+        tags = "".join(["<tag>%s</tag>" % t for t in rand.sample(TAGS, 3)])
+        out.append('<link accessType="public"><url>http://example.com/%d/'
+                   'article?id=%d</url><modDate>%s 10:%02d</modDate>'
+                   '<addDate>%s 09:%02d</addDate><title>Example article '
+                   'number %d &amp; friends</title><nickname>%s</nickname>'
+                   '<tags>%s</tags><note>A *short* note about article %d, '
+                   'see [this](http://example.com/%d) too.</note></link>'
+                   % (i, i, day, i % 60, day, i % 60, i,
+                      i % 3 and "" or "nick %d" % i, tags, i, i))
+    out.append("</links>\n")
+    return "\n".join(out)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers like the simpy REST API, including the Basic auth challenge."""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1   # send each response in one go, as a real server would
+    links_xml = makeLinksXML(100)
+    void_xml = "<status><code>0</code><message>Done.</message></status>"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        expected = "Basic " + base64.b64encode(USER + ":" + PASSWD)
+        if self.headers.get("Authorization") != expected:
+            self.send_response(401)
+            self.send_header("WWW-Authenticate",
+                             'Basic realm="%s"' % simpy.REALM)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if simpy.GETLINKS_URL in self.path:
+            body = self.links_xml
+        elif simpy.GETTAGS_URL in self.path:
+            body = "<tags>%s</tags>" % "".join(
+                ['<tag name="%s" count="1"/>' % t for t in TAGS])
+        else:
+            body = self.void_xml
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def startStandIn():
+    """Starts a stand-in server on a free port in a background thread and
+    points the simpy module at it."""
+    server = StandInServer(("127.0.0.1", 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    host = "127.0.0.1:%d" % server.server_address[1]
+    simpy.BASE_URL = "http://" + host + simpy.REALM
+    simpy.HOST = host
+    return server
+
+
+def timeit(fn, calls):
+    start = time.time()
+    for i in range(calls):
+        fn(i)
+    return time.time() - start
+
+
+def report(name, calls, seconds):
+    print "%-40s %8.1f calls/sec %8.3f ms/call" % \
+        (name, calls / seconds, 1000.0 * seconds / calls)
+
+
+def benchConnections(calls=500):
+    server = startStandIn()
+    client = simpy.SimpyClient(USER, PASSWD)
+    link = simpy.Link(title=u"A title", url=u"http://example.com/",
+                      accessType=u"public", tags=[u"read later"])
+
+    def legacySave(i):
+        simpy.parseVoidResponse(simpy.POST(simpy.url(simpy.SAVELINK_URL),
+                                           USER, PASSWD, link.toPost()))
+    def legacyRename(i):
+        simpy.parseVoidResponse(simpy.POST(simpy.url(simpy.RENAMETAG_URL),
+                                           USER, PASSWD,
+                                           {'fromTag': u'a', 'toTag': u'b'}))
+    def legacyTags(i):
+        simpy.parseTags(simpy.GET(simpy.url(simpy.GETTAGS_URL),
+                                  USER, PASSWD, {'limit': '0'}))
+
+    print "%d calls each against %s" % (calls, simpy.BASE_URL)
+    report("saveLink, new connection per call", calls,
+           timeit(legacySave, calls))
+    report("saveLink, pooled", calls,
+           timeit(lambda i: client.saveLink(link), calls))
+    report("renameTag, new connection per call", calls,
+           timeit(legacyRename, calls))
+    report("renameTag, pooled", calls,
+           timeit(lambda i: client.renameTag(u'a', u'b'), calls))
+    report("getTags, new connection per call", calls,
+           timeit(legacyTags, calls))
+    report("getTags, pooled", calls,
+           timeit(lambda i: client.getTags(), calls))
+
+    # a burst of writes from several threads sharing one client
+    threads, per_thread = 4, calls / 4
+    def worker():
+        for i in range(per_thread):
+            client.saveLink(link)
+    start = time.time()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    report("saveLink, pooled, %d threads" % threads, threads * per_thread,
+           time.time() - start)
+    client.pool.close()
+    server.shutdown()
+
+
+def deepSize(objects):
+    """Returns the number of bytes held by 'objects' and everything they
+    refer to, counting objects shared between them only once."""
+    seen = {}
+    stack = list(objects)
+    total = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen[id(obj)] = obj
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, simpy.SimpyData):
+            if hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for name in cls.__dict__.get("__slots__", ()):
+                    if hasattr(obj, name):
+                        stack.append(getattr(obj, name))
+    return total
+
+
+def benchParse(repeat=3):
+    for n in (1000, 10000, 100000):
+        xml = makeLinksXML(n)
+        best = None
+        for i in range(repeat):
+            gc.collect()
+            start = time.time()
+            simpy.parseData(xml)
+            seconds = time.time() - start
+            if best is None or seconds < best: best = seconds
+        print "%7d links %6.1f MB %10.0f links/sec %6.2f MB/sec" % \
+            (n, len(xml) / 1048576.0, n / best, len(xml) / 1048576.0 / best)
+
+
+def benchMemory(links=100000):
+    xml = makeLinksXML(links)
+    gc.collect()
+    start = time.time()
+    parsed = simpy.parseData(xml)
+    seconds = time.time() - start
+    print "parsed %d links (%.1f MB) in %.2f sec, %.0f links/sec" % \
+        (len(parsed), len(xml) / 1048576.0, seconds, len(parsed) / seconds)
+    print "%.0f bytes per link" % (deepSize(parsed) / float(len(parsed)))
+
+
+BENCHMARKS = {'connections': benchConnections,
+              'parse': benchParse,
+              'memory': benchMemory}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print __doc__
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
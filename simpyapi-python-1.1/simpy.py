@@ -45,8 +45,10 @@ __author__ = "Benjamin Reitzammer <benjamin@nur-eine-i.de>"
 __version__ = "1.1"
 
 
-import urllib2, urllib, re, datetime, os
+import urllib2, urllib, urlparse, httplib, socket, base64, threading
+import re, datetime, os
 import xml.parsers.expat
+from StringIO import StringIO
 
 ### 
 ### set these to your own values if you know what you are doing 
@@ -72,6 +74,18 @@ REALM = "/simpy/api/rest"
 USER_AGENT = "Mozilla (compatible; simpyapi-python "+ __version__ +")"
 
 
+# the number of idle connections each SimpyClient keeps open per host
+POOL_SIZE = 4
+
+
+# socket timeout in seconds for requests made by SimpyClient
+TIMEOUT = 60
+
+
+# the number of bytes read from the socket at a time by streaming calls
+CHUNK_SIZE = 16384
+
+
 # the URLs of the specific API calls 
 GETLINKS_URL   = "/GetLinks.do"
 SAVELINK_URL   = "/SaveLink.do"
@@ -109,6 +123,7 @@ class SimpyClient:
           passwd - the password to use when authenticating against the API
         """
         self.user, self.passwd = user, passwd
+        self.pool = ConnectionPool(user, passwd)
         
         
     def getTags(self, limit=0):
@@ -121,7 +136,7 @@ class SimpyClient:
           A list of dictionaries that contain the values for 'count' and 'tag' 
           as returned by the call to the API, never <None>
         """
-        return parseTags( GET(url(GETTAGS_URL), self.user, self.passwd, {'limit': str(limit)}) )
+        return parseTags( self.pool.GET(url(GETTAGS_URL), {'limit': str(limit)}) )
         
     def removeTag(self, tag=None):
         """Makes a call to RemoveTag() of the simpy API, removing the specified tag
@@ -137,7 +152,7 @@ class SimpyClient:
         if tag is None: 
             return None
         else:
-            return parseVoidResponse( POST(url(REMOVETAG_URL), self.user, self.passwd, {'tag': tag}) )
+            return parseVoidResponse( self.pool.POST(url(REMOVETAG_URL), {'tag': tag}) )
         
     def renameTag(self, fromTag=None, toTag=None):
         """Makes a call to RenameTag() of the simpy API, renaming the fromTag to 
@@ -155,10 +170,8 @@ class SimpyClient:
         if fromTag is None or toTag is None: 
             return None
         else:
-            return parseVoidResponse( POST(url(RENAMETAG_URL), \
-                                           self.user, \
-                                           self.passwd, \
-                                           {'fromTag': fromTag, 'toTag': toTag}) )
+            return parseVoidResponse( self.pool.POST(url(RENAMETAG_URL), \
+                                                     {'fromTag': fromTag, 'toTag': toTag}) )
         
     def mergeTags(self, fromTag1=None, fromTag2=None, toTag=None):
         """Makes a call to MergeTags() of the simpy API, merging the fromTag1 
@@ -177,10 +190,8 @@ class SimpyClient:
         if fromTag1 is None or fromTag2 is None or toTag is None: 
             return None
         else:
-            return parseVoidResponse( POST(url(MERGETAGS_URL), \
-                                           self.user, \
-                                           self.passwd, \
-                                           {'fromTag1': fromTag1, 'fromTag2': fromTag2, 'toTag': toTag}) )
+            return parseVoidResponse( self.pool.POST(url(MERGETAGS_URL), \
+                                                     {'fromTag1': fromTag1, 'fromTag2': fromTag2, 'toTag': toTag}) )
         
     def splitTag(self, tag=None, toTag1=None, toTag2=None):
         """Makes a call to SplitTag() of the simpy API, splitting the tag specified 
@@ -199,10 +210,8 @@ class SimpyClient:
         if tag is None or toTag1 is None or toTag2 is None: 
             return None
         else:
-            return parseVoidResponse( POST(url(SPLITTAG_URL), \
-                                           self.user, \
-                                           self.passwd, \
-                                           {'tag': tag, 'toTag1': toTag1, 'toTag2': toTag2}) )
+            return parseVoidResponse( self.pool.POST(url(SPLITTAG_URL), \
+                                                     {'tag': tag, 'toTag1': toTag1, 'toTag2': toTag2}) )
         
     def getLinks(self, params={}):
         """Makes a call to GetLinks() of the simpy API  
@@ -228,7 +237,26 @@ class SimpyClient:
             A list of Link-objects, that's never <None>
         """
         if params is None: params = {}
-        return parseData( GET(url(GETLINKS_URL), self.user, self.passwd, params) )
+        return parseData( self.pool.GET(url(GETLINKS_URL), params) )
+
+    def iterLinks(self, params=None):
+        """Makes a call to GetLinks() of the simpy API, like getLinks(), but
+        parses the response while it is being downloaded.
+
+        Parameters:
+            params - the same as for getLinks()
+
+        Return:
+            A generator that yields each Link-object as soon as it has been
+            parsed
+        """
+        if params is None: params = {}
+        response = self.pool.open(url(GETLINKS_URL), params)
+        try:
+            for link in iterData(response):
+                yield link
+        finally:
+            response.close()
 
     def saveLink(self, link):
         """Makes a call to SaveLink() of the simpy API
@@ -241,7 +269,7 @@ class SimpyClient:
           unequal zero indicates an error.
         """
         if link._validate(): 
-            return parseVoidResponse( POST(url(SAVELINK_URL), self.user, self.passwd, link.toPost()) )
+            return parseVoidResponse( self.pool.POST(url(SAVELINK_URL), link.toPost()) )
         else: 
             raise ValidationError(link)     
         
@@ -260,7 +288,7 @@ class SimpyClient:
         if href is None : 
             raise ValidationError(href)     
         else: 
-            return parseVoidResponse( POST(url(DELETELINK_URL), self.user, self.passwd, {'href': href}) )
+            return parseVoidResponse( self.pool.POST(url(DELETELINK_URL), {'href': href}) )
         
     def getNotes(self, query='', limit=0):
         """Makes a call to GetNotes() of the simpy API
@@ -273,7 +301,7 @@ class SimpyClient:
             A list of Note-objects, or <None> if the 'query' provided is <None>
         """
         if query is None: query = ''
-        return parseData( GET(url(GETNOTES_URL), self.user, self.passwd, {'q': query, 'limit': str(limit)}) )
+        return parseData( self.pool.GET(url(GETNOTES_URL), {'q': query, 'limit': str(limit)}) )
         
     def saveNote(self, note):
         """Makes a call to SaveNote() of the simpy API
@@ -283,7 +311,7 @@ class SimpyClient:
           unequal zero indicates an error.
         """
         if note._validate():
-            return parseVoidResponse( POST(url(SAVENOTE_URL), self.user, self.passwd, note.toPost()) )
+            return parseVoidResponse( self.pool.POST(url(SAVENOTE_URL), note.toPost()) )
         else: 
             raise ValidationError(note)
 
@@ -297,7 +325,7 @@ class SimpyClient:
         if note is None or note.ident is None:
             raise ValidationError(note)
         else:
-            return parseVoidResponse( POST(url(DELETENOTE_URL), self.user, self.passwd, { 'noteId': note.ident }) )
+            return parseVoidResponse( self.pool.POST(url(DELETENOTE_URL), { 'noteId': note.ident }) )
 
 
     def getWatchlists(self):
@@ -305,7 +333,7 @@ class SimpyClient:
         
         Return:
         """
-        return parseWatchlists( GET(url(GETWATCHLISTS_URL), self.user, self.passwd) )
+        return parseWatchlists( self.pool.GET(url(GETWATCHLISTS_URL)) )
         
     def getWatchlist(self, watchlistId):
         """Makes a call to GetWatchlist() of the simpy API
@@ -314,7 +342,7 @@ class SimpyClient:
             A Watchlist object if the provided Id was a valid watchlist id, None
             otherwise
         """
-        arr = parseWatchlists( GET(url(GETWATCHLIST_URL), self.user, self.passwd, {'watchlistId': watchlistId}) )
+        arr = parseWatchlists( self.pool.GET(url(GETWATCHLIST_URL), {'watchlistId': watchlistId}) )
         if len(arr) > 0: return arr[0]
         else: None
         
@@ -353,37 +381,313 @@ class PostRedirectHandler(urllib2.HTTPRedirectHandler):
                                                                newurl)
         request.add_data(self.data)
         return request
-        
-        
+
+
+
+class ConnectionPool:
+    """A thread-safe pool of persistent HTTP/1.1 connections.
+
+    SimpyClient makes its calls through one of these, so that consecutive
+    calls reuse an open TCP connection instead of each building a new opener
+    and connecting again. The Basic auth header is sent with every request
+    rather than waiting to be challenged for it, which saves another round
+    trip per call. Like PostRedirectHandler, redirects are followed with the
+    same method and body.
+    """
+
+    MAX_REDIRECTS = 10
+
+    # Requests that can safely be sent twice. Only these are sent on an idle
+    # connection, which the server may have closed, and sent again on a new
+    # one if it has; any other request gets a new connection, so that it is
+    # never repeated after the server may have acted on it.
+    IDEMPOTENT = ("GET", "HEAD")
+
+    def __init__(self, user, passwd, size=POOL_SIZE, timeout=TIMEOUT):
+        """Create an instance of this class
+
+        Parameters:
+          user    - the username sent with every request
+          passwd  - the password sent with every request
+          size    - the number of idle connections kept open per host
+          timeout - the socket timeout of the connections in seconds
+        """
+        credentials = user +":"+ passwd
+        if isinstance(credentials, unicode):
+            credentials = credentials.encode("utf-8")
+        self.auth = "Basic "+ base64.b64encode(credentials)
+        self.size, self.timeout = size, timeout
+        self.idle = {}      # (scheme, host) -> list of idle connections
+        self.lock = threading.Lock()
+
+    def GET(self, url, params=None):
+        """Performs GET request on url, just like the GET() function.
+
+        Return:
+            Response body as string.
+        """
+        return self.open(url, params).read()
+
+    def POST(self, url, params):
+        """Performs a POST to the specified URL, just like the POST() function.
+
+        Return:
+            Response body as string.
+        """
+        return self.open(url, params, post=True).read()
+
+    def open(self, url, params=None, post=False):
+        """Makes a GET (or POST, if 'post' is true) request to url with the
+        given 'params'.
+
+        Return:
+            A PooledResponse, a file-like object for reading the response
+            body. Raises urllib2.HTTPError if the server answered with an
+            error status and urllib2.URLError if it couldn't be reached.
+        """
+        if params is None: params = {}
+        data = urlencode(params)
+        headers = {'User-Agent': USER_AGENT, 'Authorization': self.auth}
+        if post:
+            method, body = "POST", data
+            headers['Content-type'] = 'application/x-www-form-urlencoded; UTF-8'
+        else:
+            method, body = "GET", None
+            url = url +"?"+ data
+
+        for i in range(self.MAX_REDIRECTS):
+            key, conn, response = self._request(method, url, body, headers)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                response.read()
+                self._release(key, conn, response)
+                url = urlparse.urljoin(url, location)
+            elif response.status >= 400:
+                fp = StringIO(response.read())
+                self._release(key, conn, response)
+                raise urllib2.HTTPError(url, response.status, response.reason, \
+                                        response.msg, fp)
+            else:
+                return PooledResponse(self, key, conn, response)
+        raise urllib2.HTTPError(url, response.status, "Too many redirects", \
+                                response.msg, StringIO(""))
+
+    def _request(self, method, url, body, headers):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        if query: path = path +"?"+ query
+        key = (scheme, host)
+        if method in self.IDEMPOTENT: conn = self._acquire(key)
+        else: conn = None
+        while True:
+            fresh = conn is None
+            if fresh: conn = self._connect(key)
+            try:
+                conn.request(method, path, body, headers)
+                return key, conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if fresh: raise urllib2.URLError(e)
+                # the server dropped the idle connection, try a new one
+                conn = None
+
+    def _connect(self, key):
+        scheme, host = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _acquire(self, key):
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key)
+            if idle: return idle.pop()
+            else: return None
+        finally:
+            self.lock.release()
+
+    def _release(self, key, conn, response):
+        """Puts conn back in the pool, once 'response' has been read."""
+        if not response.will_close:
+            self.lock.acquire()
+            try:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    return
+            finally:
+                self.lock.release()
+        conn.close()
+
+    def close(self):
+        """Closes all idle connections."""
+        self.lock.acquire()
+        try:
+            for idle in self.idle.values():
+                for conn in idle: conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+
+
+class PooledResponse:
+    """The file-like response of a ConnectionPool request. The connection is
+    returned to the pool once the body has been read to the end.
+    """
+    def __init__(self, pool, key, conn, response):
+        self.pool, self.key, self.conn, self.response = pool, key, conn, response
+
+    def read(self, amt=None):
+        if self.conn is None:
+            return ""
+        if amt is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(amt)
+        if self.response.isclosed():
+            self.pool._release(self.key, self.conn, self.response)
+            self.conn = None
+        return data
+
+    def close(self):
+        """Discards the rest of the response, closing the connection if it
+        hasn't been read to the end."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
 
 ##
 ## Data holding classes
 ##
         
-class SimpyData(dict):
+class SimpyData(object):
     """Base class that provides nice utility methods for data holding classes
+
+    Subclasses name their fields and defaults in 'args' and declare them in 
+    __slots__, so that instances don't each carry a dictionary. Fields can be
+    read as attributes, or by key like the dictionaries these used to be:
+    instances still have the mapping methods of a dict and compare equal to
+    a dict of the same fields, although isinstance(data, dict) is false.
+    Like dicts they can't be hashed.
     """
+    __slots__ = ()
+    args = {}
+    __hash__ = None
+
     def __init__(self, **kw):
-        for k, v in self.args.iteritems(): self[k] = v            
-        dict.__init__(self, kw)
-        self.__dict__ = self
+        for k, v in self.args.iteritems(): 
+            setattr(self, k, kw.pop(k, v))
+        if kw: 
+            raise TypeError("unknown fields: %s" % ", ".join(kw.keys()))
+        
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.args: raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.args
+
+    def __iter__(self):
+        return iter(self.args)
+
+    def get(self, key, default=None):
+        if key in self.args: return getattr(self, key)
+        else: return default
+
+    def __len__(self):
+        return len(self.args)
+
+    def __eq__(self, other):
+        if isinstance(other, (SimpyData, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented: return equal
+        return not equal
+
+    def has_key(self, key):
+        return key in self.args
+
+    def keys(self):
+        return self.args.keys()
+
+    def values(self):
+        return [getattr(self, k) for k in self.args]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.args]
+
+    def iterkeys(self):
+        return iter(self.args)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self, other=(), **kw):
+        if hasattr(other, "keys"): other = [(k, other[k]) for k in other.keys()]
+        for k, v in list(other) + kw.items():
+            self[k] = v
+
+    def copy(self):
+        """Returns the fields in a new dict, as dict.copy() did."""
+        return dict(self.items())
         
     def __str__(self):
-        state = ["%s=%r" % (attribute, value) for (attribute, value) in self.__dict__.items()]
+        state = ["%s=%r" % (attribute, value) for (attribute, value) in self.items()]
         return "\n".join(state).encode("utf-8") +"\n"     
         
     def acc(self):
         if self.accessType == "public": return 1
         else: return 0
+
+
+
+_EXPLICIT = object()
+
+def _lazyDate(strField, slot):
+    """Returns a property for a date that is parsed from the string field
+    'strField' when it is first read, and cached in 'slot' together with the
+    string it was parsed from. A date assigned explicitly is kept as it is;
+    assigning None makes it follow 'strField' again.
+    """
+    def get(self):
+        source = getattr(self, strField)
+        cached = getattr(self, slot)
+        if cached is None or (cached[0] is not _EXPLICIT and cached[0] != source):
+            cached = (source, parseSimpyDate(source))
+            setattr(self, slot, cached)
+        return cached[1]
+    def set(self, date):
+        if date is None: setattr(self, slot, None)
+        else: setattr(self, slot, (_EXPLICIT, date))
+    return property(get, set)
         
 
         
 class Link(SimpyData):
     """Data holder class for links 
     """
+    __slots__ = ('title', 'url', 'note', 'nickname', 'accessType', \
+                 'addDateStr', 'tags', 'modDateStr', '_addDate', '_modDate')
     args = {'title':'', 'url':'', 'note':'', 'nickname':'', \
             'accessType':'', 'addDateStr':'', 'tags':None, \
             'modDateStr':'', 'addDate':None, 'modDate':None}
+    addDate = _lazyDate('addDateStr', '_addDate')
+    modDate = _lazyDate('modDateStr', '_modDate')
             
     def __init__(self, **kw):
         SimpyData.__init__(self, **kw)
@@ -398,7 +702,7 @@ class Link(SimpyData):
             'note': self.note, 
             'urlNickname': self.nickname, 
             'tags': ','.join(self.tags),
-            'accessType': self.acc()
+            'accessType': str(self.acc())
         }
         
     def _validate(self):
@@ -411,9 +715,14 @@ class Link(SimpyData):
 class Note(SimpyData):
     """Data holder class for notes
     """
+    __slots__ = ('title', 'uri', 'description', 'nickname', 'ident', \
+                 'accessType', 'addDateStr', 'tags', 'modDateStr', \
+                 '_addDate', '_modDate')
     args = {'title':'', 'uri':'', 'description':'', 'nickname':'', 'ident': '', \
             'accessType':'', 'addDateStr':'', 'tags':None, \
             'modDateStr':'', 'addDate':None, 'modDate':None}
+    addDate = _lazyDate('addDateStr', '_addDate')
+    modDate = _lazyDate('modDateStr', '_modDate')
             
     def __init__(self, **kw):
         SimpyData.__init__(self, **kw)
@@ -440,6 +749,8 @@ class Note(SimpyData):
 class Watchlist(SimpyData):
     """Data holder class for a watchlist
     """
+    __slots__ = ('identifier', 'name', 'description', 'newLinks', 'users', \
+                 'filters', 'addDate')
     args = {'identifier':'', 'name':'', 'description':'', 'newLinks':'', \
             'users': None, 'filters': None, 'addDate': None }
             
@@ -541,6 +852,16 @@ def parseSimpyDate(dateStr):
 
 
 
+_tags = {}
+
+def internTag(tag):
+    """Returns the one shared copy of the string 'tag', so that links with the
+    same tags don't each hold their own copies of them.
+    """
+    return _tags.setdefault(tag, tag)
+
+
+
 def parseTags(string):
     """Parses a response of the GetTags() call to the simpy API.
     
@@ -588,41 +909,95 @@ def parseData(string):
     """Parse a list of <link> or <note> elements into a list of corresponding objects.
     """
     data = []
+    _dataParser(data).Parse(string, True)
+    return data
+
+
+
+def iterData(stream, chunksize=CHUNK_SIZE):
+    """Parse a list of <link> or <note> elements read from the file-like object
+    'stream', 'chunksize' bytes at a time.
+
+    Return:
+      A generator that yields each object as soon as its closing tag has been
+      parsed, so the whole document never has to be held in memory.
+    """
+    done = []
+    parser = _dataParser(done)
+    while True:
+        chunk = stream.read(chunksize)
+        parser.Parse(chunk, not chunk)
+        for obj in done:
+            yield obj
+        del done[:]
+        if not chunk:
+            break
+
+
+
+def _appendText(field):
+    """Returns a function that appends text to 'field' of an object."""
+    def append(obj, text):
+        if text: setattr(obj, field, getattr(obj, field) + text)
+    return append
+
+def _appendTag(obj, text):
+    obj.tags.append( internTag(text) )
+
+def _appendLinkNote(obj, text):
+    if isinstance(obj, Link) and text: obj.note += text
+
+# What to do with the text of the elements inside a <link> or <note>, keyed 
+# by element name.
+TEXT_HANDLERS = {
+    "title":       _appendText("title"),
+    "url":         _appendText("url"),
+    "uri":         _appendText("uri"),
+    "id":          _appendText("ident"),
+    "nickname":    _appendText("nickname"),
+    "tag":         _appendTag,
+    "addDate":     _appendText("addDateStr"),
+    "modDate":     _appendText("modDateStr"),
+    "description": _appendText("description"),
+    "note":        _appendLinkNote,
+}
+
+def _dataParser(done):
+    """Creates the expat parser used by parseData() and iterData(). Each
+    <link> or <note> is appended to the list 'done' once it has been parsed.
+
+    Character data goes straight into a list of chunks, which is emptied when
+    an element with a TEXT_HANDLERS entry starts and handed to that entry in
+    one piece when it ends.
+    """
+    data = []       # the object being parsed
     tagstack = []
+    chunks = []     # the text since the current element started
+    handler = []    # the TEXT_HANDLERS entry of the current element, if any
     def start_element(name, attrs):
-        if name == "tag":
-            data[-1].tags.append("")
-        elif name == "link":
+        if name == "link":
             data.append( Link( accessType=attrs['accessType'] ) )
         elif name == "note" and tagstack[-1] == "notes":    # be sure we are parsing notes
             data.append( Note( accessType=attrs['accessType'] ) )
+        elif name in TEXT_HANDLERS and data:
+            handler.append( TEXT_HANDLERS[name] )
+            del chunks[:]
             
         tagstack.append(name)
         
     def end_element(name):
         tagstack.pop()
-        if name == "modDate": data[-1].modDate = parseSimpyDate(data[-1].modDateStr)
-        elif name == "addDate": data[-1].addDate = parseSimpyDate(data[-1].addDateStr)
-        
-    def char_data(chardata):
-        if tagstack[-1] == "title":         data[-1].title       += chardata
-        elif tagstack[-1] == "url":         data[-1].url         += chardata
-        elif tagstack[-1] == "uri":         data[-1].uri         += chardata
-        elif tagstack[-1] == "id":          data[-1].ident       += chardata
-        elif tagstack[-1] == "nickname":    data[-1].nickname    += chardata
-        elif tagstack[-1] == "tag":         data[-1].tags[-1]    += chardata       
-        elif tagstack[-1] == "addDate":     data[-1].addDateStr  += chardata       
-        elif tagstack[-1] == "modDate":     data[-1].modDateStr  += chardata       
-        elif tagstack[-1] == "description": data[-1].description += chardata       
-        elif tagstack[-1] == "note" and isinstance(data[-1], Link):
-            data[-1].note += chardata
+        if handler:
+            handler.pop()(data[-1], "".join(chunks))
+        elif name == "link" or (name == "note" and tagstack and tagstack[-1] == "notes"):
+            done.append( data.pop() )
         
     parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
     parser.StartElementHandler = start_element
     parser.EndElementHandler = end_element
-    parser.CharacterDataHandler = char_data
-    parser.Parse( string )
-    return data    
+    parser.CharacterDataHandler = chunks.append
+    return parser
     
 
 
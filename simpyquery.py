@@ -0,0 +1,187 @@
+"""Simpy's query syntax, answered against the local store.
+
+A query is a list of terms separated by spaces. A term is a word or a
+"quoted phrase", which may be put after a field name and a colon to look for
+it in that field alone: tags:python, title:"read later". Without a field a
+term is looked for in the title, nickname, tags, url and note of a link. A
+tags: term is a whole tag; any other term matches its words, in order,
+anywhere in the field.
+
+A term starting with + must match and one starting with - must not. The
+other terms are optional: if a query has no + terms a link must match at
+least one of them, and otherwise they only count towards how well it
+matches. A query of - terms alone matches every link that has none of them.
+
+Query works out whether one link matches, and what the tag index and the
+search index can be asked for instead of looking at every link; LinkStore
+plans a query with it.
+"""
+import re
+from search import tokenize, FIELD_WEIGHTS
+import tagindex
+
+# The fields a term can name, besides tags.
+TEXT_FIELDS = ('title', 'nickname', 'note', 'url')
+
+TERM_RE = re.compile(r'([+-]?)(?:([A-Za-z]+):)?(?:"([^"]*)"?|([^\s"]+))')
+
+REQUIRED, PROHIBITED, OPTIONAL = '+', '-', ''
+
+def parse(text):
+    """Return the terms of a query as (sign, field, value) tuples, where
+    sign is REQUIRED, PROHIBITED or OPTIONAL and field is None if the term
+    didn't name a known one."""
+    terms = []
+    for match in TERM_RE.finditer(text):
+        sign, field, phrase, word = match.groups()
+        if field is not None and field.lower() not in TEXT_FIELDS + ('tags',):
+            # Not a field, just a word with a colon in it.
+            value = field + ':' + (phrase is None and word or phrase)
+            field = None
+        else:
+            value = phrase is None and word or phrase
+            if field is not None:
+                field = field.lower()
+        if value:
+            terms.append((sign, field, value))
+    return terms
+
+def _contains(words, phrase):
+    """Return whether the list `phrase` appears in the list `words`."""
+    if not phrase:
+        return False
+    n = len(phrase)
+    first = phrase[0]
+    for i in range(len(words) - n + 1):
+        if words[i] == first and words[i:i + n] == phrase:
+            return True
+    return False
+
+class Query:
+    """A parsed simpy query."""
+
+    def __init__(self, text):
+        self.text = text
+        self.terms = parse(text)
+        self.required = [term for term in self.terms if term[0] == REQUIRED]
+        self.prohibited = [term for term in self.terms
+                           if term[0] == PROHIBITED]
+        self.optional = [term for term in self.terms if term[0] == OPTIONAL]
+        # The words of each term that isn't a tag, which is what a link's
+        # fields are tokenized to for matching it.
+        self.words = dict([(term, tokenize(term[2])) for term in self.terms
+                           if term[1] != 'tags'])
+
+    def isEmpty(self):
+        return not self.terms
+
+    def _termMatches(self, term, link, fields):
+        sign, field, value = term
+        if field == 'tags':
+            return value in link.tags
+        words = self.words[term]
+        if field is not None:
+            return _contains(fields[field], words)
+        for field, weight in FIELD_WEIGHTS:
+            if _contains(fields[field], words):
+                return True
+        return False
+
+    def matches(self, link):
+        """Return whether a link matches the query, working it out from the
+        link alone."""
+        if not self.terms:
+            return False
+        fields = {}
+        for field, weight in FIELD_WEIGHTS:
+            if field == 'tags':
+                fields[field] = tokenize(u' '.join(link.tags))
+            else:
+                fields[field] = tokenize(link[field])
+        for term in self.required:
+            if not self._termMatches(term, link, fields):
+                return False
+        for term in self.prohibited:
+            if self._termMatches(term, link, fields):
+                return False
+        if self.optional and not self.required:
+            for term in self.optional:
+                if self._termMatches(term, link, fields):
+                    return True
+            return False
+        return True
+
+    def _tagTerms(self, terms):
+        return [(tagindex.TAG, term[2]) for term in terms
+                if term[1] == 'tags']
+
+    def tagExpression(self):
+        """Return the tag expression (see tagindex) that the query is, if it
+        has only tags: terms, or else None."""
+        if not self.terms or [term for term in self.terms
+                              if term[1] != 'tags']:
+            return None
+        expression = (tagindex.AND,) + tuple(self._tagTerms(self.required))
+        if self.optional and not self.required:
+            expression += ((tagindex.OR,) +
+                           tuple(self._tagTerms(self.optional)),)
+        return expression + tuple([(tagindex.NOT, term) for term
+                                   in self._tagTerms(self.prohibited)])
+
+    def requiredTagExpression(self):
+        """Return a tag expression for the links that have the tags the
+        query asks for with + and - terms, which every link that matches it
+        does, or None if it has no + tags: terms."""
+        required = self._tagTerms(self.required)
+        if not required:
+            return None
+        return (tagindex.AND,) + tuple(required) + \
+            tuple([(tagindex.NOT, term)
+                   for term in self._tagTerms(self.prohibited)])
+
+    def searchTerms(self):
+        """Return the words of the query as the search index's terms
+        (required, optional, prohibited), if the index can answer the query
+        by itself: when every term is one word looked for in any field, and
+        there is at least one + or optional term. Otherwise None."""
+        if [term for term in self.terms if term[1] is not None or
+            len(self.words[term]) != 1]:
+            return None
+        if not self.required and not self.optional:
+            return None
+        return tuple([[self.words[term][0] for term in terms]
+                      for terms in (self.required, self.optional,
+                                    self.prohibited)])
+
+    def candidateTerms(self):
+        """Return the search index terms (required, optional) for the links
+        that could match the query, to narrow down the links to look at: the
+        words of its + terms, all of which a matching link has, or if it has
+        only optional terms their words, one of which a matching link has
+        unless it matches optionalTagExpression(). Returns None if the index
+        can't narrow the query down."""
+        required = [word for term in self.required if term[1] != 'tags'
+                    for word in self.words[term]]
+        if required:
+            return required, []
+        if self.required or not self.optional:
+            return None
+        # Any one word of a phrase will do to find the links with it, and a
+        # term with no words matches no link.
+        return [], [self.words[term][0] for term in self.optional
+                    if term[1] != 'tags' and self.words[term]]
+
+    def optionalTagExpression(self):
+        """Return a tag expression for the links that have any of the tags
+        in optional tags: terms, if the query has only optional terms and
+        some of those are tags, or else None."""
+        tags = self._tagTerms(self.optional)
+        if self.required or not tags:
+            return None
+        return (tagindex.OR,) + tuple(tags)
+
+    def rankTerms(self):
+        """Return the words of the + and optional terms, which a link that
+        matches scores for."""
+        return [word for term in self.required + self.optional
+                if term[1] != 'tags' for word in self.words[term]]
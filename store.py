@@ -0,0 +1,622 @@
+"""A local copy of the links in the simpy account.
+
+The links are kept in an SQLite database so that page views can be served
+without a round trip to simpy. LinkStore.sync() keeps the copy current: the
+first sync downloads the whole account, later ones only ask simpy for the
+links that were added or modified since the last one. Links are written to
+the database as they are parsed from the download.
+
+Given a Summarizer, the store also keeps a summary of each note with its
+link, made once for each version of the note. Given a SearchIndex or a
+TagIndex it keeps those up to date with the links. Queries in simpy's
+syntax are answered from the stored links, using the indexes where they
+can.
+"""
+import datetime, time, threading, sqlite3
+from itertools import islice, ifilter
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from simpy import Link, internTag, parseSimpyDate
+from cache import LRUCache
+import tagindex
+from linkindex import SQL_BATCH, getState, setState
+from simpyquery import Query
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    id TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    nickname TEXT NOT NULL DEFAULT '',
+    note TEXT NOT NULL DEFAULT '',
+    accessType TEXT NOT NULL DEFAULT '',
+    tags TEXT NOT NULL DEFAULT '',
+    addDate TEXT NOT NULL DEFAULT '',
+    modDate TEXT NOT NULL DEFAULT '',
+    seen INTEGER NOT NULL DEFAULT 0,
+    excerpt_text TEXT NOT NULL DEFAULT '',
+    excerpt_html TEXT NOT NULL DEFAULT '',
+    word_count INTEGER NOT NULL DEFAULT 0,
+    summary_version TEXT NOT NULL DEFAULT '',
+    permalink_id TEXT NOT NULL DEFAULT '',
+    indexed INTEGER NOT NULL DEFAULT 0,
+    tagged INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS links_newest ON links (addDate, id);
+CREATE TABLE IF NOT EXISTS link_tags (
+    id TEXT NOT NULL,
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS link_tags_tag ON link_tags (tag, id);
+CREATE INDEX IF NOT EXISTS link_tags_id ON link_tags (id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Don't ask simpy for changes more often than this (seconds).
+SYNC_INTERVAL = 60
+
+# The afterDate parameter of GetLinks only looks at the date a link was
+# added, so edits to old links (a tag added or taken off) and deletions
+# can't be seen by a delta sync; only downloading the whole account again
+# catches them. That takes longer the bigger the account is, so it is meant
+# to be done out of the way of page views, every few minutes, by calling
+# sync(full=True) from a scheduled job. A sync that hasn't had a full one
+# for this long (seconds) does one itself, in case there is no such job.
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+# How long a connection waits for another one to finish writing to the
+# database before giving up (seconds).
+DB_TIMEOUT = 30
+
+LINK_FIELDS = ('id', 'url', 'title', 'nickname', 'note', 'accessType',
+               'tags', 'addDate', 'modDate')
+
+# Columns added to the links table since it was first created, which older
+# databases are given when they are opened.
+ADDED_COLUMNS = (('excerpt_text', "TEXT NOT NULL DEFAULT ''"),
+                 ('excerpt_html', "TEXT NOT NULL DEFAULT ''"),
+                 ('word_count', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('summary_version', "TEXT NOT NULL DEFAULT ''"),
+                 ('permalink_id', "TEXT NOT NULL DEFAULT ''"),
+                 ('indexed', 'INTEGER NOT NULL DEFAULT 0'),
+                 ('tagged', 'INTEGER NOT NULL DEFAULT 0'))
+
+# Indexes on added columns, which can only be made once they are there, and
+# indexes that have been replaced.
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS links_permalink_id ON links (permalink_id);
+DROP INDEX IF EXISTS links_addDate;
+"""
+
+# The order links are listed in, newest first. Links added on the same day
+# are in the order of their ids, so that the order is always the same.
+NEWEST_FIRST = 'addDate DESC, id DESC'
+
+def newestFirst(link):
+    """The key to sort links by for NEWEST_FIRST, with reverse=True."""
+    return link.addDateStr, link.id
+
+# How many notes to summarize at a time.
+SUMMARY_BATCH = 500
+
+# When the links wanted from the tag index are more than this share of all
+# the links, they are found by reading through all of them rather than
+# looked up SQL_BATCH at a time.
+SCAN_FRACTION = 0.25
+
+# The stored links with their ordinals in the tag index.
+TAGGED_SQL = 'SELECT tag_docs.ordinal AS ordinal, links.* FROM links ' \
+             'JOIN tag_docs ON tag_docs.id = links.id'
+
+def linkId(url):
+    """Return the key a link is stored under, a hash of its url."""
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return sha1(url).hexdigest()
+
+def permalink(url):
+    """Return the url without its query string."""
+    i = url.find('?')
+    if i == -1:
+        return url
+    return url[:i]
+
+def permalinkId(url):
+    """Return the hash of the permalink of a url, which the links sharing
+    that permalink can also be found by."""
+    return linkId(permalink(url))
+
+class StoredLink(Link):
+    """A simpy Link as kept in the store, with its id and the summary of its
+    note."""
+    __slots__ = ('id', 'excerptText', 'excerptHtml', 'wordCount')
+    args = dict(Link.args, id='', excerptText='', excerptHtml='',
+                wordCount=0)
+
+def rowToLink(row):
+    """Turn a row of the links table back into a StoredLink."""
+    if row['tags']:
+        tags = [internTag(tag) for tag in row['tags'].split(',')]
+    else:
+        tags = []
+    return StoredLink(title=row['title'], url=row['url'], note=row['note'],
+                      nickname=row['nickname'], accessType=row['accessType'],
+                      tags=tags, addDateStr=row['addDate'],
+                      modDateStr=row['modDate'], id=row['id'],
+                      excerptText=row['excerpt_text'],
+                      excerptHtml=row['excerpt_html'],
+                      wordCount=row['word_count'])
+
+class LinkStore:
+    """The links of one simpy account, stored in an SQLite database.
+
+    If `query` is given only the links matching it (a simpy search string)
+    are downloaded and kept. If `summarizer` is given, a
+    summary.Summarizer, the notes are summarized as they are stored. If
+    `searchIndex` is given, a search.SearchIndex, the links are indexed for
+    searching, and if `tagIndex` is given, a tagindex.TagIndex, their tags
+    are indexed."""
+
+    def __init__(self, path, query=None, summarizer=None,
+                 link_cache_size=1000, searchIndex=None, tagIndex=None):
+        self.path = path
+        self.query = query
+        self.summarizer = summarizer
+        self.searchIndex = searchIndex
+        self.tagIndex = tagIndex
+        # Links looked up by link(), keyed by the store version and the id
+        # they were asked for.
+        self._link_cache = LRUCache(link_cache_size)
+        self._local = threading.local()
+        db = self._db()
+        db.executescript(SCHEMA)
+        columns = [row[1] for row in db.execute('PRAGMA table_info(links)')]
+        for name, definition in ADDED_COLUMNS:
+            if name not in columns:
+                db.execute('ALTER TABLE links ADD COLUMN %s %s'
+                           % (name, definition))
+        if 'permalink_id' not in columns:
+            db.executemany('UPDATE links SET permalink_id = ? WHERE id = ?',
+                           [(permalinkId(row[1]), row[0]) for row
+                            in db.execute('SELECT id, url FROM links')])
+        db.executescript(ADDED_INDEXES)
+        if searchIndex is not None:
+            searchIndex.createTables(db)
+            # A new index starts with the links already stored; after that
+            # each sync indexes the links it writes.
+            if self.getState('search_generation') is None:
+                searchIndex.update(db, rowToLink)
+        if tagIndex is not None:
+            tagIndex.createTables(db)
+            if self.getState('tag_generation') is None:
+                tagIndex.update(db)
+        # A new summarizer makes new summaries for every link straight away,
+        # rather than at the next sync.
+        if summarizer is not None and \
+           self.getState('summary_version') != summarizer.version:
+            if self._summarize(db):
+                setState(db, 'version', self.version() + 1)
+        db.commit()
+
+    def _db(self):
+        """Return this thread's connection to the database."""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=DB_TIMEOUT)
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def getState(self, key, default=None):
+        return getState(self._db(), key, default)
+
+    def setState(self, key, value):
+        """Keep `value`, a string, under `key` for getState(), for whatever
+        is worked out from the links and is worth sharing with other
+        processes. It isn't kept if a sync is writing to the store, rather
+        than waiting for it. Returns whether it was kept."""
+        db = self._db()
+        if not self._beginWrite(db, False):
+            return False
+        try:
+            setState(db, key, value)
+        except:
+            db.rollback()
+            raise
+        db.commit()
+        return True
+
+    def isEmpty(self):
+        return self.getState('last_sync') is None
+
+    def version(self):
+        """Return a number that changes whenever the stored links do."""
+        return int(self.getState('version', 0))
+
+    def links(self, include=(), exclude=()):
+        """Return the stored links, newest first, as simpy Link objects.
+
+        Only links that have all the tags in `include` and none of the tags
+        in `exclude` are returned."""
+        if self.tagIndex is not None and (include or exclude):
+            return self.tagged(tagindex.tagExpression(include, exclude))
+        sql = 'SELECT * FROM links'
+        where, args = [], []
+        for tag in include:
+            where.append('id IN (SELECT id FROM link_tags WHERE tag = ?)')
+            args.append(tag)
+        for tag in exclude:
+            where.append('id NOT IN (SELECT id FROM link_tags WHERE tag = ?)')
+            args.append(tag)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + NEWEST_FIRST
+        return [rowToLink(row) for row in self._db().execute(sql, args)]
+
+    def iterLinks(self):
+        """Return an iterator over the stored links, newest first, reading
+        them from the database as they are asked for."""
+        for row in self._db().execute('SELECT * FROM links ORDER BY ' +
+                                      NEWEST_FIRST):
+            yield rowToLink(row)
+
+    def tagged(self, expression, limit=None):
+        """Return the stored links that match a tag expression (see
+        tagindex), newest first: at most `limit` of them, or all of them if
+        `limit` is None."""
+        if limit is not None and self.tagIndex is not None:
+            db = self._db()
+            wanted = dict.fromkeys(tagindex.ordinals(
+                self.tagIndex.evaluate(db, expression)))
+            # Reading the newest links until enough of them match takes
+            # about limit * links / len(wanted) rows, and looking them all up
+            # takes len(wanted).
+            if wanted and limit * self.tagIndex.linkCount(db) < \
+               len(wanted) ** 2:
+                links = []
+                for row in db.execute(TAGGED_SQL + ' ORDER BY links.addDate '
+                                      'DESC, links.id DESC'):
+                    if len(links) == limit:
+                        break
+                    if row[0] in wanted:
+                        links.append(rowToLink(row))
+                return links
+        return self.partition({None: expression})[None][:limit]
+
+    def partition(self, expressions):
+        """Sort the stored links into views, given a dictionary of tag
+        expressions keyed by view name. Returns a dictionary of lists of
+        links, newest first, keyed by the same names; a link can be in more
+        than one view.
+
+        With a tag index the views are worked out from the bitmaps of their
+        tags, and only the links in at least one of them are read, each of
+        them once."""
+        if not expressions:
+            return {}
+        if self.tagIndex is None:
+            views = dict([(name, []) for name in expressions])
+            for link in self.links():
+                for name, expression in expressions.items():
+                    if tagindex.matches(expression, link.tags):
+                        views[name].append(link)
+            return views
+        db = self._db()
+        ordinals = dict([(name, tagindex.ordinals(
+                            self.tagIndex.evaluate(db, expression)))
+                         for name, expression in expressions.items()])
+        wanted = {}
+        for view in ordinals.values():
+            wanted.update(dict.fromkeys(view))
+        sql = TAGGED_SQL
+        if len(wanted) > SCAN_FRACTION * self.tagIndex.linkCount(db):
+            rows = [row for row in db.execute(sql) if row[0] in wanted]
+        else:
+            rows = []
+            batches = wanted.keys()
+            for i in range(0, len(batches), SQL_BATCH):
+                batch = batches[i:i + SQL_BATCH]
+                rows.extend(db.execute(sql + ' WHERE tag_docs.ordinal IN (%s)'
+                                       % ','.join('?' * len(batch)), batch))
+        for row in rows:
+            wanted[row[0]] = rowToLink(row)
+        # Newest first, as links() gives them.
+        newest = sorted(rows, key=lambda row: (row['addDate'], row['id']),
+                        reverse=True)
+        rank = dict([(row[0], i) for i, row in enumerate(newest)])
+        return dict([(name, [wanted[ordinal] for ordinal
+                             in sorted(view, key=rank.__getitem__)])
+                     for name, view in ordinals.items()])
+
+    def tagCounts(self):
+        """Return how many of the stored links each tag has, most used
+        first, as a list of dictionaries with the 'tag' and the 'count', as
+        SimpyClient.getTags() gives them. Unless the store was made with a
+        `query` these are the counts for the whole account."""
+        if self.tagIndex is not None:
+            return self.tagIndex.counts(self._db())
+        return [{'tag': tag, 'count': count} for tag, count
+                in self._db().execute('SELECT tag, count(*) AS n '
+                                      'FROM link_tags GROUP BY tag '
+                                      'ORDER BY n DESC, tag')]
+
+    def completeTag(self, prefix, limit=10):
+        """Return the counts, as tagCounts() gives them, of the most used
+        tags that begin with `prefix`, ignoring case: at most `limit` of
+        them."""
+        if self.tagIndex is not None:
+            return self.tagIndex.complete(self._db(), prefix, limit)
+        prefix = prefix.lower()
+        return [item for item in self.tagCounts()
+                if item['tag'].lower().startswith(prefix)][:limit]
+
+    def link(self, id):
+        """Return the stored link whose id is `id`, or else the newest one
+        whose permalink has that id, or None."""
+        key = (self.version(), id)
+        link = self._link_cache.get(key)
+        if link is not None:
+            return link
+        db = self._db()
+        row = db.execute('SELECT * FROM links WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            row = db.execute('SELECT * FROM links WHERE permalink_id = ? '
+                             'ORDER BY ' + NEWEST_FIRST + ' LIMIT 1',
+                             (id,)).fetchone()
+        if row is None:
+            return None
+        link = rowToLink(row)
+        self._link_cache.set(key, link)
+        return link
+
+    def _linksById(self, ids):
+        """Return the stored links with `ids`, in the same order."""
+        db = self._db()
+        links = {}
+        for i in range(0, len(ids), SQL_BATCH):
+            batch = ids[i:i + SQL_BATCH]
+            links.update([(row['id'], rowToLink(row)) for row in db.execute(
+                'SELECT * FROM links WHERE id IN (%s)'
+                % ','.join('?' * len(batch)), batch)])
+        return [links[id] for id in ids]
+
+    def search(self, text, limit=None):
+        """Return the stored links that match `text`, a simpy query (see
+        simpyquery): at most `limit` of them, or all of them if `limit` is
+        None. If the query has words the links are ranked by them, best
+        first, and otherwise they are newest first.
+
+        A query on tags alone is answered from the tag index, and one on
+        words alone from the search index. Any other query looks at the
+        links that one of the indexes says could match it, or failing that
+        at every link."""
+        query = Query(text)
+        if query.isEmpty():
+            return []
+        db = self._db()
+        expression = query.tagExpression()
+        if expression is not None and self.tagIndex is not None:
+            return self.tagged(expression, limit)
+        terms = query.searchTerms()
+        if terms is not None and self.searchIndex is not None:
+            required, optional, prohibited = terms
+            return self._linksById(self.searchIndex.rank(
+                db, required, optional, prohibited, limit))
+
+        links = self._candidates(db, query)
+        words = self.searchIndex is not None and query.rankTerms()
+        if links is None and not words and limit is not None:
+            # Newest first, so only as many links are read as it takes to
+            # find enough that match.
+            return list(islice(ifilter(query.matches, self.iterLinks()),
+                               limit))
+        if links is None:
+            links = self.links()
+        links = [link for link in links if query.matches(link)]
+        links.sort(key=newestFirst, reverse=True)
+        if words:
+            scores = dict([(link.id, self.searchIndex.score(db, link, words))
+                           for link in links])
+            links.sort(key=lambda link: scores[link.id], reverse=True)
+        return links[:limit]
+
+    def _candidates(self, db, query):
+        """Return the links that could match a query going by the indexes,
+        for search() to look at, or None if they can't narrow it down."""
+        terms = query.candidateTerms()
+        tags = query.optionalTagExpression()
+        if terms is not None and self.searchIndex is not None and \
+           (tags is None or self.tagIndex is not None):
+            required, optional = terms
+            links = self._linksById(self.searchIndex.rank(
+                db, required, optional, limit=None))
+            if tags is not None:
+                ids = dict.fromkeys([link.id for link in links])
+                links.extend([link for link in self.tagged(tags)
+                              if link.id not in ids])
+            return links
+        expression = query.requiredTagExpression()
+        if expression is not None and self.tagIndex is not None:
+            return self.tagged(expression)
+        return None
+
+    def views(self, queries):
+        """Sort the stored links into views, given a dictionary of simpy
+        queries keyed by view name. Returns a dictionary of lists of links
+        keyed by the same names, as search() would give them; a link can be
+        in more than one view.
+
+        The views that are queries on tags are worked out together by
+        partition(), with the links in them read once."""
+        expressions, views = {}, {}
+        for name, text in queries.items():
+            expression = Query(text).tagExpression()
+            if expression is None:
+                views[name] = self.search(text)
+            else:
+                expressions[name] = expression
+        views.update(self.partition(expressions))
+        return views
+
+    def sync(self, client, force=False, full=False):
+        """Bring the store up to date with simpy using `client`, a
+        SimpyClient.
+
+        Does nothing if the last sync was less than SYNC_INTERVAL seconds ago,
+        unless `force` is true. The whole account is downloaded again if
+        `full` is true, which anything that changes links on simpy should
+        ask for, since a delta sync can't see the change, and if the store
+        was last filled with another `query`.
+
+        Only one sync runs at a time, in any thread or process. A sync that
+        finds another one running does nothing, unless it is a full one or
+        the store has never been filled, which wait for it to finish.
+        Returns the number of links that were added, changed or removed.
+        Errors from the client (urllib2.HTTPError etc.) are passed on and
+        leave the store as it was, as does sqlite3.OperationalError if a
+        sync that waits for another one times out."""
+        now = time.time()
+        last_sync = float(self.getState('last_sync', 0))
+        if not force and not full and now - last_sync < SYNC_INTERVAL:
+            return 0
+        db = self._db()
+        empty = self.isEmpty()
+        if not self._beginWrite(db, full or empty):
+            return 0
+        try:
+            if empty and not full and not self.isEmpty():
+                # Another sync filled the store while this one waited.
+                db.rollback()
+                return 0
+            last_full = float(self.getState('last_full_sync', 0))
+            high_water = self.getState('high_water')
+            if full or not high_water or \
+               now - last_full > FULL_SYNC_INTERVAL or \
+               self.getState('query', u'') != (self.query or u''):
+                changed = self._fullSync(db, client, now)
+            else:
+                changed = self._deltaSync(db, client, now, high_water)
+        except:
+            db.rollback()
+            raise
+        db.commit()
+        return changed
+
+    def _beginWrite(self, db, wait):
+        """Begin a transaction to write in, which only one connection can
+        have at a time. If another one has it, wait for it unless `wait` is
+        false, in which case return False straight away."""
+        if wait:
+            db.execute('BEGIN IMMEDIATE')
+            return True
+        db.execute('PRAGMA busy_timeout = 0')
+        try:
+            try:
+                db.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError:
+                return False
+        finally:
+            db.execute('PRAGMA busy_timeout = %d' % (DB_TIMEOUT * 1000))
+        return True
+
+    def _params(self, **params):
+        params['limit'] = '-1'
+        if self.query:
+            params['q'] = self.query
+        return params
+
+    def _fullSync(self, db, client, now):
+        links = client.iterLinks(self._params())
+        generation = int(self.getState('generation', 0)) + 1
+        changed, high_water = self._save(db, links, generation)
+        # Anything not in the download was deleted from simpy.
+        db.execute('DELETE FROM link_tags WHERE id IN '
+                   '(SELECT id FROM links WHERE seen < ?)', (generation,))
+        changed += db.execute('DELETE FROM links WHERE seen < ?',
+                              (generation,)).rowcount
+        setState(db, 'generation', generation)
+        setState(db, 'last_full_sync', now)
+        setState(db, 'query', self.query or u'')
+        self._finishSync(db, high_water, changed, now)
+        return changed
+
+    def _deltaSync(self, db, client, now, high_water):
+        # afterDate and beforeDate are exclusive and only have a resolution
+        # of a day, so widen the window by a day on either side.
+        after = parseSimpyDate(high_water)
+        if isinstance(after, datetime.datetime):
+            after = after.date()
+        after -= datetime.timedelta(days=1)
+        before = datetime.date.today() + datetime.timedelta(days=2)
+        links = client.iterLinks(self._params(afterDate=after.isoformat(),
+                                              beforeDate=before.isoformat()))
+        generation = int(self.getState('generation', 0))
+        changed, high_water = self._save(db, links, generation)
+        self._finishSync(db, high_water, changed, now)
+        return changed
+
+    def _finishSync(self, db, high_water, changed, now):
+        high_water = max(high_water, self.getState('high_water', ''))
+        setState(db, 'high_water', high_water)
+        setState(db, 'last_sync', now)
+        if self._summarize(db) or changed:
+            setState(db, 'version', self.version() + 1)
+        if self.searchIndex is not None:
+            self.searchIndex.update(db, rowToLink)
+        if self.tagIndex is not None:
+            self.tagIndex.update(db)
+
+    def _summarize(self, db):
+        """Summarize the notes whose summary is missing or was made by
+        another version of the summarizer: the links written by this sync,
+        or all of them if the summarizer has changed. Returns how many were
+        summarized."""
+        if self.summarizer is None:
+            return 0
+        version = self.summarizer.version
+        rows = db.execute('SELECT id, note FROM links '
+                          'WHERE summary_version != ?', (version,)).fetchall()
+        for i in range(0, len(rows), SUMMARY_BATCH):
+            batch = rows[i:i + SUMMARY_BATCH]
+            summaries = self.summarizer.summarize([row[1] for row in batch])
+            db.executemany('UPDATE links SET excerpt_text = ?, '
+                           'excerpt_html = ?, word_count = ?, '
+                           'summary_version = ? WHERE id = ?',
+                           [(text, html, words, version, row[0])
+                            for row, (text, html, words)
+                            in zip(batch, summaries)])
+        setState(db, 'summary_version', version)
+        return len(rows)
+
+    def _save(self, db, links, generation):
+        """Insert or update `links`, marking them as seen in `generation`.
+        Links whose modDate hasn't changed are left alone. Returns the number
+        of links written and the newest addDate or modDate seen."""
+        changed = 0
+        high_water = ''
+        for link in links:
+            high_water = max(high_water, link.addDateStr, link.modDateStr)
+            id = linkId(link.url)
+            row = db.execute('SELECT modDate FROM links WHERE id = ?',
+                             (id,)).fetchone()
+            if row is not None and row[0] == link.modDateStr:
+                db.execute('UPDATE links SET seen = ? WHERE id = ?',
+                           (generation, id))
+                continue
+            db.execute('INSERT OR REPLACE INTO links (%s, seen, permalink_id) '
+                       'VALUES (%s, ?, ?)' % (', '.join(LINK_FIELDS),
+                                              ', '.join('?' * len(LINK_FIELDS))),
+                       (id, link.url, link.title, link.nickname, link.note,
+                        link.accessType, ','.join(link.tags),
+                        link.addDateStr, link.modDateStr, generation,
+                        permalinkId(link.url)))
+            db.execute('DELETE FROM link_tags WHERE id = ?', (id,))
+            db.executemany('INSERT INTO link_tags (id, tag) VALUES (?, ?)',
+                           [(id, tag) for tag in link.tags])
+            changed += 1
+        return changed, high_water
@@ -0,0 +1,55 @@
+"""Summaries of notes for the listing pages: the first words of a note as
+plain text and as html, and how many words there are in all, so that a page
+doesn't have to carry every note in full.
+"""
+import re, cgi, htmlentitydefs
+
+# How many words of a note the listings show.
+EXCERPT_WORDS = 40
+
+# Change this whenever summarize() would give a different summary, so that
+# the stored summaries are made again.
+VERSION = '1'
+
+TAG_RE = re.compile(r'<[^>]*>')
+ENTITY_RE = re.compile(r'&(#[xX][0-9a-fA-F]+|#[0-9]+|[a-zA-Z][a-zA-Z0-9]*);')
+
+def _entity(match):
+    name = match.group(1)
+    try:
+        if name[:2] in ('#x', '#X'):
+            return unichr(int(name[2:], 16))
+        if name[0] == '#':
+            return unichr(int(name[1:]))
+        return unichr(htmlentitydefs.name2codepoint[name])
+    except (KeyError, ValueError, OverflowError):
+        return match.group(0)
+
+def htmlToText(html):
+    """Return the text of a piece of html, with the tags taken out, the
+    entities replaced and the whitespace collapsed."""
+    text = ENTITY_RE.sub(_entity, TAG_RE.sub(u' ', html))
+    return u' '.join(text.split())
+
+def summarize(html, words=EXCERPT_WORDS):
+    """Return (text, html, word count) for the html of a note. A note of no
+    more than `words` words is its own summary; a longer one is cut short as
+    plain text."""
+    text = htmlToText(html)
+    all_words = text.split()
+    if len(all_words) <= words:
+        return text, html, len(all_words)
+    excerpt = u' '.join(all_words[:words]) + u' \u2026'
+    return excerpt, u'<p>%s</p>\n' % cgi.escape(excerpt), len(all_words)
+
+class Summarizer:
+    """Makes the summaries for lists of notes, given `render`, a function
+    that returns the html for a list of notes, and `version`, which changes
+    whenever the html render gives would."""
+
+    def __init__(self, render, version=''):
+        self.render = render
+        self.version = '%s/%s' % (VERSION, version)
+
+    def summarize(self, notes):
+        return [summarize(html) for html in self.render(notes)]
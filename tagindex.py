@@ -0,0 +1,278 @@
+"""An index of the tags of the links in the store, for finding the links in a
+view without reading every link.
+
+Each tag is given an integer id, and each link an ordinal. The index keeps a
+bitmap for each tag, a Python long with a bit set for every link that has
+the tag, packed into a blob in the store's database. A query on tags is
+answered by combining their bitmaps with &, | and ~, and only the links
+whose bits are set in the result are read. LinkStore keeps the index up to
+date as links are added, changed and removed, and with it how many links
+each tag has, which a TagTrie completes tags from.
+
+A query is a tag expression, a tuple made of:
+
+    (TAG, tag)              the links that have `tag`
+    (AND, expression, ...)  the links that match all of the expressions
+    (OR, expression, ...)   the links that match any of them
+    (NOT, expression)       the links that don't match it
+    (ALL,)                  every link
+
+For example the unread links are
+(AND, (TAG, u'read later'), (NOT, (TAG, u'have read'))).
+"""
+import binascii, operator
+from cache import LRUCache
+from linkindex import LinkIndex
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tag_docs (
+    ordinal INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    tags BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_bitmaps (
+    id INTEGER PRIMARY KEY,
+    tag TEXT NOT NULL UNIQUE,
+    bitmap BLOB NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+
+TAG, AND, OR, NOT, ALL = 'tag', 'and', 'or', 'not', 'all'
+
+# The bitmap of every link is kept as that of a tag with no name, which
+# simpy tags never are.
+ALL_LINKS = u''
+
+def tagExpression(include=(), exclude=()):
+    """Return the expression for the links that have all the tags in
+    `include` and none of the tags in `exclude`."""
+    terms = [(TAG, tag) for tag in include] + \
+            [(NOT, (TAG, tag)) for tag in exclude]
+    if not terms:
+        return (ALL,)
+    return (AND,) + tuple(terms)
+
+def matches(expression, tags):
+    """Return whether a link with `tags` matches a tag expression, working
+    it out from the link alone."""
+    op = expression[0]
+    if op == TAG:
+        return expression[1] in tags
+    if op == AND:
+        for term in expression[1:]:
+            if not matches(term, tags):
+                return False
+        return True
+    if op == OR:
+        for term in expression[1:]:
+            if matches(term, tags):
+                return True
+        return False
+    if op == NOT:
+        return not matches(expression[1], tags)
+    if op == ALL:
+        return True
+    raise ValueError('not a tag expression: %r' % (expression,))
+
+# Bitmaps are stored as their bytes, most significant first.
+def encodeBitmap(bitmap):
+    if not bitmap:
+        return buffer('')
+    hexed = '%x' % bitmap
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    return buffer(binascii.unhexlify(hexed))
+
+def decodeBitmap(blob):
+    blob = str(blob)
+    if not blob:
+        return 0L
+    return long(binascii.hexlify(blob), 16)
+
+def _bitmapBytes(bitmap):
+    """Return the bytes of a bitmap, least significant first."""
+    data = bytearray(str(encodeBitmap(bitmap)))
+    data.reverse()
+    return data
+
+def bitmap(ordinals):
+    """Return the bitmap with the bits of `ordinals` set."""
+    if not ordinals:
+        return 0L
+    # Setting the bits of a long one at a time would copy it each time, so
+    # they are set in a bytearray that is turned into a long at the end.
+    data = bytearray(max(ordinals) // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    data.reverse()
+    return long(binascii.hexlify(str(data)), 16)
+
+# The positions of the bits set in each value of a byte.
+BYTE_BITS = [tuple([bit for bit in range(8) if byte >> bit & 1])
+             for byte in range(256)]
+
+def ordinals(bitmap):
+    """Return the ordinals of the bits set in a bitmap, in increasing
+    order."""
+    result = []
+    for i, byte in enumerate(_bitmapBytes(bitmap)):
+        if byte:
+            base = i << 3
+            result.extend([base + bit for bit in BYTE_BITS[byte]])
+    return result
+
+def count(bitmap):
+    """Return how many bits are set in a bitmap."""
+    return bin(bitmap).count('1')
+
+class TagTrie:
+    """Completes the start of a tag to the tags that begin with it, ignoring
+    case, most used first, in time that only depends on how long the start
+    is. Made from a list of tag counts, most used first, as TagIndex.counts()
+    gives them."""
+
+    def __init__(self, counts, size=10):
+        # A node is a dictionary of the nodes for the next character, with
+        # the `size` most used tags below it under None.
+        self.size = size
+        self.root = {None: []}
+        for item in counts:
+            node = self.root
+            if len(node[None]) < size:
+                node[None].append(item)
+            for char in item['tag'].lower():
+                child = node.get(char)
+                if child is None:
+                    child = node[char] = {None: []}
+                node = child
+                if len(node[None]) < size:
+                    node[None].append(item)
+
+    def complete(self, prefix, limit=10):
+        """Return the counts of the most used tags that begin with
+        `prefix`, at most `limit` of them."""
+        node = self.root
+        for char in prefix.lower():
+            node = node.get(char)
+            if node is None:
+                return []
+        return node[None][:limit]
+
+class TagIndex(LinkIndex):
+    """The tag index, used by a LinkStore through the methods that take its
+    database connection."""
+
+    def __init__(self, cache_size=1000):
+        # Bitmaps that have been read, keyed by the generation of the index
+        # they were read from and the tag.
+        self.bitmap_cache = LRUCache(cache_size)
+        # The generation of the index, the tag counts and the TagTrie made
+        # from them, from the last time they were asked for.
+        self._counts = (None, None, None)
+
+    def createTables(self, db):
+        db.executescript(SCHEMA)
+
+    docs_table, docs_column = 'tag_docs', 'tags'
+    keys_table, key_column = 'tag_bitmaps', 'tag'
+    value_columns = ('bitmap', 'count')
+    empty_values = (buffer(''), 0)
+    link_columns = 'id, tags'
+    dirty_column = 'tagged'
+    generation_key = 'tag_generation'
+    all_key = ALL_LINKS
+
+    def _linkKeys(self, row, rowToLink):
+        return dict.fromkeys([tag for tag in row['tags'].split(',') if tag],
+                             True)
+
+    def _merge(self, blob, changed):
+        result = decodeBitmap(blob)
+        result &= ~bitmap([ordinal for ordinal, on in changed.items()
+                           if not on])
+        result |= bitmap([ordinal for ordinal, on in changed.items() if on])
+        if not result:
+            return None
+        return encodeBitmap(result), count(result)
+
+    def _bitmap(self, db, generation, tag):
+        key = (generation, tag)
+        result = self.bitmap_cache.get(key)
+        if result is None:
+            row = db.execute('SELECT bitmap FROM tag_bitmaps WHERE tag = ?',
+                             (tag,)).fetchone()
+            if row is None:
+                result = 0L
+            else:
+                result = decodeBitmap(row[0])
+            self.bitmap_cache.set(key, result)
+        return result
+
+    def evaluate(self, db, expression):
+        """Return the bitmap of the links that match a tag expression."""
+        return self._evaluate(db, self.generation(db), expression)
+
+    def _evaluate(self, db, generation, expression):
+        op = expression[0]
+        if op == TAG:
+            return self._bitmap(db, generation, expression[1])
+        if op == AND:
+            # The terms that are negated are taken away from the others, so
+            # that the bitmap of everything they don't match is never made.
+            terms = [term for term in expression[1:] if term[0] != NOT]
+            if terms:
+                result = reduce(operator.and_,
+                                [self._evaluate(db, generation, term)
+                                 for term in terms])
+            else:
+                result = self._bitmap(db, generation, ALL_LINKS)
+            for term in expression[1:]:
+                if not result:
+                    break
+                if term[0] == NOT:
+                    result &= ~self._evaluate(db, generation, term[1])
+            return result
+        if op == OR:
+            return reduce(operator.or_,
+                          [self._evaluate(db, generation, term)
+                           for term in expression[1:]], 0L)
+        if op == NOT:
+            return self._bitmap(db, generation, ALL_LINKS) & \
+                ~self._evaluate(db, generation, expression[1])
+        if op == ALL:
+            return self._bitmap(db, generation, ALL_LINKS)
+        raise ValueError('not a tag expression: %r' % (expression,))
+
+    def _readCounts(self, db):
+        generation = self.generation(db)
+        if self._counts[0] != generation:
+            counts = [{'tag': tag, 'count': count} for tag, count
+                      in db.execute('SELECT tag, count FROM tag_bitmaps '
+                                    'WHERE tag != ? ORDER BY count DESC, tag',
+                                    (ALL_LINKS,))]
+            self._counts = (generation, counts, None)
+        return self._counts
+
+    def counts(self, db):
+        """Return how many links each tag has, most used first, as a list
+        of dictionaries with the 'tag' and the 'count', as
+        SimpyClient.getTags() gives them."""
+        return self._readCounts(db)[1]
+
+    def complete(self, db, prefix, limit=10):
+        """Return the counts of the most used tags that begin with
+        `prefix`, ignoring case, at most `limit` of them."""
+        generation, counts, trie = self._readCounts(db)
+        if trie is None or limit > trie.size:
+            trie = TagTrie(counts, max(limit, 10))
+            self._counts = (generation, counts, trie)
+        return trie.complete(prefix, limit)
+
+    def linkCount(self, db):
+        """Return how many links are indexed."""
+        row = db.execute('SELECT count FROM tag_bitmaps WHERE tag = ?',
+                         (ALL_LINKS,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]